@@ -0,0 +1,112 @@
+import hashlib
+import os
+import pathlib as pl
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import runReport as rr
+
+ARTWORK_CACHE_DIR = ".artwork_cache"
+ARTWORK_CACHE_MAX_BYTES = 512 * 1024 * 1024
+MEMORY_ITEMS = 64
+
+class ArtworkCache:
+    # Converted covers stored by the hash of the source image bytes, so an album that embeds
+    # the same cover in every track gets converted once. Disk entries survive across runs and
+    # are evicted least recently used first once max_bytes is exceeded.
+    def __init__(self, directory=ARTWORK_CACHE_DIR, max_bytes=ARTWORK_CACHE_MAX_BYTES, memory_items=MEMORY_ITEMS):
+        self.dir = pl.Path(directory)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.memory_items = memory_items
+        self.memory = OrderedDict()
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.size = sum(f.stat().st_size for f in self.dir.glob("*.img"))
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, data: bytes, variant=""):
+        return hashlib.sha256(variant.encode("utf-8") + b"\0" + data).hexdigest()
+
+    def remember(self, digest, data):
+        self.memory[digest] = data
+        self.memory.move_to_end(digest)
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+    def get(self, digest):
+        with self.lock:
+            if digest in self.memory:
+                self.memory.move_to_end(digest)
+                return self.memory[digest]
+        path = self.dir / f"{digest}.img"
+        try:
+            data = path.read_bytes()
+            os.utime(path)  # mtime is the LRU clock
+        except OSError:
+            return None
+        with self.lock:
+            self.remember(digest, data)
+        return data
+
+    def put(self, digest, data):
+        path = self.dir / f"{digest}.img"
+        temp = self.dir / f"{digest}.{threading.get_ident()}.tmp"
+        temp.write_bytes(data)
+        os.replace(temp, path)
+        with self.lock:
+            self.remember(digest, data)
+            self.size += len(data)
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        # Trim to 90% so eviction doesn't run on every put once the cache is full
+        files = sorted(self.dir.glob("*.img"), key=lambda f: f.stat().st_mtime)
+        self.size = sum(f.stat().st_size for f in files)
+        for f in files:
+            if self.size <= self.max_bytes * 0.9:
+                break
+            self.size -= f.stat().st_size
+            f.unlink(missing_ok=True)
+            self.memory.pop(f.stem, None)
+
+    def convert(self, data: bytes, convert_func, variant=""):
+        # convert_func(data) -> bytes or None; concurrent requests for the same cover wait for one conversion
+        digest = self.key(data, variant)
+        cached = self.get(digest)
+        if cached is not None:
+            with self.lock:
+                self.hits += 1
+            rr.count("artwork_cache_hit")
+            return cached
+
+        with self.lock:
+            future = self.inflight.get(digest)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.inflight[digest] = future
+            else:
+                self.hits += 1
+        if not owner:
+            rr.count("artwork_cache_hit")
+            return future.result()
+
+        try:
+            converted = convert_func(data)
+            if converted:
+                self.put(digest, converted)
+            with self.lock:
+                self.misses += 1
+            rr.count("artwork_cache_miss")
+            future.set_result(converted)
+            return converted
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.inflight.pop(digest, None)
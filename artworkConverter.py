@@ -1,13 +1,72 @@
-import ffmpeg as ff
+import io
+import threading
+
+import progressMonitor as pm
+
+ARTWORK_SIZE = 1000
+
+# Pillow and ffmpeg-python are imported on the first conversion
+_pillow = None
+_pillow_lock = threading.Lock()
+
+def pillow():
+    # (Image, ImageOps), or None when Pillow isn't installed
+    global _pillow
+    with _pillow_lock:
+        if _pillow is None:
+            try:
+                from PIL import Image, ImageOps
+                _pillow = (Image, ImageOps)
+            except ImportError:  # Pillow is optional, ffmpeg over pipes is the fallback
+                _pillow = False
+        return _pillow or None
 
 def convertArtwork(input_path, output_path):
+    import ffmpeg as ff
     try:
-        (
+        stream = (
             ff.input(input_path)
-            .filter("scale", 1000, 1000, force_original_aspect_ratio="increase")
-            .filter('crop', 1000, 1000)
+            .filter("scale", ARTWORK_SIZE, ARTWORK_SIZE, force_original_aspect_ratio="increase")
+            .filter('crop', ARTWORK_SIZE, ARTWORK_SIZE)
             .output(output_path, vframes=1, format="image2")
-            .run(overwrite_output=True, capture_stderr=True)
+            .global_args(*pm.progressArgs())
         )
+        with pm.task("artwork", counted=False) as task:
+            process = stream.run_async(pipe_stderr=True, overwrite_output=True)
+            _, stderr = pm.communicate(process, task)
+        if process.returncode:
+            raise ff.Error("ffmpeg", None, stderr)
+    except ff.Error as e:
+        print(f"Error converting artwork: {e.stderr.decode()}")
+
+def convertArtworkBytes(data: bytes):
+    # Same scale/crop as convertArtwork, image in and PNG out, without touching the disk
+    import ffmpeg as ff
+    try:
+        with pm.task("artwork", counted=False) as task:
+            if pillow():
+                Image, ImageOps = pillow()
+                with Image.open(io.BytesIO(data)) as img:
+                    img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+                    img = ImageOps.fit(img, (ARTWORK_SIZE, ARTWORK_SIZE), Image.LANCZOS)
+                    out = io.BytesIO()
+                    img.save(out, format="PNG")
+                    return out.getvalue()
+
+            process = (
+                ff.input("pipe:", format="image2pipe")
+                .filter("scale", ARTWORK_SIZE, ARTWORK_SIZE, force_original_aspect_ratio="increase")
+                .filter('crop', ARTWORK_SIZE, ARTWORK_SIZE)
+                .output("pipe:", vframes=1, format="image2pipe", vcodec="png")
+                .global_args(*pm.progressArgs())
+                .run_async(pipe_stdin=True, pipe_stdout=True, pipe_stderr=True)
+            )
+            out, stderr = pm.communicate(process, task, input=data)
+        if process.returncode:
+            raise ff.Error("ffmpeg", out, stderr)
+        return out
     except ff.Error as e:
-        print(f"Error converting artwork: {e.stderr.decode()}")
\ No newline at end of file
+        print(f"Error converting artwork: {e.stderr.decode(errors='ignore')}")
+    except Exception as e:
+        print(f"Error converting artwork: {e}")
+    return None
@@ -1,14 +1,56 @@
-import ffmpeg
+import functools
+import os
+
+import progressMonitor as pm
+import replayGainAnalyzer as rga
+import tagSession as ts
+
+# ffmpeg-python and the NumPy meter are imported when something is converted, not at startup
 
 AUDIO_FORMATS = ["mp3", "flac", "m4a", "opus", "ogg", "wav"]
 SAMPLE_RATES = ["8000", "11025", "16000", "22050", "32000", "44100", "48000", "88200", "96000", "176000", "192000", "352000", "384000", "384000"]
 BITRATES = ["64k", "96k", "128k", "192k", "256k", "320k"]
 
+# Encoder -> codec_name reported by ffprobe, and which containers can carry it without re-encoding
+PROBED_CODECS = {"libmp3lame": "mp3", "flac": "flac", "pcm_s16le": "pcm_s16le", "libopus": "opus", "libvorbis": "vorbis", "aac": "aac"}
+LOSSLESS_CODECS = ["flac", "pcm_s16le"]
+BITRATE_TOLERANCE = 0.08
+RESERVE_OPTION = "/metadata"  # ffmpeg 7 reads "-/metadata file" as -metadata with the file's contents
+
+@functools.lru_cache(maxsize=None)
+def optionFiles():
+    # ffmpeg before 7.0 has no -/option, the placeholder tag would be too long for a command line
+    import re
+    import subprocess
+    try:
+        version = subprocess.run(["ffmpeg", "-hide_banner", "-version"], capture_output=True, text=True).stdout
+    except OSError:
+        return False
+    match = re.match(r"ffmpeg version n?(\d+)\.", version)
+    if match and int(match.group(1)) < 7:
+        print(f"AUDIO CONVERTER: ffmpeg {match.group(1)} cannot reserve tag space (needs 7.0), tagging rewrites each file.")
+        return False
+    return True  # Git builds (N-12345-g...) are newer than any release
+
+def reservePlaceholder(size):
+    # Option file for the placeholder tag, removed with removePlaceholder once ffmpeg is done
+    import tempfile
+    with tempfile.NamedTemporaryFile("w", prefix="reserve_", suffix=".txt", delete=False, encoding="ascii") as f:
+        f.write(f"{ts.RESERVED_TAG}={' ' * size}")
+    return f.name
+
+def removePlaceholder(output_kwargs):
+    if output_kwargs and RESERVE_OPTION in output_kwargs:
+        try:
+            os.remove(output_kwargs[RESERVE_OPTION])
+        except OSError:
+            pass
+
 class AudioConverter:
     def __init__(self, sample_rate=48000, channels=2, bitrate="192k",
                  output_format="mp3", acodec=None, preserve_metadata=True):
-        self.sample_rate = sample_rate
-        self.channels = channels
+        self.sample_rate = int(sample_rate)
+        self.channels = int(channels)
         self.bitrate = bitrate
         self.output_format = output_format
         self.acodec = acodec
@@ -28,7 +70,7 @@ class AudioConverter:
         if self.output_format not in AUDIO_FORMATS:
             self.output_format = "wav"  # Default to WAV
             print(f"Unsupported output format specified. Defaulting to WAV.")
-        if self.sample_rate <= 0 or self.sample_rate not in SAMPLE_RATES:
+        if self.sample_rate <= 0 or str(self.sample_rate) not in SAMPLE_RATES:
             self.sample_rate = 48000  # Default sample rate
             print(f"Invalid sample rate specified. Defaulting to 48000 Hz.")
         if self.channels not in [1, 2]:
@@ -38,32 +80,112 @@ class AudioConverter:
             self.bitrate = "192k"  # Default bitrate
             print(f"Invalid bitrate specified. Defaulting to 192 kbps.")
 
-    def converter(self, input_path, output_path):
+    def profileName(self):
+        # Folder name used when several profiles are written in one run
+        if PROBED_CODECS.get(self.acodec, self.acodec) in LOSSLESS_CODECS:
+            return self.output_format
+        return f"{self.output_format}-{self.bitrate}"
+
+    def describe(self):
+        return {
+            "output_format": self.output_format,
+            "sample_rate": self.sample_rate,
+            "channels": self.channels,
+            "bitrate": self.bitrate,
+            "acodec": self.acodec,
+            "preserve_metadata": self.preserve_metadata,
+        }
+
+    def probe(self, input_path):
+        import ffmpeg
+        info = ffmpeg.probe(input_path)
+        return next((stream for stream in info.get("streams", []) if stream.get("codec_type") == "audio"), None), info.get("format", {})
+
+    def canStreamCopy(self, input_path):
+        # True when the source's first audio stream already is what converter() would produce
+        import ffmpeg
         try:
-            m4aShit = {
-                "m4a": "mp4"
-            }.get(self.output_format, self.output_format)
-            output_kwargs = {
-                "ar": self.sample_rate,
-                "ac": self.channels,
-                "format": m4aShit,
-                "acodec": self.acodec,
-                "audio_bitrate": self.bitrate,
-                "loglevel": "error",
-            }
-            if self.output_format == "m4a":
-                output_kwargs.pop("b:a", None)
-                output_kwargs["q:a"] = 2  # 0 (Best) : 5 (Worst)
+            stream, container = self.probe(input_path)
+        except ffmpeg.Error as e:
+            print(f"AUDIO CONVERTER: Could not probe {input_path}: {e.stderr.decode(errors='ignore').strip()}")
+            return False
+        except Exception as e:
+            print(f"AUDIO CONVERTER: Could not probe {input_path}: {e}")
+            return False
+        return self.matchesProfile(stream, container)
 
+    def matchesProfile(self, stream, container=None):
+        if not stream:
+            return False
+        codec = PROBED_CODECS.get(self.acodec, self.acodec)
+        if stream.get("codec_name") != codec:
+            return False
+        if int(stream.get("sample_rate", 0)) != self.sample_rate or int(stream.get("channels", 0)) != self.channels:
+            return False
+        if codec in LOSSLESS_CODECS:
+            return True
+        if self.output_format == "m4a":
+            # Encoded at a VBR quality (q:a), not a bitrate, so any AAC stream at the target rate and layout will do
+            return True
+        bit_rate = stream.get("bit_rate")
+        if not bit_rate and int((container or {}).get("nb_streams", 0)) == 1:
+            # The container's rate only stands in when the audio is all it holds, cover art would inflate it
+            bit_rate = container.get("bit_rate")
+        if not bit_rate:
+            return False
+        target = int(self.bitrate.rstrip("k")) * 1000
+        return abs(int(bit_rate) - target) <= target * BITRATE_TOLERANCE
+
+    def outputKwargs(self, copy=False, reserve=None):
+        # reserve: size of the cover the tags written after the encode will carry (0 for none), None when
+        # nothing is tagged later. Its room is held by a placeholder tag, see tagSession.RESERVED_TAG.
+        m4aShit = {
+            "m4a": "mp4"
+        }.get(self.output_format, self.output_format)
+        if copy:
+            # Remux only, the audio packets are kept as they are
+            output_kwargs = {"format": m4aShit, "acodec": "copy", "loglevel": "error"}
             if not self.preserve_metadata:
                 output_kwargs["map_metadata"] = "-1"
+            return self.reserveKwargs(output_kwargs, reserve)
+        output_kwargs = {
+            "ar": self.sample_rate,
+            "ac": self.channels,
+            "format": m4aShit,
+            "acodec": self.acodec,
+            "audio_bitrate": self.bitrate,
+            "loglevel": "error",
+        }
+        if self.output_format == "m4a":
+            output_kwargs.pop("b:a", None)
+            output_kwargs["q:a"] = 2  # 0 (Best) : 5 (Worst)
+
+        if not self.preserve_metadata:
+            output_kwargs["map_metadata"] = "-1"
+        return self.reserveKwargs(output_kwargs, reserve)
+
+    def reserveKwargs(self, output_kwargs, reserve):
+        size = ts.reserveSize(self.output_format, reserve) if reserve is not None and self.preserve_metadata else 0
+        if size and optionFiles():
+            output_kwargs[RESERVE_OPTION] = reservePlaceholder(size)
+        return output_kwargs
+
+    def converter(self, input_path, output_path, copy=False, reserve=None):
+        import ffmpeg
+        output_kwargs = None
+        try:
+            output_kwargs = self.outputKwargs(copy, reserve)
             stream = (
                 ffmpeg
                 .input(input_path)
                 .output(output_path, vn=None, **{"map":"0:a:0"}, **output_kwargs) 
+                .global_args(*pm.progressArgs())
             )
-            print(ffmpeg.compile(stream))
-            stream.run(overwrite_output=True, capture_stderr=True)
+            with pm.task("remux" if copy else "encode", input_path) as task:
+                process = stream.run_async(pipe_stderr=True, overwrite_output=True)
+                _, stderr = pm.communicate(process, task)
+            if process.returncode:
+                raise ffmpeg.Error("ffmpeg", None, stderr)
 
         except ffmpeg.Error as e:
             print(f"FFmpeg error converting {input_path}: {e.stderr.decode()}")
@@ -71,4 +193,102 @@ class AudioConverter:
         except Exception as e:
             print(f"Error converting {input_path}: {e}")
             return False
-        return True
\ No newline at end of file
+        finally:
+            removePlaceholder(output_kwargs)
+        return True
+
+    def convertAndAnalyze(self, input_path, output_path, copy=False, reserve=None):
+        # Single decode: asplit feeds the encoder and an ebur128 meter in the same ffmpeg process
+        # Returns (converted, (gain, peak) or None)
+        return convertProfiles(input_path, [(self, output_path, copy)], analyze=True, meter_format=self, reserve=reserve)
+
+def convertProfiles(input_path, targets, analyze=True, meter_format=None, reserve=None):
+    # One ffmpeg process decodes the source once and asplit feeds every encoder (plus the ebur128 meter).
+    # targets: [(AudioConverter, output_path, copy)]. Copy targets take the packets untouched.
+    # The meter reads the decoded source, or meter_format's rate/layout when given. With the NumPy analyser
+    # the meter branch is raw float PCM on stdout, measured here while ffmpeg is still encoding.
+    # Returns (converted, (gain, peak) or None)
+    import ffmpeg
+    import loudnessMeter as lm
+    placeholders = []
+    try:
+        meter_info = None
+        if analyze and rga.ANALYZER == "numpy":
+            encoded_meter = meter_format is not None and any(target[0] is meter_format and not target[2] for target in targets)
+            meter_info = (meter_format.sample_rate, meter_format.channels) if encoded_meter else lm.streamInfo(input_path)
+
+        def meterOutput(stream):
+            if meter_info:
+                # Held to the rate and channels the meter is built for, like loudnessMeter.analyzeFile
+                rate, channels = meter_info
+                return stream.output("pipe:", format="f32le", acodec="pcm_f32le", ar=rate, ac=channels)
+            return stream.filter("ebur128", peak="true", framelog="info").output("-", format="null")
+
+        source = ffmpeg.input(input_path)["a:0"]
+        encoded = [target for target in targets if not target[2]]
+        branches = len(encoded) + (1 if analyze and not meter_format else 0)
+        split = source.filter_multi_output("asplit", branches) if branches > 1 else None
+        outputs = []
+        index = 0
+        for settings, output_path, copy in targets:
+            output_kwargs = settings.outputKwargs(copy, reserve)
+            placeholders.append(output_kwargs)
+            # ebur128 prints its summary and per-block log at info level
+            output_kwargs["loglevel"] = "info" if analyze and not meter_info else "error"
+            if copy:
+                # Packets are copied untouched, only the other branches decode
+                outputs.append(source.output(output_path, **output_kwargs))
+                continue
+            branch = split[index] if split else source
+            index += 1
+            formatted = branch.filter("aformat", sample_rates=settings.sample_rate,
+                                      channel_layouts="mono" if settings.channels == 1 else "stereo")
+            if meter_format is settings and analyze:
+                formatted = formatted.filter_multi_output("asplit")
+                outputs.append(formatted[0].output(output_path, **output_kwargs))
+                outputs.append(meterOutput(formatted[1]))
+            else:
+                outputs.append(formatted.output(output_path, **output_kwargs))
+        if analyze and (not meter_format or not encoded):
+            meter = split[index] if split else source
+            outputs.append(meterOutput(meter))
+
+        stream = ffmpeg.merge_outputs(*outputs).global_args("-hide_banner", "-nostats", *pm.progressArgs())
+        stage = "encode+loudness" if analyze else "encode"
+        if meter_info:
+            meter = lm.LoudnessMeter(*meter_info, jobs=rga.ANALYZER_THREADS)
+            with pm.task(stage, input_path) as task:
+                process = stream.run_async(pipe_stdout=True, pipe_stderr=True, overwrite_output=True)
+                stderr = lm.measureProcess(process, meter, task)
+            if process.returncode:
+                raise ffmpeg.Error("ffmpeg", None, stderr)
+            measured = meter.result()
+            return True, rga.fromMeasurement(*measured)
+        with pm.task(stage, input_path) as task:
+            process = stream.run_async(pipe_stderr=True, overwrite_output=True)
+            _, stderr = pm.communicate(process, task)
+        if process.returncode:
+            raise ffmpeg.Error("ffmpeg", None, stderr)
+
+    except ffmpeg.Error as e:
+        print(f"FFmpeg error converting {input_path}: {e.stderr.decode(errors='ignore')}")
+        return False, None
+    except Exception as e:
+        print(f"Error converting {input_path}: {e}")
+        return False, None
+    finally:
+        for output_kwargs in placeholders:
+            removePlaceholder(output_kwargs)
+    if not analyze:
+        return True, None
+    return True, rga.parse_ebur128(stderr.decode("utf-8", errors="ignore"))
+
+def parseProfile(spec, sample_rate=48000, channels=2, preserve_metadata=True):
+    # "format[:bitrate[:sample_rate[:channels]]]", e.g. "mp3:320k" or "opus:128k:48000:2"
+    parts = spec.split(":")
+    output_format = parts[0].lower()
+    bitrate = parts[1] if len(parts) > 1 and parts[1] else "192k"
+    sample_rate = parts[2] if len(parts) > 2 and parts[2] else sample_rate
+    channels = parts[3] if len(parts) > 3 and parts[3] else channels
+    return AudioConverter(sample_rate=sample_rate, channels=channels, bitrate=bitrate,
+                          output_format=output_format, preserve_metadata=preserve_metadata)
@@ -0,0 +1,222 @@
+import collections
+import heapq
+import io
+import itertools
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+
+import runReport as rr
+
+IO_JOBS = 4  # Files that can be in I/O stages (MusicBrainz, tag writes, copies) at once
+# Before the first pick the probe gets this long (or until it has this many items) to see the library
+PROBE_HEAD_START = 2.0
+PROBE_LOOKAHEAD = 1000
+
+def defaultJobs():
+    return os.cpu_count() or 1
+
+class StageLimits:
+    # Separate concurrency limits for CPU stages (encode, loudness, artwork) and I/O stages (MusicBrainz,
+    # tag writes). Workers outnumber CPU slots, so a file waiting on the network doesn't keep an encoder idle.
+    # Slots are never nested, a stage holds one kind at a time.
+    def __init__(self, cpu, io):
+        self.semaphores = {"cpu": threading.Semaphore(cpu), "io": threading.Semaphore(io)}
+
+    @contextmanager
+    def slot(self, kind):
+        semaphore = self.semaphores[kind]
+        start = time.monotonic()
+        semaphore.acquire()
+        rr.record(f"{kind}_slot_wait", time.monotonic() - start)
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+_limits = None
+
+def slot(kind):
+    # "cpu" or "io"; free when no limits are active (single calls outside runParallel)
+    return _limits.slot(kind) if _limits else nullcontext()
+
+class CostQueue:
+    # Hands out items biggest estimated cost first (longest processing time first). A probe thread works
+    # through the lazy item stream and fills the heap, so work starts right away and a long file that shows
+    # up late still jumps ahead of everything shorter that hasn't started.
+    # Items that cost nothing (already done) go out at once, they don't hold a worker a long job would need.
+    def __init__(self, items, cost):
+        self.heap = []
+        self.free = collections.deque()
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.finished = False
+        self.error = None
+        self.total = 0.0
+        self.longest = 0.0
+        self.count = 0
+        threading.Thread(target=self.feed, args=(items, cost), name="cost-probe", daemon=True).start()
+
+    def feed(self, items, cost):
+        try:
+            for item in items:
+                try:
+                    estimate = cost(item)
+                except Exception:
+                    estimate = 0.0
+                with self.cond:
+                    if estimate > 0:
+                        heapq.heappush(self.heap, (-estimate, next(self.counter), item))
+                    else:
+                        self.free.append(item)
+                    self.total += estimate
+                    self.longest = max(self.longest, estimate)
+                    self.count += 1
+                    self.cond.notify()
+        except Exception as e:
+            self.error = e
+        finally:
+            with self.cond:
+                self.finished = True
+                self.cond.notify_all()
+
+    def __iter__(self):
+        deadline = time.monotonic() + PROBE_HEAD_START
+        waiting = True
+        while True:
+            with self.cond:
+                while waiting and not self.free and not self.finished and len(self.heap) < PROBE_LOOKAHEAD and time.monotonic() < deadline:
+                    self.cond.wait(deadline - time.monotonic())
+                waiting = waiting and not (self.finished or len(self.heap) >= PROBE_LOOKAHEAD or time.monotonic() >= deadline)
+                while not self.heap and not self.free and not self.finished:
+                    self.cond.wait()
+                if self.heap and not waiting:
+                    item = heapq.heappop(self.heap)[2]
+                elif self.free:
+                    item = self.free.popleft()
+                elif self.error:
+                    raise self.error
+                else:
+                    return
+            yield item
+
+    def idealSeconds(self, jobs):
+        # Lower bound for the CPU part of the batch: the work spread evenly, but never less than the longest file
+        return max(self.total / max(1, jobs), self.longest)
+
+class ThreadLocalOutput:
+    # Routes print() from worker threads into per-file buffers so logs don't interleave
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text):
+        buffer = getattr(self.local, "buffer", None)
+        if buffer is None:
+            return self.stream.write(text)
+        return buffer.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    @contextmanager
+    def capture(self):
+        buffer = io.StringIO()
+        self.local.buffer = buffer
+        try:
+            yield buffer
+        finally:
+            self.local.buffer = None
+
+class FileResult:
+    def __init__(self, source, value=None, error=None, log=""):
+        self.source = source
+        self.value = value
+        self.error = error
+        self.log = log
+
+    @property
+    def ok(self):
+        return self.error is None
+
+@contextmanager
+def capturedStdout():
+    proxy = sys.stdout if isinstance(sys.stdout, ThreadLocalOutput) else ThreadLocalOutput(sys.stdout)
+    previous = sys.stdout
+    sys.stdout = proxy
+    try:
+        yield proxy
+    finally:
+        sys.stdout = previous
+
+def runTask(proxy, func, item, *args, **kwargs):
+    with proxy.capture() as buffer:
+        try:
+            value = func(item, *args, **kwargs)
+            return FileResult(item, value=value, log=buffer.getvalue())
+        except Exception as e:
+            traceback.print_exc(file=buffer)
+            return FileResult(item, error=e, log=buffer.getvalue())
+
+def runParallel(func, items, *args, jobs=None, io_jobs=None, **kwargs):
+    # Yields a FileResult per item as soon as its pipeline finishes. items may be a lazy
+    # generator; only a few items per worker are pulled ahead so memory stays flat.
+    # jobs bounds the CPU stages and io_jobs the I/O stages (see slot()); with a CostQueue as items a new
+    # item is only taken when a worker is free, so the pick is made as late as possible.
+    # Items are pulled on a feeder thread, so finished files come back even while the next item is still
+    # on its way (a folder watcher can block for hours).
+    global _limits
+    jobs = max(1, int(jobs or defaultJobs()))
+    io_jobs = max(1, int(io_jobs or IO_JOBS))
+    workers = jobs + io_jobs
+    ahead = threading.Semaphore(workers if isinstance(items, CostQueue) else workers * 4)
+    finished = queue.Queue()
+    stopped = threading.Event()
+    _limits = StageLimits(jobs, io_jobs)
+
+    def feed(pool, proxy):
+        submitted = 0
+        try:
+            for item in items:
+                ahead.acquire()
+                if stopped.is_set():
+                    break
+                future = pool.submit(runTask, proxy, func, item, *args, **kwargs)
+                future.add_done_callback(lambda f: (ahead.release(), finished.put(f)))
+                submitted += 1
+        except Exception as e:
+            finished.put(e)
+        finally:
+            finished.put(submitted)
+
+    try:
+        with capturedStdout() as proxy:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="worker") as pool:
+                feeder = threading.Thread(target=feed, args=(pool, proxy), name="batch-feeder", daemon=True)
+                feeder.start()
+                yielded = 0
+                total = None
+                error = None
+                while total is None or yielded < total:
+                    done = finished.get()
+                    if isinstance(done, Exception):
+                        error = done
+                    elif isinstance(done, int):
+                        total = done
+                    else:
+                        yielded += 1
+                        yield done.result()
+                if error:
+                    raise error
+    finally:
+        stopped.set()
+        ahead.release()
+        _limits = None
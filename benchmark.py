@@ -0,0 +1,352 @@
+import audioConverter as ac
+import mbStandIn
+import tagSession as ts
+
+import ffmpeg as ff
+import pathlib as pl
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # Windows, peak RSS is reported as None
+    resource = None
+
+# Deterministic corpus: every format gets tone and noise tracks of each duration, tagged and with a cover
+CORPUS_DIR = ".bench_corpus"
+WORK_DIR = ".bench_run"
+RESULTS_DIR = "benchmarks"
+CORPUS_VERSION = 1
+DURATIONS = [5, 30]
+COVER_SIZE = 1400
+
+def corpusSpec(formats, durations, tracks):
+    return {"version": CORPUS_VERSION, "formats": list(formats), "durations": list(durations), "tracks": tracks}
+
+def corpusTracks(spec):
+    # (format, name, lavfi source, duration) for every file in the corpus
+    for fmt in spec["formats"]:
+        n = 0
+        for duration in spec["durations"]:
+            for i in range(spec["tracks"]):
+                n += 1
+                if n % 2:
+                    source = f"sine=frequency={220 + 110 * n}:sample_rate=44100:duration={duration}"
+                else:
+                    source = f"anoisesrc=color=pink:seed={n}:amplitude=0.25:sample_rate=44100:duration={duration}"
+                yield fmt, f"bench_{fmt}_{n:02d}", source, duration
+
+def makeCover():
+    out, _ = (
+        ff.input(f"testsrc=size={COVER_SIZE}x{COVER_SIZE}:rate=1", format="lavfi")
+        .output("pipe:", vframes=1, format="image2pipe", vcodec="mjpeg")
+        .run(capture_stdout=True, capture_stderr=True)
+    )
+    return out
+
+def buildCorpus(corpus_dir: pl.Path, spec):
+    # Reused as long as the spec matches, so repeated runs measure the same bytes
+    spec_file = corpus_dir / "corpus.json"
+    if spec_file.exists() and json.loads(spec_file.read_text()) == spec:
+        print(f"BENCHMARK: Reusing corpus in {corpus_dir}")
+        return
+    shutil.rmtree(corpus_dir, ignore_errors=True)
+    corpus_dir.mkdir(parents=True)
+    cover = makeCover()
+    for fmt, name, source, duration in corpusTracks(spec):
+        path = corpus_dir / f"{name}.{fmt}"
+        sample_rate = 48000 if fmt == "opus" else 44100  # libopus has no 44.1k mode
+        settings = ac.AudioConverter(sample_rate=sample_rate, channels=2, bitrate="192k", output_format=fmt)
+        output_kwargs = settings.outputKwargs()
+        output_kwargs.update({"fflags": "+bitexact", "flags:a": "+bitexact"})
+        (
+            ff.input(source, format="lavfi")
+            .output(str(path), **output_kwargs)
+            .run(overwrite_output=True, capture_stderr=True)
+        )
+        session = ts.TagSession(path)
+        session.setTags(artist=f"Bench Artist {name[-2:]}", title=f"Bench Title {name}",
+                        album=f"Bench Album {fmt}", year="2020", genre="Test")
+        session.setCover(cover)
+        session.commit()
+    spec_file.write_text(json.dumps(spec))
+    print(f"BENCHMARK: Built corpus in {corpus_dir}")
+
+def corpusFiles(corpus_dir: pl.Path, spec):
+    return [(corpus_dir / f"{name}.{fmt}", duration) for fmt, name, _, duration in corpusTracks(spec)]
+
+def peakRss():
+    # Lifetime peaks in MB: this process, and the largest child (ffmpeg)
+    if resource is None:
+        return None, None
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return (round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+            round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1))
+
+def measure(name, func, files, audio_seconds, repeat=1, verbose=False):
+    # Best of `repeat` runs, func(iteration) does the work
+    best = None
+    for iteration in range(repeat):
+        sink = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+        with sink:
+            start = time.perf_counter()
+            func(iteration)
+            elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    rss, child_rss = peakRss()
+    result = {
+        "seconds": round(best, 4),
+        "files": files,
+        "audio_seconds": audio_seconds,
+        "files_per_s": round(files / best, 3) if best else None,
+        "audio_s_per_s": round(audio_seconds / best, 3) if best else None,
+        "peak_rss_mb": rss,
+        "peak_child_rss_mb": child_rss,
+    }
+    print(f"BENCHMARK: {name}: {result['seconds']}s, {result['files_per_s']} files/s, {result['audio_s_per_s']} audio-s/s")
+    return result
+
+def startupTime(args, ready=None):
+    # Seconds from spawning a fresh interpreter until it exits (args), or until `ready` shows up on its stdout
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, *args], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL, cwd=pl.Path(__file__).parent)
+    if ready is None:
+        process.communicate()
+        return time.perf_counter() - start
+    seen = b""
+    while ready not in seen:
+        data = process.stdout.read1(4096)
+        if not data:
+            break
+        seen += data
+    elapsed = time.perf_counter() - start
+    process.kill()
+    process.communicate()
+    return elapsed if ready in seen else None
+
+def measureStartup(repeat):
+    # Import and menu-ready latency in fresh interpreters, best of `repeat` (at least 3) with the bare
+    # interpreter start alongside so the numbers can be read on any machine
+    runs = max(3, repeat)
+    baseline = min(startupTime(["-c", "pass"]) for _ in range(runs))
+    results = {}
+    for name, args, ready in [("startup_import", ["-c", "import main"], None),
+                              ("startup_menu", ["main.py", "--no-report"], b"Select an option")]:
+        times = [startupTime(args, ready) for _ in range(runs)]
+        if None in times:
+            print(f"BENCHMARK: {name}: never got ready")
+            continue
+        best = min(times)
+        results[name] = {"seconds": round(best, 4), "interpreter_seconds": round(baseline, 4),
+                         "overhead_seconds": round(best - baseline, 4)}
+        print(f"BENCHMARK: {name}: {results[name]['seconds']}s ({results[name]['overhead_seconds']}s over a bare interpreter)")
+    return results
+
+def resetWorkDir(work_dir: pl.Path):
+    # Open caches are closed first, a run after this one opens them again on its first lookup and starts cold
+    import mbLookup as mbl
+    import replayGainAnalyzer as rga
+    mbl.closeCache()
+    rga.closeCache()
+    for name in ["Output", "Artwork", ".artwork_cache", "stages"]:
+        shutil.rmtree(work_dir / name, ignore_errors=True)
+    for f in work_dir.glob("*.sqlite*"):
+        f.unlink()
+
+def runBenchmarks(args):
+    corpus_dir = pl.Path(args.corpus).resolve()
+    work_dir = pl.Path(args.work).resolve()
+    spec = corpusSpec(args.formats, args.durations, args.tracks)
+    buildCorpus(corpus_dir, spec)
+    files = corpusFiles(corpus_dir, spec)
+    total_audio = sum(duration for _, duration in files)
+
+    # Everything the converter writes (Output/, caches, manifest) goes to the work dir
+    work_dir.mkdir(parents=True, exist_ok=True)
+    os.chdir(work_dir)
+    resetWorkDir(work_dir)
+    import main
+    sys.excepthook = sys.__excepthook__  # main's hook waits for Enter
+    import artworkConverter as art
+    import replayGainAnalyzer as rga
+    import segmentEncoder as se
+    mbl = main.mbl
+
+    server = mbStandIn.StandInServer(delay=args.mb_delay).start()
+    mbl.setServer(server.hostname)
+    mbl.setRate(args.mb_rate)
+    if args.mb_batch:
+        mbl.MB_BATCH_SIZE = args.mb_batch
+    settings = ac.AudioConverter(sample_rate=48000, channels=2, bitrate="192k", output_format=args.output_format)
+
+    def endToEnd(iteration):
+        resetWorkDir(work_dir)
+        main.batchConvert(corpus_dir, settings, convert_artwork=True, file_renaming=True, modify_metadata=True,
+                          bypass_conversion=False, jobs=args.jobs)
+
+    def rerun(iteration):
+        main.batchConvert(corpus_dir, settings, convert_artwork=True, file_renaming=True, modify_metadata=True,
+                          bypass_conversion=False, jobs=args.jobs)
+
+    results = {}
+    if args.startup:
+        results.update(measureStartup(args.repeat))
+    results["end_to_end"] = measure("end_to_end", endToEnd, len(files), total_audio, args.repeat, args.verbose)
+    results["mb_requests"] = server.requests
+    results["end_to_end_rerun"] = measure("end_to_end_rerun", rerun, len(files), total_audio, args.repeat, args.verbose)
+
+    if args.stages:
+        # Single-threaded per-stage numbers over the same corpus
+        stage_dir = work_dir / "stages"
+        stage_dir.mkdir(exist_ok=True)
+        outputs = [stage_dir / f"{source.stem}_{source.suffix[1:]}.{settings.output_format}" for source, _ in files]
+
+        def encode(iteration):
+            for (source, _), output in zip(files, outputs):
+                settings.converter(str(source), str(output))
+
+        def encodeAnalyze(iteration):
+            for (source, _), output in zip(files, outputs):
+                settings.convertAndAnalyze(str(source), str(output))
+
+        def encodeSegmented(iteration):
+            # Every file split in --jobs segments, however short it is
+            shortest, se.SEGMENT_MIN_SECONDS = se.SEGMENT_MIN_SECONDS, 0
+            try:
+                for (source, _), output in zip(files, outputs):
+                    segments = se.plan(settings, source, args.jobs)
+                    if segments:
+                        se.convertSegmented(settings, str(source), str(output), segments, jobs=args.jobs)
+                    else:
+                        settings.convertAndAnalyze(str(source), str(output))
+            finally:
+                se.SEGMENT_MIN_SECONDS = shortest
+
+        def replaygain(iteration):
+            for source, _ in files:
+                rga.analyze_replaygain(source, use_cache=False)
+
+        def replaygainEbur128(iteration):
+            engine, rga.ANALYZER = rga.ANALYZER, "ffmpeg"
+            try:
+                replaygain(iteration)
+            finally:
+                rga.ANALYZER = engine
+
+        covers = []
+        for source, _ in files:
+            tag_type, audio = ts.loadMutagen(source)
+            cover = main.artworkExtractor(tag_type, audio)
+            if cover:
+                covers.append(cover)
+
+        def artwork(iteration):
+            for cover in covers:
+                art.convertArtworkBytes(cover)
+
+        def tagging(iteration):
+            for (source, _), output in zip(files, outputs):
+                tag_type, audio = ts.loadMutagen(source)
+                main.modifyMetadata(tag_type, audio, covers[0] if covers else None, output, rg=(0.0, 0.0))
+
+        results["encode"] = measure("encode", encode, len(files), total_audio, args.repeat, args.verbose)
+        results["encode_analyze"] = measure("encode_analyze", encodeAnalyze, len(files), total_audio, args.repeat, args.verbose)
+        if se.frameSamples(settings) and args.jobs > 1:
+            results["encode_segmented"] = measure("encode_segmented", encodeSegmented, len(files), total_audio, args.repeat, args.verbose)
+        results["replaygain"] = measure("replaygain", replaygain, len(files), total_audio, args.repeat, args.verbose)
+        results["replaygain_ebur128"] = measure("replaygain_ebur128", replaygainEbur128, len(files), total_audio, args.repeat, args.verbose)
+        results["artwork"] = measure("artwork", artwork, len(covers), 0, args.repeat, args.verbose)
+        results["tagging"] = measure("tagging", tagging, len(files), total_audio, args.repeat, args.verbose)
+
+    server.stop()
+    mbl.mbCache().close()
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": gitCommit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "ffmpeg": ffmpegVersion(),
+        "jobs": args.jobs,
+        "output_format": args.output_format,
+        "repeat": args.repeat,
+        "corpus": spec,
+        "results": results,
+    }
+
+def gitCommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=pl.Path(__file__).parent).stdout.strip() or None
+    except OSError:
+        return None
+
+def ffmpegVersion():
+    try:
+        return subprocess.run(["ffmpeg", "-version"], capture_output=True, text=True).stdout.splitlines()[0]
+    except (OSError, IndexError):
+        return None
+
+def compareResults(old, new, threshold):
+    # Returns the names of stages whose throughput dropped by more than threshold
+    regressions = []
+    for name, result in new["results"].items():
+        before = old.get("results", {}).get(name)
+        if not isinstance(result, dict) or not isinstance(before, dict):
+            continue
+        if not before.get("seconds") or not result.get("seconds"):
+            continue
+        ratio = before["seconds"] / result["seconds"]
+        flag = ""
+        if ratio < 1 - threshold:
+            flag = "  <-- REGRESSION"
+            regressions.append(name)
+        print(f"BENCHMARK: {name}: {before['seconds']}s -> {result['seconds']}s ({ratio:.2f}x){flag}")
+    return regressions
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description="Batch Audio Converter benchmarks")
+    parser.add_argument("--corpus", default=CORPUS_DIR, help="where the synthetic corpus is generated")
+    parser.add_argument("--work", default=WORK_DIR, help="scratch folder for outputs and caches")
+    parser.add_argument("--formats", nargs="+", default=ac.AUDIO_FORMATS, choices=ac.AUDIO_FORMATS)
+    parser.add_argument("--durations", nargs="+", type=int, default=DURATIONS, help="track lengths in seconds")
+    parser.add_argument("--tracks", type=int, default=2, help="tracks per format and duration")
+    parser.add_argument("--output-format", default="mp3", choices=ac.AUDIO_FORMATS)
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--repeat", type=int, default=1, help="runs per measurement, the fastest is kept")
+    parser.add_argument("--mb-delay", type=float, default=0.02, help="simulated MusicBrainz response time in seconds")
+    parser.add_argument("--mb-rate", type=float, default=50, help="MusicBrainz requests per second allowed against the stand-in")
+    parser.add_argument("--startup", action=argparse.BooleanOptionalAction, default=True, help="time importing main and reaching the menu")
+    parser.add_argument("--mb-batch", type=int, default=None, help="tracks per combined MusicBrainz search (default: mbLookup's)")
+    parser.add_argument("--stages", action=argparse.BooleanOptionalAction, default=True, help="also time each stage on its own")
+    parser.add_argument("--results", default=None, help="JSON file to write (default: benchmarks/bench-<time>.json)")
+    parser.add_argument("--compare", default=None, help="earlier results JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="slowdown that counts as a regression")
+    parser.add_argument("--verbose", action="store_true", help="show the converter's own output")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parseArgs(argv)
+    results_file = pl.Path(args.results or pl.Path(RESULTS_DIR) / f"bench-{time.strftime('%Y%m%d-%H%M%S')}.json").resolve()
+    compare = json.loads(pl.Path(args.compare).read_text()) if args.compare else None
+
+    report = runBenchmarks(args)
+    results_file.parent.mkdir(parents=True, exist_ok=True)
+    results_file.write_text(json.dumps(report, indent=2))
+    print(f"BENCHMARK: Results written to {results_file}")
+
+    if compare and compareResults(compare, report, args.threshold):
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
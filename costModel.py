@@ -0,0 +1,47 @@
+import pathlib as pl
+
+# Rough CPU seconds per second of audio for each stage, measured with ffmpeg on one core.
+# Only the ratios matter: they decide which files start first.
+DECODE_COST = {"wav": 0.001, "flac": 0.0015, "mp3": 0.003, "m4a": 0.0025, "ogg": 0.0025, "opus": 0.0045}
+ENCODE_COST = {"wav": 0.0005, "flac": 0.002, "mp3": 0.016, "m4a": 0.025, "ogg": 0.026, "opus": 0.04}
+LOUDNESS_COST = 0.015
+COPY_COST = 0.0002  # Remux or plain copy
+FIXED_COST = 0.1  # Process start, artwork, tag save; what a file costs regardless of its length
+# Used when mutagen can't read the duration: typical bytes per second of audio
+BYTES_PER_SECOND = {"wav": 176400, "flac": 100000, "mp3": 24000, "m4a": 24000, "ogg": 20000, "opus": 16000}
+
+_durations = {}  # (path, size, mtime) -> seconds, the scheduler, progress monitor and segmenter all ask
+
+def probeDuration(path: pl.Path):
+    # Seconds of audio from the container header, estimated from the file size if that fails
+    path = pl.Path(path)
+    try:
+        stat = path.stat()
+    except OSError:
+        return 0.0
+    key = (str(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _durations:
+        _durations[key] = readDuration(path, stat.st_size)
+    return _durations[key]
+
+def readDuration(path: pl.Path, size):
+    try:
+        import mutagen
+        audio = mutagen.File(str(path))
+        if audio is not None and audio.info.length:
+            return float(audio.info.length)
+    except Exception:
+        pass
+    return size / BYTES_PER_SECOND.get(path.suffix[1:].lower(), 24000)
+
+def estimateCost(path: pl.Path, profiles, measure=True, bypass=False):
+    # Estimated CPU seconds for one source: decode once, one encode per profile, the loudness meter
+    path = pl.Path(path)
+    duration = probeDuration(path)
+    if bypass:
+        return FIXED_COST + duration * COPY_COST
+    cost = duration * DECODE_COST.get(path.suffix[1:].lower(), 0.003)
+    cost += duration * sum(ENCODE_COST.get(profile.output_format, 0.02) for profile in profiles)
+    if measure:
+        cost += duration * LOUDNESS_COST
+    return FIXED_COST + cost
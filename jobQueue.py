@@ -0,0 +1,374 @@
+import json
+import os
+import pathlib as pl
+import socket
+import threading
+import time
+import uuid
+
+import mbLookup as mbl
+import progressMonitor as pm
+
+# Distributed batches: a coordinator publishes one job per source into a folder every node mounts (NFS),
+# workers on any node lease jobs, run the normal per-file pipeline and write back the result. Jobs move
+# between state folders by rename, which is atomic on NFS too, so no file locking is needed:
+#
+#   pending/<priority>-<id>.json  ->  leased/<priority>-<id>~<worker>.json  ->  done/<id>.json
+#
+# A worker renews its leases (touches the files) while it works. A lease not renewed for LEASE_SECONDS
+# is taken back by the coordinator and published again, up to MAX_ATTEMPTS times, then it is failed/.
+# MusicBrainz lookups are files too (lookups/ -> answers/), answered by the coordinator alone so the
+# rate limit holds for the whole cluster. Workers' live progress goes to reports/<worker>.metrics.json.
+
+LEASE_SECONDS = 120.0
+MAX_ATTEMPTS = 3  # Leases a job gets, a source that kills its worker every time isn't retried forever
+POLL_INTERVAL = 0.5  # Seconds between looks at the queue folders
+LOOKUP_POLL = 0.1
+LOOKUP_TIMEOUT = 300.0  # A worker gives up on an answer after this long (coordinator gone)
+LISTING_TTL = 5.0  # A worker re-lists pending/ at most this often while earlier names are still there
+STATES = ["pending", "leased", "done", "failed", "lookups", "answers", "reports"]
+
+def workerName():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+def writeJson(path: pl.Path, data):
+    # Written aside and renamed into place, readers never see half a file
+    temp = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    temp.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+    os.replace(temp, path)
+
+def readJson(path: pl.Path):
+    return json.loads(pl.Path(path).read_text(encoding="utf-8"))
+
+def visible(directory: pl.Path):
+    # Entry names without the temporary files of writes in progress
+    try:
+        return [name for name in os.listdir(directory) if not name.startswith(".")]
+    except FileNotFoundError:
+        return []
+
+def jobId(name):
+    # "<priority>-<id>.json" or "<priority>-<id>~<worker>.json" -> id
+    return name.split(".")[0].split("~")[0].split("-", 1)[1]
+
+def newId():
+    return uuid.uuid4().hex[:16]
+
+def priorityName(cost, job_id):
+    # Names sort longest estimated job first, like batchEngine.CostQueue
+    return f"{max(0, 10 ** 10 - int(cost * 1000)):011d}-{job_id}.json"
+
+class JobQueue:
+    def __init__(self, root):
+        self.root = pl.Path(root)
+        for state in STATES:
+            (self.root / state).mkdir(parents=True, exist_ok=True)
+        self.listing = []
+        self.listed = 0.0
+
+    # Coordinator side
+
+    def reset(self, config):
+        # A new batch: whatever an earlier coordinator left behind is dropped
+        for state in STATES:
+            for name in os.listdir(self.root / state):
+                try:
+                    os.remove(self.root / state / name)
+                except OSError:
+                    pass
+        try:
+            os.remove(self.root / "stop")
+        except FileNotFoundError:
+            pass
+        config = {**config, "batch": uuid.uuid4().hex}
+        writeJson(self.root / "config.json", config)
+        return config
+
+    def publish(self, job, cost):
+        # job["id"] from newId(), known to the caller before a worker can finish it
+        writeJson(self.root / "pending" / priorityName(cost, job["id"]), {**job, "cost": cost, "attempts": 0})
+
+    def now(self):
+        # The file server's clock, lease times are compared with what it stamped on the files
+        clock = self.root / "clock"
+        clock.touch()
+        return clock.stat().st_mtime
+
+    def expire(self, lease_seconds):
+        # Leases that weren't renewed go back to pending/, or to failed/ after MAX_ATTEMPTS; returns those jobs
+        expired = []
+        now = self.now()
+        for name in visible(self.root / "leased"):
+            path = self.root / "leased" / name
+            try:
+                if now - path.stat().st_ctime < lease_seconds:
+                    continue
+                # Claimed by rename first, a late renewal by the worker then fails instead of racing us
+                taken = self.root / "pending" / f".expired-{name}"
+                os.rename(path, taken)
+            except FileNotFoundError:
+                continue
+            job = readJson(taken)
+            job["attempts"] += 1
+            job.setdefault("workers", []).append(name.split("~", 1)[1][:-5])
+            if job["attempts"] >= MAX_ATTEMPTS:
+                writeJson(self.root / "failed" / f"{job['id']}.json", job)
+            else:
+                writeJson(self.root / "pending" / priorityName(job["cost"], job["id"]), job)
+            os.remove(taken)
+            expired.append(job)
+        return expired
+
+    def withdraw(self, job_id):
+        # A job that finished after its lease was taken back isn't run again
+        for name in visible(self.root / "pending"):
+            if jobId(name) == job_id:
+                try:
+                    os.remove(self.root / "pending" / name)
+                except FileNotFoundError:
+                    pass
+
+    def results(self):
+        # Finished jobs, each one handed out once
+        for name in sorted(visible(self.root / "done")):
+            path = self.root / "done" / name
+            try:
+                result = readJson(path)
+                os.remove(path)
+            except (FileNotFoundError, ValueError):
+                continue
+            yield result
+
+    def counts(self):
+        return {state: len(visible(self.root / state)) for state in ("pending", "leased")}
+
+    def workerMetrics(self):
+        # Each worker's latest progress snapshot (see metricsPath), marked stale once it stopped updating it
+        now = self.now()
+        snapshots = {}
+        for name in visible(self.root / "reports"):
+            if not name.endswith(".metrics.json"):
+                continue
+            path = self.root / "reports" / name
+            try:
+                snapshot = readJson(path)
+                snapshot["stale"] = now - path.stat().st_mtime > pm.STALE_SECONDS
+            except (FileNotFoundError, ValueError):
+                continue
+            snapshots[name[:-len(".metrics.json")]] = snapshot
+        return snapshots
+
+    def stop(self):
+        (self.root / "stop").write_text(self.config()["batch"], encoding="utf-8")
+
+    # Worker side
+
+    def config(self, wait=False):
+        while True:
+            try:
+                return readJson(self.root / "config.json")
+            except (FileNotFoundError, ValueError):
+                if not wait:
+                    return None
+            time.sleep(POLL_INTERVAL)
+
+    def stopped(self, batch):
+        try:
+            return (self.root / "stop").read_text(encoding="utf-8") == batch
+        except FileNotFoundError:
+            return False
+
+    def lease(self, worker):
+        # Takes the first pending job (longest first) or returns None; rename decides between workers
+        for attempt in range(2):
+            if attempt or not self.listing or time.monotonic() - self.listed > LISTING_TTL:
+                self.listing = sorted(visible(self.root / "pending"))
+                self.listed = time.monotonic()
+            while self.listing:
+                name = self.listing.pop(0)
+                leased = self.root / "leased" / f"{name[:-5]}~{worker}.json"
+                try:
+                    os.rename(self.root / "pending" / name, leased)
+                except FileNotFoundError:
+                    continue  # Another worker was faster
+                os.utime(leased)
+                job = readJson(leased)
+                job["lease"] = leased.name
+                return job
+        return None
+
+    def renew(self, job):
+        try:
+            os.utime(self.root / "leased" / job["lease"])
+            return True
+        except FileNotFoundError:
+            return False
+
+    def complete(self, job, result):
+        writeJson(self.root / "done" / f"{job['id']}.json", {**result, "id": job["id"]})
+        try:
+            os.remove(self.root / "leased" / job["lease"])
+        except FileNotFoundError:
+            pass
+
+    def reportPath(self, worker):
+        return self.root / "reports" / f"{worker}.jsonl"
+
+    def metricsPath(self, worker):
+        return self.root / "reports" / f"{worker}.metrics.json"
+
+class JobRecords:
+    # Manifest store of a worker: the records come with the jobs and go back with the results, only the
+    # coordinator writes manifest.sqlite (SQLite locking isn't safe across NFS clients)
+    def __init__(self):
+        self.records = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            return self.records.get(key, default)
+
+    def put(self, key, value):
+        with self.lock:
+            self.records[key] = value
+
+    def pop(self, key):
+        with self.lock:
+            return self.records.pop(key, None)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+class Leases:
+    # The jobs of one worker as (audio path, sidecar) for batchConvert; at most `capacity` are held at once
+    # so an idle node can still get work. Held leases are renewed on a timer until finished() reports them.
+    def __init__(self, job_queue: JobQueue, root: pl.Path, config, capacity, worker=None):
+        self.queue = job_queue
+        self.root = pl.Path(root).resolve()
+        self.config = config
+        self.worker = worker or workerName()
+        self.records = JobRecords()
+        self.slots = threading.Semaphore(max(1, capacity))
+        self.held = {}  # Resolved source path -> job
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.completed = 0
+        threading.Thread(target=self.renewLeases, name="lease-renewal", daemon=True).start()
+
+    def stop(self):
+        self.stopping.set()
+
+    def renewLeases(self):
+        while not self.stopping.wait(self.config["lease_seconds"] / 4):
+            with self.lock:
+                jobs = list(self.held.values())
+            for job in jobs:
+                if not self.queue.renew(job):
+                    print(f"WORKER: Lease on {job['source']} was taken back (renewed too late), its result may be ignored.")
+
+    def __iter__(self):
+        while True:
+            while not self.slots.acquire(timeout=POLL_INTERVAL):
+                if self.stopping.is_set():
+                    return
+            job = None
+            while job is None:
+                if self.stopping.is_set() or self.queue.stopped(self.config["batch"]):
+                    return
+                job = self.queue.lease(self.worker)
+                if job is None:
+                    self.stopping.wait(POLL_INTERVAL)
+            source = self.root / job["source"]
+            with self.lock:
+                self.held[str(source)] = job
+            if job.get("record"):
+                self.records.put(str(source.resolve()), job["record"])
+            yield source, self.root / job["sidecar"] if job.get("sidecar") else None
+
+    def finished(self, result):
+        # batchConvert's per-file callback: the result and the file's manifest record go back to the coordinator
+        source = result.source[0]
+        with self.lock:
+            job = self.held.pop(str(source), None)
+        if job is None:
+            return
+        self.queue.complete(job, {
+            "worker": self.worker,
+            "ok": result.ok,
+            "error": None if result.ok else str(result.error),
+            "log": result.log,
+            "record": self.records.pop(str(pl.Path(source).resolve())),
+        })
+        self.completed += 1
+        self.slots.release()
+
+class QueueProvider:
+    # MusicBrainz provider of a worker: lookups are written to the queue folder and answered by the
+    # coordinator, which holds the cache and the only rate limiter
+    name = "queue"
+
+    def __init__(self, job_queue: JobQueue, batch):
+        self.queue = job_queue
+        self.batch = batch
+
+    def lookupMany(self, pairs):
+        request = uuid.uuid4().hex
+        writeJson(self.queue.root / "lookups" / f"{request}.json", {"pairs": [list(pair) for pair in pairs]})
+        answer = self.queue.root / "answers" / f"{request}.json"
+        deadline = time.monotonic() + LOOKUP_TIMEOUT
+        while True:
+            try:
+                results = readJson(answer)
+                os.remove(answer)
+                return results
+            except (FileNotFoundError, ValueError):
+                pass
+            if time.monotonic() > deadline or self.queue.stopped(self.batch):
+                raise RuntimeError("no MusicBrainz answer from the coordinator")
+            time.sleep(LOOKUP_POLL)
+
+    def lookup(self, artist, title):
+        return self.lookupMany([(artist, title)]).get(mbl.cacheKey(artist, title))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+class LookupServer:
+    # Coordinator side of QueueProvider: requests go through one LookupStage (rate limit, cache, batching)
+    def __init__(self, job_queue: JobQueue, stage: mbl.LookupStage):
+        self.queue = job_queue
+        self.stage = stage
+        self.waiting = {}  # request -> [(key, future)]
+        self.stopping = threading.Event()
+        self.answered = 0
+        self.thread = threading.Thread(target=self.run, name="mb-answers", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopping.wait(LOOKUP_POLL):
+            for name in visible(self.queue.root / "lookups"):
+                path = self.queue.root / "lookups" / name
+                try:
+                    pairs = readJson(path)["pairs"]
+                    os.remove(path)
+                except (FileNotFoundError, ValueError):
+                    continue
+                self.waiting[name] = [(mbl.cacheKey(artist, title), self.stage.submit(artist, title, priority=self.stage.URGENT))
+                                      for artist, title in pairs]
+            for name, futures in list(self.waiting.items()):
+                if all(future.done() for _, future in futures):
+                    # A failed search answers None, the worker tags without MusicBrainz data like it would alone
+                    writeJson(self.queue.root / "answers" / name,
+                              {key: None if future.exception() else future.result() for key, future in futures})
+                    del self.waiting[name]
+                    self.answered += 1
+
+    def close(self):
+        self.stopping.set()
+        self.thread.join()
@@ -0,0 +1,45 @@
+import os
+import pathlib as pl
+
+def scanLibrary(directory, audio_formats, artwork_ext, recursive=True, exclude=()):
+    # Single os.scandir pass per folder: yields (audio_path, sidecar_artwork_path or None) as soon as a
+    # folder is read, so processing can start before the walk ends. Only one folder is held in memory
+    # at a time. Extensions match case-insensitively; sidecar preference follows artwork_ext order.
+    audio_formats = {ext.lower() for ext in audio_formats}
+    artwork_rank = {ext.lower(): i for i, ext in enumerate(artwork_ext)}
+    exclude = {os.path.normcase(str(pl.Path(p).resolve())) for p in exclude}
+
+    stack = [str(pl.Path(directory).resolve())]
+    while stack:
+        current = stack.pop()
+        audio = []
+        images = {}
+        subdirs = []
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if recursive and not entry.name.startswith(".") and os.path.normcase(entry.path) not in exclude:
+                                subdirs.append(entry.path)
+                            continue
+                        if not entry.is_file():
+                            continue
+                    except OSError:
+                        continue
+                    stem, ext = os.path.splitext(entry.name)
+                    ext = ext[1:].lower()
+                    if ext in audio_formats:
+                        audio.append((stem, entry.path))
+                    elif ext in artwork_rank:
+                        best = images.get(stem)
+                        if best is None or artwork_rank[ext] < best[0]:
+                            images[stem] = (artwork_rank[ext], entry.path)
+        except OSError as e:
+            print(f"LIBRARY SCANNER: Cannot read {current}: {e}")
+            continue
+
+        for stem, path in sorted(audio):
+            sidecar = images.get(stem)
+            yield pl.Path(path), pl.Path(sidecar[1]) if sidecar else None
+        stack.extend(sorted(subdirs, reverse=True))
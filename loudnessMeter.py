@@ -0,0 +1,281 @@
+import math
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import progressMonitor as pm
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional, replayGainAnalyzer falls back to ffmpeg's ebur128
+    np = None
+
+# ITU-R BS.1770 / EBU R128, the same numbers ffmpeg's ebur128 filter prints
+SUB_BLOCK = 0.1  # Momentary blocks are 400 ms windows moved in 100 ms steps
+BLOCK_SUB_BLOCKS = 4
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = 10.0
+K_WEIGHTING_SECONDS = 0.15  # Length of the FIR version of the K filter, its tail is < -160 dB by then
+TRUE_PEAK_RATE = 192000  # 4x at 48 kHz like ebur128; the top of the 4x grid is refined, see truePeak
+TRUE_PEAK_TAPS = 32  # Interpolation taps per phase
+TRUE_PEAK_REFINE = 0.985  # Oversampled samples this close to the highest one (0.13 dB) get their peak refined
+CHUNK_SECONDS = 10
+# Surround channels count 1.41x, LFE not at all (FL FR FC LFE BL BR)
+CHANNEL_WEIGHTS = {5: [1.0, 1.0, 1.0, 1.41, 1.41], 6: [1.0, 1.0, 1.0, 0.0, 1.41, 1.41]}
+
+_filters = {}
+_spectra = {}
+_filters_lock = threading.Lock()
+
+def kWeightingCoefficients(rate):
+    # Pre-filter (high shelf) and RLB high-pass biquads for any sample rate
+    f0, gain, q = 1681.974450955533, 3.999843853973347, 0.7071752369554196
+    k = math.tan(math.pi * f0 / rate)
+    vh = 10 ** (gain / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = ([(vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0],
+             [1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0])
+    f0, q = 38.13547087602444, 0.5003270373238773
+    k = math.tan(math.pi * f0 / rate)
+    a0 = 1 + k / q + k * k
+    highpass = ([1.0, -2.0, 1.0], [1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0])
+    return shelf, highpass
+
+def biquadImpulse(b, a, x):
+    y = [0.0] * len(x)
+    x1 = x2 = y1 = y2 = 0.0
+    for n, x0 in enumerate(x):
+        y0 = b[0] * x0 + b[1] * x1 + b[2] * x2 - a[1] * y1 - a[2] * y2
+        x2, x1, y2, y1 = x1, x0, y1, y0
+        y[n] = y0
+    return y
+
+def filtersFor(rate):
+    # (K-weighting FIR, true peak polyphase bank), built once per sample rate
+    with _filters_lock:
+        if rate not in _filters:
+            taps = int(rate * K_WEIGHTING_SECONDS)
+            shelf, highpass = kWeightingCoefficients(rate)
+            impulse = [1.0] + [0.0] * (taps - 1)
+            k_fir = np.array(biquadImpulse(*highpass, biquadImpulse(*shelf, impulse)))
+
+            factor = max(1, round(TRUE_PEAK_RATE / rate))
+            phases = None
+            if factor > 1:
+                n = np.arange(TRUE_PEAK_TAPS * factor) - (TRUE_PEAK_TAPS * factor - 1) / 2
+                sinc = np.sinc(n / factor) * np.kaiser(len(n), 8.0)
+                # One column per phase, reversed so a window @ phases is the interpolated value
+                phases = np.stack([(sinc[p::factor] / sinc[p::factor].sum())[::-1] for p in range(factor)], axis=1).astype(np.float32)
+            _filters[rate] = (k_fir, phases)
+        return _filters[rate]
+
+def fftSize(n):
+    # Smallest 2^a 3^b 5^c >= n, the FFT is as fast there as at a power of two that can be twice as long
+    best = 1 << (n - 1).bit_length()
+    five = 1
+    while five < best:
+        three = five
+        while three < best:
+            size = three << max(0, (n - 1) // three).bit_length()
+            best = min(best, size)
+            three *= 3
+        five *= 5
+    return best
+
+def fftConvolve(x, h):
+    n = len(x) + len(h) - 1
+    size = fftSize(n)
+    key = (id(h), size)
+    spectrum = _spectra.get(key)
+    if spectrum is None:
+        # The K filter is the same for every chunk of a rate, its spectrum is worked out once
+        spectrum = _spectra.setdefault(key, np.fft.rfft(h, size))
+    return np.fft.irfft(np.fft.rfft(x, size) * spectrum, size)[:n]
+
+def truePeak(x, phases, sample_peak):
+    # Interpolated samples can only beat sample_peak where some input within reach is above
+    # sample_peak / gain (gain = the largest sum of |taps| of a phase), so only those windows are upsampled
+    taps, factor = phases.shape
+    if len(x) < taps:
+        return 0.0
+    gain = np.abs(phases).sum(axis=0).max()
+    big = np.concatenate([[0], np.cumsum(np.abs(x) * gain >= sample_peak)])
+    candidates = np.nonzero(big[taps:] - big[:-taps])[0]
+    if not len(candidates):
+        return 0.0
+    upsampled = np.abs(np.lib.stride_tricks.sliding_window_view(x.astype(np.float32), taps)[candidates] @ phases)
+    # Column by column, a max along the short axis is several times slower
+    highest = upsampled[:, 0].copy()
+    for p in range(1, factor):
+        np.maximum(highest, upsampled[:, p], out=highest)
+    peak = highest.max()
+
+    # The 4x grid can straddle the real top (up to ~0.1 dB low near Nyquist): a parabola through the highest
+    # grid point of each lobe close to the peak and its neighbours on the grid finds the top between them.
+    # Rows are windows one sample apart, so the grid runs on from the end of one row into the next.
+    inner = np.nonzero((candidates[1:-1] - candidates[:-2] == 1) & (candidates[2:] - candidates[1:-1] == 1))[0] + 1
+    lobes = inner[(highest[inner] >= peak * TRUE_PEAK_REFINE) &
+                  (highest[inner] >= highest[inner - 1]) & (highest[inner] >= highest[inner + 1])]
+    if not len(lobes):
+        return float(peak)
+    grid = upsampled.reshape(-1)
+    index = lobes * factor + upsampled[lobes].argmax(axis=1)
+    before, top, after = grid[index - 1], grid[index], grid[index + 1]
+    curve = np.where((top >= before) & (top >= after), before - 2 * top + after, 0.0)
+    refined = top - (after - before) ** 2 / (8 * np.where(curve < 0, curve, -np.inf))
+    return float(max(peak, refined.max()))
+
+def analyzeChunk(chunk, history, rate, weights):
+    # chunk: (samples, channels) float array, a whole number of sub-blocks long; history: the samples before it.
+    # Returns (energy per 100 ms sub-block, true peak of the chunk)
+    k_fir, phases = filtersFor(rate)
+    sub = int(round(rate * SUB_BLOCK))
+    energy = np.zeros(len(chunk) // sub)
+    peak = 0.0
+    for c in range(chunk.shape[1]):
+        x = np.concatenate([history[:, c], chunk[:, c]])
+        start = len(history)
+        if weights[c]:
+            y = fftConvolve(x[-(len(chunk) + len(k_fir) - 1):], k_fir)[len(k_fir) - 1:len(k_fir) - 1 + len(chunk)]
+            squares = (y[:len(energy) * sub] ** 2).reshape(len(energy), sub)
+            energy += weights[c] * squares.mean(axis=1)
+        channel_peak = np.abs(chunk[:, c]).max(initial=0.0)
+        if phases is not None and channel_peak > 0:
+            channel_peak = max(channel_peak, truePeak(x[max(0, start - len(phases) + 1):], phases, channel_peak))
+        peak = max(peak, float(channel_peak))
+    return energy, peak
+
+class LoudnessMeter:
+    # Streams interleaved float32 PCM through K-weighting and 100 ms energy sums. Full chunks are handed to a
+    # thread pool as they arrive (each one carries the filter history it needs), so long files use every core.
+    def __init__(self, rate, channels, jobs=None, lead=0):
+        # lead: samples at the start that only fill the filter history (the audio before a segment)
+        if np is None:
+            raise RuntimeError("NumPy is not installed")
+        self.rate = int(rate)
+        self.channels = int(channels)
+        self.weights = CHANNEL_WEIGHTS.get(self.channels, [1.0] * self.channels)
+        self.sub = int(round(self.rate * SUB_BLOCK))
+        self.chunk = self.sub * int(CHUNK_SECONDS / SUB_BLOCK)
+        k_fir, _ = filtersFor(self.rate)
+        self.history_length = len(k_fir) - 1
+        self.history = np.zeros((self.history_length, self.channels))
+        self.pending = []
+        self.pending_samples = 0
+        self.leftover = b""
+        self.futures = []
+        self.lead = int(lead)
+        self.pool = ThreadPoolExecutor(max_workers=jobs or 1) if (jobs or 1) > 1 else None
+
+    def feedBytes(self, data: bytes):
+        data = self.leftover + data
+        frame = 4 * self.channels
+        usable = len(data) - len(data) % frame
+        self.leftover = data[usable:]
+        if usable:
+            self.feed(np.frombuffer(data[:usable], dtype="<f4").reshape(-1, self.channels))
+
+    def feed(self, samples):
+        samples = np.asarray(samples, dtype=np.float64).reshape(-1, self.channels)
+        if self.lead:
+            lead = samples[:self.lead]
+            self.history = np.concatenate([self.history, lead])[-self.history_length:]
+            self.lead -= len(lead)
+            samples = samples[len(lead):]
+        self.pending.append(samples)
+        self.pending_samples += len(samples)
+        if self.pending_samples >= self.chunk:
+            buffered = np.concatenate(self.pending)
+            cut = len(buffered) - len(buffered) % self.chunk
+            for start in range(0, cut, self.chunk):
+                self.submit(buffered[start:start + self.chunk])
+            self.pending = [buffered[cut:]]
+            self.pending_samples = len(buffered) - cut
+
+    def submit(self, chunk):
+        history = self.history
+        self.history = np.concatenate([history, chunk])[-self.history_length:]
+        if self.pool:
+            self.futures.append(self.pool.submit(analyzeChunk, chunk, history, self.rate, self.weights))
+        else:
+            self.futures.append(analyzeChunk(chunk, history, self.rate, self.weights))
+
+    def measured(self):
+        # (energy per 100 ms sub-block, peak) of everything fed, see integrate()
+        if self.pending_samples:
+            rest = np.concatenate(self.pending)
+            self.pending, self.pending_samples = [], 0
+            self.submit(rest)
+        parts = [f.result() if hasattr(f, "result") else f for f in self.futures]
+        if self.pool:
+            self.pool.shutdown()
+        energy = np.concatenate([part[0] for part in parts]) if parts else np.zeros(0)
+        return energy, max((part[1] for part in parts), default=0.0)
+
+    def result(self):
+        # Returns (integrated LUFS, true peak dBFS, block histogram) with ffmpeg's 0.1 rounding
+        return integrate([self.measured()])
+
+def integrate(measurements):
+    # Gates the measured() results of consecutive pieces of one signal as a whole. Pieces that are a whole
+    # number of sub-blocks long and were fed the audio before them as lead join without a seam.
+    energy = np.concatenate([m[0] for m in measurements]) if measurements else np.zeros(0)
+    peak = max((m[1] for m in measurements), default=0.0)
+    if len(energy) >= BLOCK_SUB_BLOCKS:
+        kernel = np.ones(BLOCK_SUB_BLOCKS) / BLOCK_SUB_BLOCKS
+        blocks = np.convolve(energy, kernel, mode="valid")
+    else:
+        blocks = np.zeros(0)
+    with np.errstate(divide="ignore"):
+        momentary = -0.691 + 10 * np.log10(blocks)
+    gated = blocks[momentary >= ABSOLUTE_GATE]
+    integrated = ABSOLUTE_GATE
+    if len(gated):
+        threshold = -0.691 + 10 * math.log10(gated.mean()) - RELATIVE_GATE
+        gated = gated[-0.691 + 10 * np.log10(gated) >= threshold]
+        integrated = -0.691 + 10 * math.log10(gated.mean())
+
+    histogram = {}
+    for value in np.round(momentary[momentary >= ABSOLUTE_GATE] * 10).astype(int):
+        histogram[str(value)] = histogram.get(str(value), 0) + 1
+    peak_db = 20 * math.log10(peak) if peak > 0 else -math.inf
+    return round(integrated, 1), round(peak_db, 1), histogram
+
+def streamInfo(file_path):
+    # (sample rate, channels) of the audio, read from the container by mutagen
+    import mutagen
+    audio = mutagen.File(str(file_path))
+    if audio is None:
+        return None
+    # Opus always decodes at 48 kHz, whatever the input was
+    rate = getattr(audio.info, "sample_rate", None) or (48000 if type(audio.info).__name__ == "OggOpusInfo" else None)
+    if not rate:
+        return None
+    return rate, audio.info.channels
+
+def analyzeFile(file_path, jobs=None):
+    # ffmpeg only decodes to raw PCM, the measurement happens here. Returns the meter result or None.
+    info = streamInfo(file_path)
+    if not info:
+        return None
+    rate, channels = info
+    meter = LoudnessMeter(rate, channels, jobs=jobs)
+    with pm.task("loudness", file_path, counted=False) as task:
+        # The decode is held to the rate and channels the meter was built for, ffmpeg can see the stream
+        # differently from the container (HE-AAC's SBR rate and parametric stereo)
+        process = subprocess.Popen(
+            ["ffmpeg", "-hide_banner", "-nostats", "-v", "error", *pm.progressArgs(), "-i", str(file_path), "-map", "0:a:0",
+             "-ar", str(rate), "-ac", str(channels), "-f", "f32le", "-acodec", "pcm_f32le", "-"],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        stderr = measureProcess(process, meter, task)
+    if process.returncode != 0:
+        print(f"LOUDNESS METER: Could not decode {file_path}: {stderr.decode(errors='ignore').strip()}")
+        return None
+    return meter.result()
+
+def measureProcess(process, meter, task=None, size=1 << 20):
+    # Feeds the process' stdout to the meter until it exits, stderr is drained alongside so it can't block
+    # (its progress blocks go to task). Returns stderr.
+    return pm.communicate(process, task, output=meter.feedBytes, size=size)[1]
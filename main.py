@@ -1,28 +1,35 @@
-import time
 import audioConverter as ac
 import artworkConverter as art
 import replayGainAnalyzer as rga
+import batchEngine as be
+import mbLookup as mbl
+import manifest as mf
+import artworkCache as awc
+import libraryScanner as ls
+import runReport as rr
+import costModel as cm
+import watchFolder as wf
+import segmentEncoder as se
+import jobQueue as jq
+import progressMonitor as pm
+
+import tagSession as ts
+from tagSession import loadMutagen
 
 import pathlib as pl
-from mutagen.id3 import ID3, APIC, TIT2, TPE1, TALB, TYER, TCON, TXXX, ID3NoHeaderError
-from mutagen.flac import FLAC, Picture
-from mutagen.oggvorbis import OggVorbis
-from mutagen.oggopus import OggOpus
-from mutagen.mp4 import MP4, MP4Cover
-import musicbrainzngs as mb
 
+import argparse
 import base64
-import json
 import os
+import shutil
+import signal
 import sys
+import tempfile
+import threading
+import time
 import traceback
 
 ARTWORK_EXT = ["png", "jpg", "jpeg"]
-mb.set_useragent(
-    "Col's Tags Getter",
-    "1.2",
-    "coltagsgetterman@hotmail.com"
-)
 
 def handle_exception(exc_type, exc_value, exc_traceback):
     print("UNCAUGHT EXCEPTION:")
@@ -36,22 +43,322 @@ def get_ffmpeg_path():
         return os.path.join(sys._MEIPASS, "ffmpeg.exe")
     return "ffmpeg"
 
-MB_CACHE_FILE = "mb_cache.json"
-MB_REQ_DELAY = 1.5
-_last_req_time = 0
-def load_mb_cache():
-    if pl.Path(MB_CACHE_FILE).exists():
-        return json.loads(pl.Path(MB_CACHE_FILE).read_text(encoding="utf-8"))
-    return {}
-
-def save_mb_cache(cache):
-    pl.Path(MB_CACHE_FILE).write_text(
-        json.dumps(cache, indent=2, ensure_ascii=False),
-        encoding="utf-8"
-    )
-_mb_cache = load_mb_cache()
+_fs_lock = threading.Lock()
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description="Batch Audio Converter")
+    parser.add_argument("--jobs", type=int, default=be.defaultJobs(),
+                        help="number of files processed in parallel (default: CPU count)")
+    parser.add_argument("--io-jobs", type=int, default=be.IO_JOBS,
+                        help="files that can be in I/O stages (MusicBrainz, tag writes, copies) alongside the --jobs encoders")
+    parser.add_argument("--schedule", action=argparse.BooleanOptionalAction, default=True,
+                        help="probe durations as files are found and start the longest jobs first (--no-schedule keeps scan order)")
+    parser.add_argument("--mb-cache-ttl", type=float, default=None,
+                        help="drop MusicBrainz cache entries older than this many days")
+    parser.add_argument("--mb-cache-max", type=int, default=None,
+                        help="keep at most this many MusicBrainz cache entries (least recently used are evicted)")
+    parser.add_argument("--mb-server", default=None,
+                        help="MusicBrainz host[:port] to query over plain HTTP, e.g. a local mbStandIn server")
+    parser.add_argument("--mb-offline", metavar="DB", default=None,
+                        help="answer MusicBrainz lookups from a local store imported with mbOffline.py instead of the web service")
+    parser.add_argument("--mb-batch", type=int, default=None,
+                        help="tracks resolved per combined MusicBrainz search (1 searches every track on its own)")
+    parser.add_argument("--manifest", action=argparse.BooleanOptionalAction, default=True,
+                        help="remember finished work per source and settings so reruns only redo what changed")
+    parser.add_argument("--save-artwork", action=argparse.BooleanOptionalAction, default=True,
+                        help="also write the (converted) covers to the Artwork folder")
+    parser.add_argument("--artwork-cache-mb", type=int, default=awc.ARTWORK_CACHE_MAX_BYTES // (1024 * 1024),
+                        help="size limit of the converted artwork cache, 0 disables it")
+    parser.add_argument("--stream-copy", action=argparse.BooleanOptionalAction, default=True,
+                        help="remux instead of re-encoding sources that already match the output settings (needs ffprobe)")
+    parser.add_argument("--recursive", action=argparse.BooleanOptionalAction, default=True,
+                        help="also convert audio files in subfolders")
+    parser.add_argument("--profile", action="append", default=None, metavar="FORMAT[:BITRATE[:RATE[:CHANNELS]]]",
+                        help="write this output profile, repeat for several formats from a single decode (e.g. --profile flac --profile mp3:320k)")
+    parser.add_argument("--report", default=rr.RUN_REPORT_FILE, metavar="FILE",
+                        help="write per-stage timings and counters as JSON lines (default: run_report.jsonl)")
+    parser.add_argument("--no-report", dest="report", action="store_const", const=None,
+                        help="don't time the stages")
+    parser.add_argument("--cprofile", default=None, metavar="FILE_NAME",
+                        help="run cProfile on the source with this file name (or \"first\") and save <name>.prof")
+    parser.add_argument("--loudness-cache-max", type=int, default=None,
+                        help="keep at most this many loudness results (keyed by audio content), 0 disables the cache")
+    parser.add_argument("--loudness-engine", choices=["numpy", "ffmpeg"], default=None,
+                        help="measure loudness with ffmpeg's ebur128 filter (default) or in-process with NumPy "
+                             "(segmented encodes use NumPy whenever it is installed)")
+    parser.add_argument("--loudness-threads", type=int, default=None,
+                        help="threads the NumPy meter uses per file (helps long files when --jobs is low)")
+    parser.add_argument("--album-gain", action=argparse.BooleanOptionalAction, default=True,
+                        help="also write album ReplayGain, computed from the tracks' loudness data after the batch")
+    parser.add_argument("--single-pass", action=argparse.BooleanOptionalAction, default=True,
+                        help="measure ReplayGain loudness during conversion instead of decoding the output again")
+    parser.add_argument("--segment-jobs", type=int, default=0, metavar="N",
+                        help="encode files longer than --segment-minutes as N segments at once and join them gaplessly "
+                             "(mp3, opus, flac and wav output; mp3 segments are encoded without the bit reservoir, "
+                             "which costs some quality at the same bitrate)")
+    parser.add_argument("--segment-minutes", type=float, default=se.SEGMENT_MIN_SECONDS / 60,
+                        help="length from which --segment-jobs splits a file")
+    parser.add_argument("--watch", nargs="+", default=None, metavar="DIR",
+                        help="run headless: watch these folders and process every audio file once it has finished copying "
+                             "(settings from --profile, default mp3:192k; stop with Ctrl+C)")
+    parser.add_argument("--watch-settle", type=float, default=wf.SETTLE_SECONDS, metavar="SECONDS",
+                        help="how long a watched file must stay unchanged before it is processed")
+    parser.add_argument("--watch-poll", action="store_true",
+                        help="poll the watched folders instead of using inotify (network mounts don't report remote writes)")
+    parser.add_argument("--watch-existing", action=argparse.BooleanOptionalAction, default=True,
+                        help="also process files already in the watched folders when the daemon starts")
+    parser.add_argument("--coordinate", default=None, metavar="QUEUE_DIR",
+                        help="run headless as the coordinator of a distributed batch: publish this folder's files as jobs in "
+                             "QUEUE_DIR (on a filesystem every node mounts), answer the workers' MusicBrainz lookups and "
+                             "collect the results (settings from --profile, default mp3:192k)")
+    parser.add_argument("--work", default=None, metavar="QUEUE_DIR",
+                        help="run as a worker of a distributed batch: lease jobs from QUEUE_DIR and process them with --jobs, "
+                             "started in the same library folder as the coordinator (its mount point may differ)")
+    parser.add_argument("--lease-seconds", type=float, default=jq.LEASE_SECONDS,
+                        help="coordinator: a job whose worker stopped renewing its lease for this long is run again elsewhere")
+    parser.add_argument("--progress-interval", type=float, default=pm.PROGRESS_INTERVAL, metavar="SECONDS",
+                        help="print what every worker is on (position, speed), the throughput and an ETA this often, 0 to turn it off")
+    parser.add_argument("--metrics", default=None, metavar="FILE",
+                        help="keep the live progress in FILE for monitoring, as JSON or in the Prometheus text format for a .prom file "
+                             "(workers of a distributed batch report to the coordinator through the queue folder instead)")
+    parser.add_argument("--metrics-port", default=None, metavar="[HOST:]PORT",
+                        help=f"serve the live progress over HTTP, /metrics for Prometheus and /metrics.json (host defaults to {pm.METRICS_HOST})")
+    return parser.parse_args(argv)
+
+def watchFolders(args):
+    # Daemon mode: one long batch fed by the watcher, so caches, the manifest and the MusicBrainz
+    # rate limiter stay warm between files
+    roots = [pl.Path(root).resolve() for root in args.watch]
+    missing = [str(root) for root in roots if not root.is_dir()]
+    if missing:
+        print(f"WATCHER: Not a folder: {', '.join(missing)}")
+        return
+    specs = args.profile or ["mp3:192k"]
+    settings = [ac.parseProfile(spec) for spec in specs]
+    if len(settings) == 1:
+        settings = settings[0]
+    # Output/ mirrors the folders below the watched ones' common parent
+    directory = pl.Path(os.path.commonpath([str(root) for root in roots]))
+    watcher = wf.FolderWatcher(roots, ac.AUDIO_FORMATS, ARTWORK_EXT, exclude=["Output", "Artwork", awc.ARTWORK_CACHE_DIR],
+                               settle=args.watch_settle, poll=args.watch_poll, recursive=args.recursive,
+                               existing=args.watch_existing)
+
+    def stop(signum, frame):
+        print("WATCHER: Stopping, files already started are finished first (again to force quit).")
+        watcher.stop()
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGINT, stop)
+    if hasattr(signal, "SIGTERM"):
+        signal.signal(signal.SIGTERM, stop)
+
+    print(f"WATCHER: Writing {', '.join(specs)} to Output/.")
+    batchConvert(directory, settings, convert_artwork=True, file_renaming=True, modify_metadata=True, bypass_conversion=False,
+                 artwork_only=False, jobs=args.jobs, single_pass=args.single_pass, use_manifest=args.manifest,
+                 save_artwork=args.save_artwork, artwork_cache_mb=args.artwork_cache_mb, stream_copy=args.stream_copy,
+                 recursive=args.recursive, report=args.report, cprofile=args.cprofile, album_gain=False,
+                 io_jobs=args.io_jobs, schedule=args.schedule, segment_jobs=args.segment_jobs, sources=watcher.start(),
+                 progress_interval=args.progress_interval, metrics=args.metrics, metrics_port=args.metrics_port)
+    print("WATCHER: Stopped.")
+
+def coordinateQueue(args):
+    # Distributed batch, coordinator side: scans the library, publishes a job per source (longest first),
+    # answers every worker's MusicBrainz lookups through one rate-limited stage, takes back leases of workers
+    # that died, keeps the manifest and writes album gain once everything is in
+    directory = pl.Path(".").resolve()
+    specs = args.profile or ["mp3:192k"]
+    profiles = [ac.parseProfile(spec) for spec in specs]
+    multi = len(profiles) > 1
+    job_queue = jq.JobQueue(args.coordinate)
+    job_queue.reset({"profiles": specs, "single_pass": args.single_pass, "stream_copy": args.stream_copy,
+                     "save_artwork": args.save_artwork, "lease_seconds": args.lease_seconds})
+    if args.report:
+        rr.start(args.report)
+    # Queue depth comes from the queue folder, positions and throughput from the workers' metrics files
+    pm.start(args.progress_interval, args.metrics, args.metrics_port, queue=job_queue.counts, remote=job_queue.workerMetrics)
+    manifest = mf.Manifest() if args.manifest else None
+    tagging_stages = [(stageName("tagging", profile.profileName() if multi else None),
+                       stageFingerprints(profile, True, True, True, False, False)["tagging"]) for profile in profiles]
+    loudness_fingerprint = loudnessFingerprint(profiles, False)
+    albums = {} if args.album_gain else None
+    mb_stage = mbl.LookupStage()
+    lookups = jq.LookupServer(job_queue, mb_stage)
+
+    def recordedTracks(record):
+        # (output, loudness result) of a source's finished outputs, from its manifest record
+        entry = mf.SourceEntry(manifest, None, record)
+        rg = entry.result("loudness", loudness_fingerprint)
+        outputs = [entry.outputFor(profile.profileName() if multi else None) for profile in profiles]
+        return [(output, rg) for output in outputs if output]
+
+    def collectAlbum(tracks):
+        for output_file, rg in tracks:
+            if not (rg and len(rg) > 2 and rg[2]) and output_file.suffix.lower() != ".wav" and output_file.exists():
+                rg = rga.analyze_replaygain(output_file)
+            collectAlbumTrack(albums, output_file, rg)
+
+    published = {}  # Job id -> source, until its result is in
+    counts = {"published": 0, "unchanged": 0}
+    claimed_outputs = {}
+    def publish():
+        for audio_file, sidecar in ls.scanLibrary(directory, ac.AUDIO_FORMATS, ARTWORK_EXT, recursive=args.recursive,
+                                                  exclude=["Output", "Artwork", awc.ARTWORK_CACHE_DIR, args.coordinate]):
+            relative = audio_file.relative_to(directory)
+            outputs = [pl.Path("Output") / (profile.profileName() if multi else "") / relative.parent / f"{audio_file.stem}.{profile.output_format}"
+                       for profile in profiles]
+            # Workers can't see each other's claims, same-named sources are sorted out here
+            if not all([claimOutput(claimed_outputs, output, audio_file) for output in outputs]):
+                print(f"COORDINATOR: Skipping {audio_file.name} (another source in this batch writes {outputs[0].name}).")
+                continue
+            record = manifest.store.get(str(audio_file.resolve())) if manifest else None
+            if record and all(manifest.isComplete(audio_file, stage, fingerprint) for stage, fingerprint in tagging_stages):
+                tracks = recordedTracks(record)
+                if len(tracks) == len(profiles) and all(output.exists() for output, _ in tracks):
+                    counts["unchanged"] += 1
+                    rr.count("skipped_file")
+                    if albums is not None:
+                        collectAlbum(tracks)
+                    continue
+            job = {"id": jq.newId(), "source": relative.as_posix(),
+                   "sidecar": sidecar.relative_to(directory).as_posix() if sidecar else None, "record": record}
+            published[job["id"]] = audio_file
+            pm.queued(audio_file)
+            job_queue.publish(job, cm.estimateCost(audio_file, profiles))
+            counts["published"] += 1
+            # Lookups start while the workers are still encoding
+            try:
+                key = readLookupKey(audio_file)
+            except Exception:
+                key = None
+            if key:
+                mb_stage.submit(*key)
+
+    publisher = threading.Thread(target=publish, name="job-publisher", daemon=True)
+    print(f"COORDINATOR: Publishing {', '.join(specs)} jobs in {args.coordinate}, start workers with --work {args.coordinate}")
+    publisher.start()
+    workers = set()
+    failed = []
+    retried = 0
+    done = 0
+    try:
+        while publisher.is_alive() or published:
+            for result in job_queue.results():
+                audio_file = published.pop(result["id"], None)
+                if audio_file is None:
+                    continue  # Finished twice after a lease was taken back, the first result counts
+                job_queue.withdraw(result["id"])
+                pm.finished(audio_file, result["ok"])
+                done += 1
+                workers.add(result["worker"])
+                print(result["log"], end="")
+                if manifest and result["record"]:
+                    manifest.store.put(str(audio_file.resolve()), result["record"])
+                if not result["ok"]:
+                    failed.append((audio_file, result["error"]))
+                    rr.count("failed")
+                    print(f"AUDIO CONVERTER: {audio_file.name} failed on {result['worker']}: {result['error']}")
+                elif albums is not None and result["record"]:
+                    collectAlbum(recordedTracks(result["record"]))
+                total = f"{counts['published']}" if not publisher.is_alive() else f"{counts['published']} published so far"
+                print(f"--- Progress: {done} / {total}: {audio_file.name} ({result['worker']}){pm.etaText()}")
+            for job in job_queue.expire(args.lease_seconds):
+                retried += 1
+                rr.count("lease_expired")
+                if job["attempts"] >= jq.MAX_ATTEMPTS:
+                    audio_file = published.pop(job["id"], None)
+                    pm.finished(audio_file, False)
+                    failed.append((audio_file, f"workers stopped responding {job['attempts']} times ({', '.join(job['workers'])})"))
+                    rr.count("failed")
+                    print(f"COORDINATOR: Giving up on {job['source']}, its workers stopped responding {job['attempts']} times.")
+                else:
+                    print(f"COORDINATOR: Lease on {job['source']} by {job['workers'][-1]} expired, published again.")
+            time.sleep(jq.POLL_INTERVAL)
+    except KeyboardInterrupt:
+        print("COORDINATOR: Interrupted, workers stop after the files they have started.")
+    finally:
+        job_queue.stop()
+        lookups.close()
+        mb_stage.close()
+        pm.finish()
+
+    if albums:
+        with rr.stage("album_gain"):
+            applyAlbumGain(albums)
+    print(f"COORDINATOR: {done} files from {len(workers)} workers, {counts['unchanged']} unchanged since the last run, "
+          f"{retried} leases taken back, {lookups.answered} MusicBrainz requests answered.")
+    if failed:
+        print(f"AUDIO CONVERTER: {len(failed)} files failed:")
+        for audio_file, error in failed:
+            print(f"    {audio_file.name if audio_file else '?'}: {error}")
+    rga.flushCache()
+    if manifest:
+        manifest.close()
+    rr.count("files", done)
+    if rr.finish() and args.report:
+        print(f"RUN REPORT: Timings written to {args.report}")
+
+def workQueue(args):
+    # Distributed batch, worker side: leases jobs and runs them through the normal pipeline. MusicBrainz
+    # goes through the coordinator; the manifest records travel with the jobs.
+    job_queue = jq.JobQueue(args.work)
+    print(f"WORKER: Waiting for a batch in {args.work}.")
+    config = job_queue.config(wait=True)
+    profiles = [ac.parseProfile(spec) for spec in config["profiles"]]
+    jobs = max(1, int(args.jobs or be.defaultJobs()))
+    leases = jq.Leases(job_queue, ".", config, capacity=jobs + max(1, int(args.io_jobs or be.IO_JOBS)))
+    mbl.setProvider(jq.QueueProvider(job_queue, config["batch"]))
+    # SQLite over NFS isn't safe with several clients, the loudness cache stays on this node
+    local = pl.Path(tempfile.gettempdir()) / "batch-converter"
+    local.mkdir(exist_ok=True)
+    rga.LOUDNESS_CACHE_DB = str(local / pl.Path(rga.LOUDNESS_CACHE_DB).name)
+
+    def stop(signum, frame):
+        print("WORKER: Stopping, files already started are finished first (again to force quit).")
+        leases.stop()
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGINT, stop)
+    if hasattr(signal, "SIGTERM"):
+        signal.signal(signal.SIGTERM, stop)
+
+    print(f"WORKER: {leases.worker} working on {', '.join(config['profiles'])} with {jobs} jobs.")
+    batchConvert(".", profiles if len(profiles) > 1 else profiles[0], convert_artwork=True, file_renaming=True,
+                 modify_metadata=True, bypass_conversion=False, artwork_only=False, jobs=args.jobs,
+                 single_pass=config["single_pass"], save_artwork=config["save_artwork"], artwork_cache_mb=args.artwork_cache_mb,
+                 stream_copy=config["stream_copy"], report=job_queue.reportPath(leases.worker) if args.report else None,
+                 cprofile=args.cprofile, album_gain=False, io_jobs=args.io_jobs, schedule=False,
+                 segment_jobs=args.segment_jobs, sources=leases, manifest=mf.Manifest(store=leases.records),
+                 finished=leases.finished, progress_interval=args.progress_interval,
+                 metrics=job_queue.metricsPath(leases.worker), metrics_port=args.metrics_port)
+    leases.stop()
+    print(f"WORKER: {leases.worker} finished {leases.completed} jobs.")
 
 def main():
+    args = parseArgs()
+    if args.mb_cache_ttl is not None:
+        mbl.MB_CACHE_TTL = args.mb_cache_ttl * 86400
+    if args.mb_cache_max is not None:
+        mbl.MB_CACHE_MAX_ENTRIES = args.mb_cache_max
+    if args.mb_server:
+        mbl.setServer(args.mb_server)
+    if args.mb_batch:
+        mbl.MB_BATCH_SIZE = max(1, args.mb_batch)
+    if args.mb_offline:
+        import mbOffline as mbo
+        mbl.setProvider(mbo.OfflineProvider(args.mb_offline))
+    if args.loudness_cache_max is not None:
+        rga.LOUDNESS_CACHE_MAX_ENTRIES = args.loudness_cache_max
+    if args.loudness_engine:
+        rga.ANALYZER = args.loudness_engine
+    if args.loudness_threads:
+        rga.ANALYZER_THREADS = args.loudness_threads
+    se.SEGMENT_MIN_SECONDS = args.segment_minutes * 60
+    if args.watch or args.coordinate or args.work:
+        # Headless, no menu and no prompts
+        sys.excepthook = sys.__excepthook__
+        if args.coordinate:
+            return coordinateQueue(args)
+        if args.work:
+            return workQueue(args)
+        return watchFolders(args)
     try:
         print("=" * 21 + " Batch Audio Converter " + "=" * 21 + "\n")
         sample_rate = 48000
@@ -64,13 +371,18 @@ def main():
         modify_metadata = True
         bypass_format = True
         artwork_only = False
+        jobs = args.jobs
 
         while True:
             print("Settings:")
             print("-" * 23 + " AUDIO CONVERSION " + "-" * 24 + "\n")
-            print(f"(1) Output Format: {output_format}")
+            if args.profile:
+                print(f"Output Profiles (--profile): {', '.join(args.profile)}")
+            else:
+                print(f"(1) Output Format: {output_format}")
             print(f"(2) Sample Rate: {sample_rate}")
-            print(f"(3) Bitrate: {bitrate}")
+            if not args.profile:
+                print(f"(3) Bitrate: {bitrate}")
             print(f"(4) Channels: {channels}")
             print(f"(5) Preserve Metadata: {preserve_metadata}")
 
@@ -80,10 +392,14 @@ def main():
             print(f"(7) Auto File Renaming: {file_renaming}")
             print(f"(8) Change Metadata: {modify_metadata}")
             print(f"(9) Apply Artwork Only: {artwork_only}")
+
+            print("\n" + "-" * 25 + " PERFORMANCE " + "-" * 24 + "\n")
+
+            print(f"(11) Parallel Jobs: {jobs}")
             print("\n(10) Start Batch Conversion")
             print("(0) Exit\n")
 
-            option = input("Select an option to change (0-10): ")
+            option = input("Select an option to change (0-11): ")
             if option == "0":
                 exit()
             elif option == "1":
@@ -109,9 +425,21 @@ def main():
                 bypass_format = getValidInput("Do you wish to bypass conversion? Type \"y\" if you want just metadata work. (y/n): ", ["y", "n"]) == "y"
                 settings = ac.AudioConverter(sample_rate=sample_rate, channels=channels, bitrate=bitrate,
                                             output_format=output_format, preserve_metadata=preserve_metadata)
-                batchConvert(".", settings, convert_artwork=convert_artwork, file_renaming=file_renaming, modify_metadata=modify_metadata, bypass_conversion=bypass_format, artwork_only=artwork_only)
+                if args.profile:
+                    # Every profile gets its own folder in Output/
+                    settings = [ac.parseProfile(spec, sample_rate, channels, preserve_metadata) for spec in args.profile]
+                batchConvert(".", settings, convert_artwork=convert_artwork, file_renaming=file_renaming, modify_metadata=modify_metadata, bypass_conversion=bypass_format, artwork_only=artwork_only, jobs=jobs,
+                             single_pass=args.single_pass, use_manifest=args.manifest,
+                             save_artwork=args.save_artwork, artwork_cache_mb=args.artwork_cache_mb,
+                             stream_copy=args.stream_copy, recursive=args.recursive,
+                             report=args.report, cprofile=args.cprofile, album_gain=args.album_gain,
+                             io_jobs=args.io_jobs, schedule=args.schedule, segment_jobs=args.segment_jobs,
+                             progress_interval=args.progress_interval, metrics=args.metrics, metrics_port=args.metrics_port)
                 print("Batch conversion finished.")
                 exit()
+            elif option == "11":
+                jobs = int(getValidInput(f"Enter number of parallel jobs [1-{os.cpu_count() or 1}]: ",
+                                         [str(n) for n in range(1, (os.cpu_count() or 1) + 1)]))
             else:
                 print("Invalid option.")
     except Exception as e:
@@ -132,165 +460,521 @@ def exit():
     input("Press any key to exit...")
     quit()
 
-def batchConvert(dir, settings: ac, convert_artwork=False, file_renaming=False, modify_metadata=False, bypass_conversion=True, artwork_only=False):
+def batchConvert(dir, settings, convert_artwork=False, file_renaming=False, modify_metadata=False, bypass_conversion=True, artwork_only=False, jobs=None,
+                 single_pass=True, use_manifest=True, save_artwork=True, artwork_cache_mb=awc.ARTWORK_CACHE_MAX_BYTES // (1024 * 1024),
+                 stream_copy=True, recursive=True, report=rr.RUN_REPORT_FILE, cprofile=None, album_gain=True,
+                 io_jobs=None, schedule=True, segment_jobs=0, sources=None, manifest=None, finished=None,
+                 progress_interval=pm.PROGRESS_INTERVAL, metrics=None, metrics_port=None):
+    # sources: (audio path, sidecar) pairs under dir to process instead of scanning it, e.g. a FolderWatcher
+    # manifest: used instead of opening manifest.sqlite; finished(result) is called with every FileResult
+    # progress_interval, metrics, metrics_port: live progress, see progressMonitor
     directory = pl.Path(dir).resolve()
+    profiles = profileList(settings)
+    if bypass_conversion and len(profiles) > 1:
+        print(f"AUDIO CONVERTER: Bypassing conversion only works with a single output format.")
+        return []
+    if report:
+        rr.start(report)
+    pm.start(progress_interval, metrics, metrics_port)
     output_dir = pl.Path("Output")
     output_dir.mkdir(exist_ok=True)
 
     artwork_dir = pl.Path("Artwork")
-    artwork_dir.mkdir(exist_ok=True)
-
-    # Look for files to convert
-    audio_files = []
-    for ext in ac.AUDIO_FORMATS:
-        audio_files.extend(pl.Path(directory).glob(f"*.{ext}"))
-    if not audio_files:
+    if save_artwork:
+        artwork_dir.mkdir(exist_ok=True)
+
+    # Look for files to convert, streamed from a recursive walk (our own output folders are left out)
+    def scan():
+        return ls.scanLibrary(directory, ac.AUDIO_FORMATS, ARTWORK_EXT, recursive=recursive,
+                              exclude=[output_dir, artwork_dir, awc.ARTWORK_CACHE_DIR])
+
+    if manifest is None and use_manifest:
+        manifest = mf.Manifest()
+    artwork_cache = None
+    if convert_artwork and artwork_cache_mb:
+        artwork_cache = awc.ArtworkCache(max_bytes=artwork_cache_mb * 1024 * 1024)
+    tagging_stages = [(stageName("tagging", profile.profileName() if len(profiles) > 1 else None),
+                       stageFingerprints(profile, convert_artwork, file_renaming, modify_metadata, bypass_conversion, artwork_only)["tagging"])
+                      for profile in profiles]
+    # The last stage processFile records for a source, untagged outputs stop after the encode
+    final_stages = tagging_stages if profiles[0].preserve_metadata else [
+        (stageName("encode", profile.profileName() if len(profiles) > 1 else None),
+         stageFingerprints(profile, convert_artwork, file_renaming, modify_metadata, bypass_conversion, artwork_only)["encode"])
+        for profile in profiles]
+
+    def complete(audio_file):
+        # Nothing left to do for this source (stat-only), so it isn't probed or read ahead
+        return bool(manifest) and all(manifest.isComplete(audio_file, stage, fp) for stage, fp in final_stages)
+
+    scanned = 0
+    scan_finished = False
+    def discovered():
+        nonlocal scanned, scan_finished
+        for audio_file, sidecar in (scan() if sources is None else sources):
+            if bypass_conversion and audio_file.suffix.lower() != f".{profiles[0].output_format}":
+                print(f"So... You changed the output format, but want to bypass conversion? Do the steps again correctly...")
+                break
+            scanned += 1
+            pm.queued(audio_file, 0.0 if complete(audio_file) else None)
+            yield audio_file, sidecar
+        scan_finished = True
+
+    def prefetchKey(source):
+        audio_file, _ = source
+        if complete(audio_file):
+            return None
+        return readLookupKey(audio_file)
+
+    # MusicBrainz lookups run on their own thread, prefetched for every file while encoding goes on.
+    # The prefetch walks the library on its own so it can run ahead of the encoders.
+    mb_stage = None
+    if modify_metadata and not artwork_only and profiles[0].preserve_metadata:
+        mb_stage = mbl.LookupStage()
+        if sources is None:
+            mb_stage.prefetch(scan(), prefetchKey)
+
+    # Album ReplayGain is worked out after the batch from every track's gating blocks (a watched folder's
+    # stream has no end to wait for, so it only gets track gain)
+    albums = {} if album_gain and sources is None and modify_metadata and not artwork_only and profiles[0].preserve_metadata else None
+
+    # Convert files concurrently as they are discovered, one pipeline per file. Sources are probed as the
+    # scan finds them and the longest estimated jobs go first, so a long mix doesn't start last.
+    task = rr.profiled(processSource, cprofile) if cprofile else processSource
+    queued = discovered()
+    if schedule:
+        analyzed = modify_metadata and not artwork_only and profiles[0].preserve_metadata
+        queued = be.CostQueue(queued, lambda source: 0.0 if complete(source[0]) else cm.estimateCost(source[0], profiles, analyzed, bypass_conversion))
+    claimed_outputs = {}
+    failed = []
+    started = time.monotonic()
+    i = 0
+    for i, result in enumerate(be.runParallel(task, queued, directory, output_dir, artwork_dir, profiles if len(profiles) > 1 else settings,
+                                              claimed_outputs, convert_artwork=convert_artwork, file_renaming=file_renaming,
+                                              modify_metadata=modify_metadata, bypass_conversion=bypass_conversion,
+                                              artwork_only=artwork_only, single_pass=single_pass, mb_stage=mb_stage,
+                                              manifest=manifest, save_artwork=save_artwork, artwork_cache=artwork_cache,
+                                              stream_copy=stream_copy, albums=albums, segment_jobs=segment_jobs,
+                                              jobs=jobs, io_jobs=io_jobs), start=1):
+        audio_file, _ = result.source
+        print(result.log, end="")
+        if finished:
+            finished(result)
+        if not result.ok:
+            failed.append(result)
+            rr.count("failed")
+            print(f"AUDIO CONVERTER: {audio_file.name} failed: {result.error}")
+        if scan_finished:
+            print(f"--- Progress: {i} / {scanned}: {audio_file.name} ({i/scanned*100:.1f}%{pm.etaText()})")
+        else:
+            print(f"--- Progress: {i} / {scanned} found so far: {audio_file.name}{pm.etaText()}")
+        if sources is not None:
+            # A stream of sources (watched folders, queue leases) never ends: once every file found so far is
+            # done, their claims are released so a long-running daemon doesn't keep one per file it has seen
+            with _fs_lock:
+                if i == scanned:
+                    claimed_outputs.clear()
+
+    if not i:
         print("AUDIO CONVERTER: No compatible audio files found to work with.")
-        return []
-    
-    # Convert file by file
-    for i, audio_file in enumerate(audio_files, start=0):
-        #Define paths for audio files
-        filename = audio_file.stem + f".{settings.output_format}"
-        output_file = pl.Path(output_dir) / filename
-
-        # AUDIO CONVERTER
-        if not bypass_conversion:
-            if output_file.exists():
+    elif schedule:
+        # More jobs than cores doesn't make the CPU work go faster
+        cores = min(max(1, int(jobs or be.defaultJobs())), be.defaultJobs())
+        print(f"SCHEDULER: {queued.count} files, {queued.total:.1f}s of estimated CPU work (longest {queued.longest:.1f}s); "
+              f"ideal on {cores} cores ~{queued.idealSeconds(cores):.1f}s, took {time.monotonic() - started:.1f}s.")
+
+    if albums:
+        with rr.stage("album_gain"):
+            applyAlbumGain(albums)
+
+    if artwork_cache:
+        print(f"ARTWORK CONVERTER: {artwork_cache.misses} covers converted, {artwork_cache.hits} reused from cache.")
+
+    if failed:
+        print(f"AUDIO CONVERTER: {len(failed)} of {scanned} files failed:")
+        for result in failed:
+            print(f"    {result.source[0].name}: {result.error}")
+
+    if mb_stage:
+        mb_stage.close()
+    pm.finish()
+    rga.flushCache()
+    if manifest:
+        manifest.close()
+    rr.count("files", scanned)
+    if rr.finish() and report:
+        print(f"RUN REPORT: Timings written to {report}")
+    return [output for ext in dict.fromkeys(profile.output_format for profile in profiles)
+            for output in pl.Path(output_dir).rglob(f"*.{ext}")]
+
+def claimOutput(claimed_outputs, output_file: pl.Path, source: pl.Path):
+    # Two sources with the same stem map to the same output, only the first one gets it
+    # (the same source coming back, e.g. replaced in a watched folder, keeps its output)
+    with _fs_lock:
+        key = str(output_file).lower()
+        owner = claimed_outputs.setdefault(key, str(source))
+        return owner == str(source)
+
+def stageFingerprints(settings: ac, convert_artwork, file_renaming, modify_metadata, bypass_conversion, artwork_only):
+    encode = mf.fingerprint("copy" if bypass_conversion else settings.describe())
+    return {
+        "encode": encode,
+        "artwork": mf.fingerprint(convert_artwork),
+        "loudness": mf.fingerprint(encode, "ebur128", "blocks"),
+        "tagging": mf.fingerprint(encode, convert_artwork, file_renaming, modify_metadata, artwork_only),
+    }
+
+def stageName(stage, profile=None):
+    # Multi-profile runs track encode/tagging per profile, single profile runs keep the plain names
+    return f"{stage}:{profile}" if profile else stage
+
+def profileList(settings):
+    return list(settings) if isinstance(settings, (list, tuple)) else [settings]
+
+def loudnessFingerprint(profiles, bypass_conversion):
+    # Several profiles share one loudness measurement taken from the decoded source
+    if len(profiles) == 1:
+        return stageFingerprints(profiles[0], False, False, False, bypass_conversion, False)["loudness"]
+    return mf.fingerprint([settings.describe() for settings in profiles], "ebur128", "blocks")
+
+class OutputTarget:
+    def __init__(self, settings: ac, profile, output_file: pl.Path, fingerprints):
+        self.settings = settings
+        self.profile = profile
+        self.output_file = output_file
+        self.fingerprints = fingerprints
+        self.copy = False
+
+def processSource(source, *args, **kwargs):
+    # Everything timed while this file is processed is attributed to it in the run report
+    with rr.source(source[0]), rr.stage("file"), pm.file(source[0]):
+        return processFile(source, *args, **kwargs)
+
+def processFile(source, directory: pl.Path, output_dir: pl.Path, artwork_dir: pl.Path, settings, claimed_outputs,
+                convert_artwork=False, file_renaming=False, modify_metadata=False, bypass_conversion=True, artwork_only=False, single_pass=True,
+                mb_stage=None, manifest=None, save_artwork=True, artwork_cache=None, stream_copy=True, albums=None, segment_jobs=0):
+    audio_file, foundimage_file = source
+    profiles = profileList(settings)
+    multi = len(profiles) > 1
+    preserve_metadata = profiles[0].preserve_metadata
+
+    # Work recorded for this exact source content and settings is not redone
+    with rr.stage("manifest_check"):
+        entry = manifest.entry(audio_file) if manifest else None
+
+    #Define paths for audio files, subfolders of the library are mirrored in Output/ and Artwork/ (one Output/<profile>/ per profile)
+    relative_dir = audio_file.parent.relative_to(directory)
+    artwork_dir = pl.Path(artwork_dir) / relative_dir
+    targets = []
+    for settings in profiles:
+        profile = settings.profileName() if multi else None
+        output_file = pl.Path(output_dir) / (profile or "") / relative_dir / (audio_file.stem + f".{settings.output_format}")
+        if not claimOutput(claimed_outputs, output_file, audio_file):
+            print(f"AUDIO CONVERTER: Skipping {audio_file.name} (another source in this batch writes {output_file.name}).")
+            continue
+        recorded = entry.outputFor(profile) if entry else None
+        if recorded and recorded.exists() and recorded.suffix.lower() == output_file.suffix.lower():
+            output_file = recorded  # Might have been renamed by an earlier run
+        output_file.parent.mkdir(parents=True, exist_ok=True)
+        fingerprints = stageFingerprints(settings, convert_artwork, file_renaming, modify_metadata, bypass_conversion, artwork_only)
+        targets.append(OutputTarget(settings, profile, output_file, fingerprints))
+    if not targets:
+        return None
+    loudness_fingerprint = loudnessFingerprint(profiles, bypass_conversion)
+
+    # AUDIO CONVERTER
+    rg = None
+    pending = []
+    verified = []  # Outputs found on disk that checked out, recorded like the ones encoded below
+    for target in targets:
+        if entry and entry.done(stageName("encode", target.profile), target.fingerprints["encode"]) and target.output_file.exists():
+            print(f"AUDIO CONVERTER: Skipping {audio_file.name} {target.settings.output_format} conversion (unchanged since last run).")
+            rr.count("skipped_encode")
+        elif target.output_file.exists() and not (entry and entry.outputFor(target.profile)):
+            if outputComplete(target.output_file, audio_file):
                 print(f"AUDIO CONVERTER: Skipping {audio_file.name} conversion (a similar file exists).")
+                verified.append(target)
             else:
-                settings.converter(str(audio_file), str(output_file))
-                print(f"AUDIO CONVERTER: {audio_file.name} converted to {settings.output_format}")
+                print(f"AUDIO CONVERTER: {target.output_file.name} is incomplete (an interrupted run?), converting it again.")
+                pending.append(target)
         else:
-            if audio_file.suffix.lower() != output_file.suffix.lower():
-                print(f"So... You changed the output format, but want to bypass conversion? Do the steps again correctly...")
-                return
-            if output_file.exists():
-                print(f"AUDIO CONVERTER: Skipping {audio_file.name} conversion (a similar file exists).")
-            else:
-                audio_file.copy(output_file)
-                print(f"AUDIO CONVERTER: {audio_file.name} copied to {output_file.parent}")
-
-        
-        if settings.preserve_metadata:
-            # Get the correct tag type for each format
+            pending.append(target)
+
+    # Artwork comes first so the new outputs can reserve room for it and the tags
+    cover = None
+    if preserve_metadata:
+        # Artwork generator, the cover only lives in memory unless Artwork/ copies are wanted
+        artwork_fingerprint = mf.fingerprint(targets[0].fingerprints["artwork"], save_artwork, foundimage_file and
+                                             (foundimage_file.name, foundimage_file.stat().st_size, foundimage_file.stat().st_mtime_ns))
+        artwork_done = entry is not None and entry.done("artwork", artwork_fingerprint)
+        done_image = entry.result("artwork", artwork_fingerprint) if artwork_done else None
+        # Outputs encoded again below are tagged again
+        tagged = {target.profile: entry is not None and target not in pending and
+                  entry.done(stageName("tagging", target.profile), target.fingerprints["tagging"]) for target in targets}
+
+        image_file = pl.Path(done_image) if done_image else pl.Path(artwork_dir) / f"{audio_file.stem}.png"
+        skip_artwork = artwork_done and (done_image is None or image_file.exists()) and (all(tagged.values()) or not modify_metadata)
+        # Get the correct tag type for each format, not needed when the artwork and every output's tags are done
+        tag_type = audio = None
+        if not (skip_artwork and all(tagged.values())):
             tag_type, audio = loadMutagen(audio_file)
 
-            # Artwork generator
-            foundimage_file = next(
-                (directory / f"{audio_file.stem}.{ext}"
-                for ext in ARTWORK_EXT
-                if (directory / f"{audio_file.stem}.{ext}").exists()),
-                None
-            )
-
+        if skip_artwork:
+            print(f"ARTWORK EXTRACTOR: Skipping {audio_file.name} artwork (unchanged since last run).")
+            rr.count("skipped_artwork")
+        else:
             if foundimage_file:
-                foundimage_file.copy(pl.Path(artwork_dir) / foundimage_file.name)
+                cover = foundimage_file.read_bytes()
                 print(f"ARTWORK EXTRACTOR: Found artwork for{foundimage_file.name}.")
             else:
-                if not artworkExtractor(tag_type, audio, pl.Path(artwork_dir) / f"{audio_file.stem}.png"):
+                with rr.stage("artwork_extract"):
+                    cover = artworkExtractor(tag_type, audio)
+                if not cover:
                     print("ARTWORK EXTRACTOR: Failed extracting thumbnail (might be missing)")
 
-            image_file = next(
-                (pl.Path(artwork_dir) / f"{audio_file.stem}.{ext}" for ext in ARTWORK_EXT
-                if (pl.Path(artwork_dir) / f"{audio_file.stem}.{ext}").exists()),
-                None
-            )
-
             # Transfrom artwork in 1000x1000 PNG if selected
             if convert_artwork:
-                if image_file.exists():
-                    tempimage_file = pl.Path(artwork_dir) / f"{audio_file.stem}_temp.png"
-                    art.convertArtwork(str(image_file), str(tempimage_file))
-                    image_file.unlink()
-                    image_file = pl.Path(artwork_dir) / f"{audio_file.stem}.png"
-                    tempimage_file.rename(image_file)
-                    print(f"ARTWORK CONVERTER: Artwork {image_file.name} converted.")
+                if cover:
+                    with rr.stage("artwork_convert"), be.slot("cpu"):
+                        if artwork_cache:
+                            converted = artwork_cache.convert(cover, art.convertArtworkBytes, variant=f"{art.ARTWORK_SIZE}")
+                        else:
+                            converted = art.convertArtworkBytes(cover)
+                    cover = converted or cover
+                    print(f"ARTWORK CONVERTER: Artwork for {audio_file.name} converted.")
                 else:
                     print("ARTWORK CONVERTER: Could not find the image to convert.")
 
-            if modify_metadata:
-                modifyMetadata(tag_type, audio, image_file, output_file, artwork_only)
-
-            if file_renaming:
-                renameFiles(tag_type, audio, output_file, image_file)
-
-        total_files = len(audio_files)
-        print(f"--- Progress: {i+1} / {total_files}: {audio_file.name} ({(i+1)/total_files*100:.1f}%)")
-    
-    save_mb_cache(_mb_cache)
-    return list(pl.Path(output_dir).glob(f"*.{settings.output_format}"))
+            if save_artwork and cover:
+                artwork_dir.mkdir(parents=True, exist_ok=True)
+                image_file = pl.Path(artwork_dir) / (audio_file.stem + (".png" if ts.imageMime(cover) == "image/png" else ".jpg"))
+                with rr.stage("artwork_save"), be.slot("io"):
+                    image_file.write_bytes(cover)
+
+            if entry and not artwork_done:
+                entry.invalidate(*(stageName("tagging", target.profile) for target in targets))
+                tagged = dict.fromkeys(tagged, False)
+            if entry:
+                entry.complete("artwork", artwork_fingerprint, str(image_file) if save_artwork and cover else None)
+
+    if pending and bypass_conversion:
+        for target in pending:
+            with rr.stage("copy"), be.slot("io"):
+                shutil.copy2(audio_file, target.output_file)
+            print(f"AUDIO CONVERTER: {audio_file.name} copied to {target.output_file.parent}")
+    elif pending:
+        # Sources that already match the target codec, rate, channels and bitrate are only remuxed
+        for target in pending:
+            with rr.stage("probe"), be.slot("io"):
+                target.copy = stream_copy and target.settings.canStreamCopy(str(audio_file))
+            rr.count("stream_copy" if target.copy else "encode")
+        formats = ", ".join(("remuxed (stream copy) to " if target.copy else "") + target.settings.output_format for target in pending)
+        measure = single_pass and modify_metadata and not artwork_only and preserve_metadata
+        # A very long file is split into segments that are encoded at the same time, each in its own CPU slot
+        # New outputs get room for the cover and tags written below, so tagging doesn't rewrite them
+        reserve = len(cover or b"") if modify_metadata else None
+        segments = None
+        if segment_jobs > 1 and len(pending) == 1 and not pending[0].copy and not (measure and not rga.NUMPY_INSTALLED):
+            segments = se.plan(pending[0].settings, audio_file, segment_jobs)
+        with rr.stage("encode_loudness" if measure else "encode"):
+            if segments:
+                converted, rg = se.convertSegmented(pending[0].settings, str(audio_file), str(pending[0].output_file), segments,
+                                            analyze=measure, jobs=segment_jobs, reserve=reserve)
+            else:
+                with be.slot("cpu"):
+                    if measure and not multi:
+                        converted, rg = pending[0].settings.convertAndAnalyze(str(audio_file), str(pending[0].output_file), copy=pending[0].copy,
+                                                                      reserve=reserve)
+                    elif measure or len(pending) > 1:
+                        # One decode for every profile, split to the encoders
+                        converted, rg = ac.convertProfiles(str(audio_file), [(target.settings, str(target.output_file), target.copy) for target in pending],
+                                                   analyze=measure, reserve=reserve)
+                    else:
+                        converted = pending[0].settings.converter(str(audio_file), str(pending[0].output_file), copy=pending[0].copy, reserve=reserve)
+        if not converted:
+            # Whatever ffmpeg left behind is incomplete, tagging it would only fail further down
+            for target in pending:
+                try:
+                    target.output_file.unlink()
+                except FileNotFoundError:
+                    pass
+            raise RuntimeError(f"{audio_file.name} could not be converted to {formats} (see the ffmpeg error above)")
+        if measure:
+            print(f"AUDIO CONVERTER: {audio_file.name} converted to {formats} (loudness measured in the same pass)")
+        else:
+            print(f"AUDIO CONVERTER: {audio_file.name} converted to {formats}")
+    if entry and pending:
+        entry.invalidate("loudness", *(stageName("tagging", target.profile) for target in pending))
+
+    # Only outputs encoded in this run (a failed encode raised above) or checked on disk count as done
+    for target in pending + verified:
+        if entry:
+            entry.setOutput(target.output_file, target.profile)
+            entry.complete(stageName("encode", target.profile), target.fingerprints["encode"])
+    if entry and rg:
+        entry.complete("loudness", loudness_fingerprint, list(rg))
+
+    if not preserve_metadata:
+        return [target.output_file for target in targets] if multi else targets[0].output_file
+
+    # Tags, loudness and the MusicBrainz result are shared by every output of this source
+    if rg is None and entry:
+        rg = entry.result("loudness", loudness_fingerprint)
+    for target in targets:
+        if tagged[target.profile]:
+            print(f"METADATA MODIFIER: Skipping {target.output_file.name} tags (unchanged since last run).")
+            rr.count("skipped_tagging")
+            continue
+
+        if modify_metadata:
+            with rr.stage("tagging"):
+                rg = modifyMetadata(tag_type, audio, cover, target.output_file, artwork_only, rg=rg, mb_stage=mb_stage) or rg
+            if entry and rg:
+                entry.complete("loudness", loudness_fingerprint, list(rg))
+
+        if file_renaming:
+            with rr.stage("rename"), be.slot("io"):
+                target.output_file, image_file = renameFiles(tag_type, audio, target.output_file, image_file)
+
+        if entry:
+            entry.setOutput(target.output_file, target.profile)
+            entry.complete("artwork", artwork_fingerprint, str(image_file) if save_artwork and image_file.exists() else None)
+            entry.complete(stageName("tagging", target.profile), target.fingerprints["tagging"])
+
+    if albums is not None:
+        # Tracks tagged in an earlier run still count towards their album
+        if not (rg and len(rg) > 2 and rg[2]) and targets[0].output_file.suffix.lower() != ".wav":
+            with be.slot("cpu"):
+                rg = rga.analyze_replaygain(targets[0].output_file)
+            if entry and rg:
+                entry.complete("loudness", loudness_fingerprint, list(rg))
+        for target in targets:
+            collectAlbumTrack(albums, target.output_file, rg)
+
+    return [target.output_file for target in targets] if multi else targets[0].output_file
+
+def outputComplete(output_file: pl.Path, source: pl.Path):
+    # ffmpeg writes the length (Xing frame count, STREAMINFO, moov, RIFF sizes) last, so an output cut off by
+    # a failed or killed run reads short or not at all
+    import mutagen
+    try:
+        audio = mutagen.File(str(output_file))
+        length = audio.info.length if audio is not None else 0
+    except Exception:
+        return False
+    expected = cm.probeDuration(source)
+    return length > 0 and abs(length - expected) <= max(1.0, expected * 0.01)
 
-def artworkExtractor(tag_type, audio, image_path: pl.Path) -> bool:
+def collectAlbumTrack(albums, output_file: pl.Path, rg):
+    if not rg or output_file.suffix.lower() == ".wav" or not output_file.exists():
+        return
+    _, _, album, _, _ = readTags(*loadMutagen(output_file))
+    if not album or album == "Unknown Album":
+        return
+    # Same album name in another folder is another album
+    with _fs_lock:
+        albums.setdefault((str(output_file.parent), album), []).append((output_file, rg))
+
+def applyAlbumGain(albums):
+    for (folder, album), tracks in albums.items():
+        result = rga.album_gain([rg for _, rg in tracks])
+        if not result:
+            print(f"REPLAYGAIN: No loudness data for album {album}, album gain skipped.")
+            continue
+        gain, peak = result
+        written = 0
+        for output_file, _ in tracks:
+            session = ts.TagSession(output_file)
+            if session.replayGain("album") == (f"{gain} dB", str(peak)):
+                continue
+            session.setReplayGain(gain, peak, scope="album")
+            session.commit()
+            written += 1
+        print(f"REPLAYGAIN: Album {album} ({len(tracks)} tracks): {gain} dB, peak {peak}" +
+              (f", written to {written} files." if written else ", unchanged."))
+
+def artworkExtractor(tag_type, audio):
+    # Returns the embedded front cover bytes, or None
     try:
         if tag_type == "id3":
             for tag in audio.getall("APIC"):
                 if tag.type == 3:
-                    image_path.write_bytes(tag.data)
-                    return True
-            return False
+                    return tag.data
+            return None
         elif tag_type == "mp4":
-            covers = audio.tags.get("covr")
+            covers = audio.tags.get("covr") if audio.tags else None
             if not covers:
-                return False
-            cover = covers[0]
-            # Determine Extension
-            if cover.imageformat == MP4Cover.FORMAT_PNG:
-                image_path = image_path.with_suffix(".png")
-            else:
-                image_path = image_path.with_suffix(".jpg")
-
-            image_path.write_bytes(bytes(cover))
-            return True
-        else:
-            if not audio.pictures:
-                return False
+                return None
+            return bytes(covers[0])
+        elif tag_type in ("ogg", "opus"):
+            from mutagen.flac import Picture
+            for value in audio.get("metadata_block_picture", []):
+                pic = Picture(base64.b64decode(value))
+                if pic.type == 3:
+                    return pic.data
+            return None
+        elif tag_type == "flac":
             for pic in audio.pictures:
                 if pic.type == 3:
-                    image_path.write_bytes(pic.data)
-                    return True
-            return False
+                    return pic.data
+            return None
+        return None
     except Exception as e:
-        print(f"ARTWORK EXTRACTOR: Extraction failed for {image_path.name}: {e}")
-        return False
+        print(f"ARTWORK EXTRACTOR: Extraction failed: {e}")
+        return None
 
 def safe_name(text, replacement=""):
         forbidden = r'\/:*?"<>|'
         return "".join(c if c not in forbidden else replacement for c in text).strip()
 
+def readTags(tag_type, audio):
+    if tag_type == "id3":
+        from mutagen.id3 import TIT2, TPE1, TALB, TCON
+        artist = audio.get("TPE1", TPE1(encoding=3, text="Unknown Artist")).text[0]
+        title  = audio.get("TIT2", TIT2(encoding=3, text="Unknown Title")).text[0]
+        album  = audio.get("TALB", TALB(encoding=3, text="Unknown Album")).text[0]
+        date = audio.get("TDRC")
+        year = str(date.text[0]) if date else ""
+        genre = audio.get("TCON", TCON(encoding=3, text="")).text[0]
+    elif tag_type == "mp4":
+        artist = audio.get("\xa9ART", ["Unknown Artist"])[0]
+        title  = audio.get("\xa9nam", ["Unknown Title"])[0] 
+        album  = audio.get("\xa9alb", ["Unknown Album"])[0]
+        genre  = audio.get("\xa9gen", [""])[0]
+        year   = audio.get("\xa9day", [""])[0]
+    else:
+        artist = audio.get("artist", ["Unknown Artist"])[0]
+        title  = audio.get("title", ["Unknown Title"])[0]
+        album  = audio.get("album", ["Unknown Album"])[0]
+        year   = audio.get("date", [""])[0]
+        genre  = audio.get("genre", [""])[0]
+    return artist, title, album, year, genre
+
+def readLookupKey(audio_file: pl.Path):
+    tag_type, audio = loadMutagen(audio_file)
+    if tag_type == "wav":
+        return None
+    artist, title, _, _, _ = readTags(tag_type, audio)
+    if artist in (None, "Unknown Artist") or title in (None, "Unknown Title"):
+        return None
+    return artist, title
+
 # METADATA MODIFIER
-def modifyMetadata(tag_type, audio, image_path: pl.Path, save_file: pl.Path, artwork_only=False):
+def modifyMetadata(tag_type, audio, cover: bytes, save_file: pl.Path, artwork_only=False, rg=None, mb_stage=None):
+
+    session = ts.TagSession(save_file)
 
-    outtag_type, out_audio = loadMutagen(save_file)
-    
     if not artwork_only:
         if tag_type == "wav" or save_file.suffix.lower() == ".wav":
             print(f"METADATA MODIFIER: WAV does not support metadata. Skipping {save_file.name}")
             return
-        elif tag_type == "id3":
-            artist = audio.get("TPE1", TPE1(encoding=3, text="Unknown Artist")).text[0]
-            title  = audio.get("TIT2", TIT2(encoding=3, text="Unknown Title")).text[0]
-            album  = audio.get("TALB", TALB(encoding=3, text="Unknown Album")).text[0]
-            date = audio.get("TDRC")
-            year = str(date.text[0]) if date else ""
-            genre = audio.get("TCON", TCON(encoding=3, text="")).text[0]
-        elif tag_type == "mp4":
-            artist = audio.get("\xa9ART", ["Unknown Artist"])[0]
-            title  = audio.get("\xa9nam", ["Unknown Title"])[0] 
-            album  = audio.get("\xa9alb", ["Unknown Album"])[0]
-            genre  = audio.get("\xa9gen", [""])[0]
-            year   = audio.get("\xa9day", [""])[0]
-        else:
-            artist = audio.get("artist", ["Unknown Artist"])[0]
-            title  = audio.get("title", ["Unknown Title"])[0]
-            album  = audio.get("album", ["Unknown Album"])[0]
-            year   = audio.get("date", [""])[0]
-            genre  = audio.get("genre", [""])[0]
-
-        # ReplayGain Calculation
-        rg = rga.analyze_replaygain(save_file)
+        artist, title, album, year, genre = readTags(tag_type, audio)
+
+        # ReplayGain Calculation (skipped when the converter already measured it)
+        if rg is None:
+            with be.slot("cpu"):
+                rg = rga.analyze_replaygain(save_file)
         if rg:
-            gain, peak = rg
+            gain, peak = rg[:2]
         else:
             print("REPLAYGAIN: Failed to calculate.")
 
@@ -299,112 +983,42 @@ def modifyMetadata(tag_type, audio, image_path: pl.Path, save_file: pl.Path, art
         if artist in (None, "Unknown Artist") or title in (None, "Unknown Title"):
             print(f"MusicBrainz: Cannot search due to empty artist and title tags! Skipping {save_file.name}")
         else:
-            recording = mbLookupRec(artist, title)
+            if mb_stage:
+                # Only waits here, the request itself runs on the lookup thread
+                recording = mb_stage.lookup(artist, title)
+            else:
+                with be.slot("io"):
+                    recording = mbl.lookup(artist, title)
 
         if recording:
-            mb_album, mb_year, mb_genre = extractMetadata(recording)
+            mb_album, mb_year, mb_genre = mbl.extractMetadata(recording)
             album = mb_album or album
             year  = mb_year or year
             genre = mb_genre or genre
 
-            if outtag_type == "id3":
-                out_audio.delall("TALB")
-                out_audio.delall("TDRC")
-                out_audio.delall("TCON")
-                out_audio.delall("TXXX:REPLAYGAIN_TRACK_GAIN")
-                out_audio.delall("TXXX:REPLAYGAIN_TRACK_PEAK")
-
-                out_audio.add(TALB(encoding=3, text=album))
-                if year:
-                    out_audio.add(TYER(encoding=3, text=year))
-                if genre:
-                    out_audio.add(TCON(encoding=3, text=genre))
-                if rg:
-                    out_audio.add(TXXX(encoding=3, desc="REPLAYGAIN_TRACK_GAIN", text=f"{gain} dB"))
-                    out_audio.add(TXXX(encoding=3, desc="REPLAYGAIN_TRACK_PEAK", text=str(peak)))
-
-                out_audio.save(v2_version=3)
-            elif outtag_type == "mp4":
-                out_audio["\xa9alb"] = album
-                out_audio["\xa9gen"] = genre
-                out_audio["\xa9day"] = year
-
-                if rg:
-                    audio["----:com.apple.iTunes:replaygain_track_gain"] = [f"{gain} dB".encode()]
-                    audio["----:com.apple.iTunes:replaygain_track_peak"] = [str(peak).encode()]
-
-                out_audio.save()
-            else:
-                out_audio["artist"] = artist
-                out_audio["title"]  = title
-                out_audio["album"]  = album
-                if year:
-                    out_audio["date"] = year
-                if genre:
-                    out_audio["genre"] = genre
-
-                if rg:
-                    out_audio["REPLAYGAIN_TRACK_GAIN"] = f"{gain} dB"
-                    out_audio["REPLAYGAIN_TRACK_PEAK"] = str(peak)
-
-                out_audio.save()
+            session.setTags(artist=artist, title=title, album=album, year=year, genre=genre)
 
-    applyArtwork(image_path, out_audio, outtag_type)
-
-def applyArtwork(image_path: pl.Path, out_audio, tag_type):
-    if image_path.exists():
-        if tag_type == "id3":
-            with open(image_path, "rb") as img:
-                out_audio.delall("APIC")
-                out_audio.add(APIC(
-                    encoding=3,
-                    mime="image/png",
-                    type=3,
-                    desc="Cover",
-                    data=img.read()
-                ))
-            out_audio.save(v2_version=3)
-        elif tag_type == "mp4":
-            with open(image_path, "rb") as img:
-                out_audio["covr"] = [MP4Cover(img.read(), imageformat=MP4Cover.FORMAT_PNG)]
-            out_audio.save()
-        elif tag_type == "flac":
-            out_audio.clear_pictures()
+        if rg:
+            session.setReplayGain(gain, peak)
 
-            pic = Picture()
-            pic.type = 3
-            pic.desc = "Cover"
-            pic.data = image_path.read_bytes()
-            pic.mime = "image/png"
+    applyArtwork(cover, session)
+    # Single write for tags, ReplayGain and cover
+    with be.slot("io"):
+        session.commit()
+    return rg
 
-            out_audio.add_picture(pic)
-            out_audio.save()
-        else:
-            with open(image_path, "rb") as img:
-                data = img.read()
-
-            pic = Picture()
-            pic.type = 3
-            pic.desc = "Cover"
-            pic.data = data
-            pic.mime = "image/png"
-
-            # Base64 encoding
-            pic_data = pic.write()
-            enc_data = base64.b64encode(pic_data)
-            vcomm_val = enc_data.decode("ascii")
-
-            out_audio["metadata_block_picture"] = [vcomm_val]
-            out_audio.save()
-        return True
+def applyArtwork(cover: bytes, session: ts.TagSession):
+    if cover:
+        return session.setCover(cover)
     else:
         return False
 
 def renameFiles(tag_type, audio, audio_path: pl.Path, image_path: pl.Path):
     if tag_type == "wav":
         print(f"FILE RENAMING: WAV cannot be renamed due to unsupported metadata. Skipping {audio_path.name}")
-        return
+        return audio_path, image_path
     elif tag_type == "id3":
+        from mutagen.id3 import TIT2, TPE1
         artist = audio.get("TPE1", TPE1(encoding=3, text="Unknown Artist")).text[0]
         title  = audio.get("TIT2", TIT2(encoding=3, text="Unknown Title")).text[0]
     elif tag_type == "mp4":
@@ -420,152 +1034,31 @@ def renameFiles(tag_type, audio, audio_path: pl.Path, image_path: pl.Path):
 
     if artist in (None, "Unknown Artist") or title in (None, "Unknown Title"):
         print(f"FILE RENAMING: Cannot rename due to empty artist and title tags! Skipping {audio_path.name}")
-        return
+        return audio_path, image_path
 
     new_audio = audio_path.parent / f"{artist} - {title}{audio_path.suffix.lower()}"
-    new_art   = image_path.parent / f"{artist} - {title}.png"
-
-    if audio_path.exists() and not new_audio.exists():
-        audio_path.rename(new_audio)
-        print(f"FILE RENAMING: Audio {audio_path.name} renamed to {new_audio.name}")
-    else:
-        print(f"FILE RENAMING: Audio named {new_audio.name} already exists! Skipped renaming.")
-
-    if image_path.exists() and not new_art.exists():
-        image_path.rename(new_art)
-        print(f"FILE RENAMING: Art {image_path.name} renamed to {new_art.name}")
-    else:
-        print(f"FILE RENAMING: Art named {new_art.name} already exists! Skipped renaming.")
-
-def loadMutagen(filepath: pl.Path):
-    ext = filepath.suffix.lower()
-
-    if ext == ".mp3":
-        try:
-            audio = ID3(filepath)
-        except ID3NoHeaderError:
-            audio = ID3()
-            audio.filename = str(filepath)
-        return "id3", audio
-    elif ext == ".flac":
-        return "flac", FLAC(filepath)
-    elif ext == ".opus":
-        return "opus", OggOpus(filepath)
-    elif ext == ".ogg":
-        return "ogg", OggVorbis(filepath)
-    elif ext == ".m4a":
-        return "mp4", MP4(filepath)
-    elif ext == ".wav":
-        return "wav", None  # skip metadata
-    else:
-        raise ValueError(f"loadMutagen - Unsupported format: {ext}")
-
-def mbReqRetry(func, retries=3):
-    for attempt in range(retries):
-        try:
-            return func()
-        except Exception as e:
-            if attempt == retries - 1:
-                print(f"MusicBrainz: Failed searching after {retries} attempts: {e}")
-                return None
-            time.sleep(2 * (attempt + 1))
-    return None
-
-def mbLookupRec(artist, title):
-    global _last_req_time
-
-    key = f"{artist.lower()}|{title.lower()}"
-
-    if key in _mb_cache:
-        print("MusicBrainz: Data found in cache!")
-        return _mb_cache[key]
-    
-    # Musicbrainz cooldown on requests
-    now = time.time()
-    elapsed = now - _last_req_time
-    if elapsed < MB_REQ_DELAY:
-        time.sleep(MB_REQ_DELAY - elapsed)
-
-    try:
-        result = mbReqRetry(lambda: mb.search_recordings(
-            recording=title,
-            artist=artist,
-            limit=10
-        ))
-        _last_req_time = time.time()
-    except Exception as e:
-        print(f"MusicBrainz: Failed to search recordings. {e}")
-        time.sleep(3)
-        return None
-    
-    if not result:
-        return None
-    
-    if not result["recording-list"]:
-        print("MusicBrainz: No record results.")
-        return None
-    
-    best = max(result["recording-list"], key=scoreRecordings)
-    
-    _mb_cache[key] = best
-    save_mb_cache(_mb_cache)
-    print("MusicBrainz: Data searched and saved in cache.")
-    return best
-
-def scoreRecordings(recording):
-    score = int(recording.get("score", 0))
-
-    # Bad scores go downnn
-    title = recording.get("title", "").lower()
-
-    bad_words = ["live", "remaster", "remastered", "edit", "radio edit", "version", "radio", "hits", "world tour"]
-    if any(word in title for word in bad_words):
-        score -= 20
-
-    # Good scores go uppp
-    if "release-list" in recording:
-        for rel in recording["release-list"]:
-            if rel.get("status") == "Official":
-                score += 10
-                break
-    return score
-
-def extractMetadata(recording):
-    album = None
-    year = None
-    genre = None
-
-    # Album and year
-    if "release-list" in recording:
-        releases = recording["release-list"]
-
-        # Filter for official albums
-        official_albums = [ r for r in releases if r.get("status") == "Official"
-                           and "release-group" in r and r["release-group"].get("primary-type") == "Album"]
-
-        if official_albums:
-            # Pick the earliest release
-            official_albums.sort(key=lambda r: r.get("date", "9999-99-99"))
-            release = official_albums[0]
+    new_art   = image_path.parent / f"{artist} - {title}{image_path.suffix.lower()}"
+
+    # Other workers may be renaming to the same target
+    with _fs_lock:
+        if audio_path == new_audio:
+            pass
+        elif audio_path.exists() and not new_audio.exists():
+            audio_path.rename(new_audio)
+            print(f"FILE RENAMING: Audio {audio_path.name} renamed to {new_audio.name}")
+            audio_path = new_audio
         else:
-            release = releases[0]
-
-        album = release.get("title")
-        date = release.get("date")
-        if date:
-            year = date[:4]
-
-    # For Genre
-    if "tag-list" in recording:
-        tags = sorted(
-            recording["tag-list"],
-            key=lambda t: int(t.get("count", 0)),
-            reverse=True
-        )
-        if tags:
-            genre = tags[0]["name"].title()
-
-    return album, year, genre
-   
+            print(f"FILE RENAMING: Audio named {new_audio.name} already exists! Skipped renaming.")
+
+        if image_path == new_art or not image_path.exists():
+            pass
+        elif image_path.exists() and not new_art.exists():
+            image_path.rename(new_art)
+            print(f"FILE RENAMING: Art {image_path.name} renamed to {new_art.name}")
+            image_path = new_art
+        else:
+            print(f"FILE RENAMING: Art named {new_art.name} already exists! Skipped renaming.")
+    return audio_path, image_path
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import pathlib as pl
+
+import sqliteCache as sc
+
+MANIFEST_DB = "manifest.sqlite"
+HASH_CHUNK = 1 << 20
+
+def fingerprint(*parts):
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+def contentHash(path: pl.Path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class SourceEntry:
+    def __init__(self, manifest, key, record):
+        self.manifest = manifest
+        self.key = key
+        self.record = record
+
+    @property
+    def output(self):
+        return self.outputFor(None)
+
+    @output.setter
+    def output(self, path):
+        self.setOutput(path)
+
+    def outputFor(self, profile=None):
+        # Multi-profile runs keep one output per profile name
+        output = self.record.get("outputs", {}).get(profile) if profile else self.record.get("output")
+        return pl.Path(output) if output else None
+
+    def setOutput(self, path, profile=None):
+        if profile:
+            self.record.setdefault("outputs", {})[profile] = str(path) if path else None
+        else:
+            self.record["output"] = str(path) if path else None
+        self.manifest.save(self)
+
+    def done(self, stage, fingerprint):
+        return self.record["stages"].get(stage, {}).get("fingerprint") == fingerprint
+
+    def result(self, stage, fingerprint, default=None):
+        if not self.done(stage, fingerprint):
+            return default
+        return self.record["stages"][stage].get("result", default)
+
+    def complete(self, stage, fingerprint, result=None):
+        self.record["stages"][stage] = {"fingerprint": fingerprint, "result": result}
+        self.manifest.save(self)
+
+    def invalidate(self, *stages):
+        for stage in stages:
+            self.record["stages"].pop(stage, None)
+        self.manifest.save(self)
+
+class Manifest:
+    # One record per source: size, mtime, content hash, last output path and which settings each stage ran with
+    def __init__(self, path=MANIFEST_DB, store=None):
+        # store: anything with get/put/close instead of the SQLite file (a distributed worker's job records)
+        self.store = store if store is not None else sc.SQLiteCache(path)
+
+    def entry(self, source: pl.Path):
+        source = pl.Path(source).resolve()
+        stat = source.stat()
+        record = self.store.get(str(source)) or {}
+
+        # Only hash when the cheap size/mtime check says the file was touched
+        if record.get("size") == stat.st_size and record.get("mtime_ns") == stat.st_mtime_ns:
+            digest = record["hash"]
+        else:
+            digest = contentHash(source)
+
+        if record.get("hash") != digest:
+            # New or changed source: nothing done before counts, but keep the old output so it gets overwritten in place
+            record = {"output": record.get("output"), "outputs": record.get("outputs", {}), "stages": {}}
+        record.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns, hash=digest)
+        return SourceEntry(self, str(source), record)
+
+    def isComplete(self, source: pl.Path, stage, fingerprint):
+        # stat-only check, no hashing
+        source = pl.Path(source).resolve()
+        record = self.store.get(str(source))
+        if not record:
+            return False
+        stat = source.stat()
+        return (record.get("size") == stat.st_size and record.get("mtime_ns") == stat.st_mtime_ns
+                and record["stages"].get(stage, {}).get("fingerprint") == fingerprint)
+
+    def save(self, entry: SourceEntry):
+        self.store.put(entry.key, entry.record)
+
+    def close(self):
+        self.store.close()
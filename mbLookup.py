@@ -0,0 +1,467 @@
+import collections
+import itertools
+import queue
+import re
+import threading
+import time
+import unicodedata
+from concurrent.futures import Future
+
+import runReport as rr
+import sqliteCache as sc
+
+MB_CACHE_FILE = "mb_cache.json"  # Legacy cache, migrated into MB_CACHE_DB on first run
+MB_CACHE_DB = "mb_cache.sqlite"
+MB_CACHE_TTL = None  # Seconds, None keeps entries forever
+MB_CACHE_MAX_ENTRIES = None
+MB_REQ_DELAY = 1.5
+MB_BATCH_SIZE = 8  # (artist, title) pairs per combined search, 1 sends one search per track
+MB_BATCH_RESULTS = 10  # Candidates asked for per pair, MusicBrainz returns at most 100 per search
+MB_UNCOLLECTED_MAX = 1000  # Resolved prefetches no worker has asked for yet that a LookupStage holds on to
+
+# Parts of a name that don't change which recording it is
+TOPIC_PATTERN = re.compile(r"\s+-\s+topic\s*$", re.IGNORECASE)
+FEAT_BRACKET_PATTERN = re.compile(r"\s*[\(\[](?:feat|ft|featuring)\b\.?[^\)\]]*[\)\]]", re.IGNORECASE)
+FEAT_PATTERN = re.compile(r"\s+(?:feat|ft|featuring)\b\.?\s[^\(\[]*", re.IGNORECASE)
+
+def load_mb_cache():
+    cache = sc.SQLiteCache(MB_CACHE_DB, ttl=MB_CACHE_TTL, max_entries=MB_CACHE_MAX_ENTRIES)
+    cache.migrateJson(MB_CACHE_FILE)
+    return cache
+
+def save_mb_cache(cache):
+    if cache is not None:
+        cache.flush()
+
+# Neither the client nor the cache is loaded at import time, the menu shouldn't wait on them
+_mb = None
+_mb_cache = None
+_mb_server = None
+_load_lock = threading.Lock()
+
+def mbClient():
+    global _mb
+    with _load_lock:
+        if _mb is None:
+            import musicbrainzngs as mb
+            mb.set_useragent(
+                "Col's Tags Getter",
+                "1.2",
+                "coltagsgetterman@hotmail.com"
+            )
+            # Requests are paced by our own token bucket, not by musicbrainzngs' blocking limiter
+            mb.set_rate_limit(False)
+            if _mb_server:
+                mb.set_hostname(*_mb_server)
+            _mb = mb
+        return _mb
+
+def mbCache():
+    # Opened on the first lookup, MB_CACHE_TTL / MB_CACHE_MAX_ENTRIES can be changed until then
+    global _mb_cache
+    with _load_lock:
+        if _mb_cache is None:
+            _mb_cache = load_mb_cache()
+        return _mb_cache
+
+def closeCache():
+    # The next mbCache() opens it again, e.g. after its file was deleted
+    global _mb_cache
+    with _load_lock:
+        if _mb_cache is not None:
+            _mb_cache.close()
+            _mb_cache = None
+
+def setServer(hostname, use_https=False):
+    # e.g. "localhost:5000" for the mbStandIn server
+    global _mb_server
+    _mb_server = (hostname, use_https)
+    if _mb is not None:
+        _mb.set_hostname(hostname, use_https=use_https)
+
+class TokenBucket:
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # Blocks until a token is available and returns the time spent waiting
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+_bucket = None
+
+def rateBucket():
+    # Built on the first request, MB_REQ_DELAY can be changed until then
+    global _bucket
+    with _load_lock:
+        if _bucket is None:
+            _bucket = TokenBucket(1 / MB_REQ_DELAY)
+        return _bucket
+
+def setRate(rate):
+    # Requests per second, e.g. for a local mirror that doesn't need MusicBrainz' pacing
+    global _bucket
+    with _load_lock:
+        _bucket = TokenBucket(rate)
+
+def cleanName(text):
+    # Drops featured artists and YouTube's " - Topic", this is what gets searched
+    cleaned = FEAT_PATTERN.sub(" ", FEAT_BRACKET_PATTERN.sub("", TOPIC_PATTERN.sub("", text or "")))
+    return " ".join(cleaned.split()) or (text or "").strip()
+
+def normalizeName(text):
+    # "Beyoncé feat. JAY-Z" -> "beyonce", "AC/DC" -> "ac dc": accents folded, case folded, punctuation dropped
+    text = unicodedata.normalize("NFKD", cleanName(text))
+    text = "".join(c for c in text if not unicodedata.combining(c)).casefold().replace("&", " and ")
+    return " ".join("".join(c if c.isalnum() else " " for c in text).split())
+
+def cacheKey(artist, title):
+    artist_key, title_key = normalizeName(artist), normalizeName(title)
+    if not title_key:
+        # Nothing but punctuation left, keep it as it was
+        return legacyKey(artist, title)
+    return f"{artist_key}|{title_key}"
+
+def legacyKey(artist, title):
+    return f"{artist.lower()}|{title.lower()}"
+
+def cachedRecording(artist, title):
+    cache = mbCache()
+    key = cacheKey(artist, title)
+    cached = cache.get(key)
+    if cached is None:
+        # Entries stored before keys were normalised
+        cached = cache.get(legacyKey(artist, title))
+        if cached is not None:
+            cache.put(key, cached)
+    return cached
+
+def lucenePhrase(text):
+    return cleanName(text).replace("\\", "\\\\").replace('"', '\\"')
+
+def batchQuery(pairs):
+    # One Lucene query for several tracks: (recording:"a" AND artist:"b") OR (...)
+    return " OR ".join(f'(recording:"{lucenePhrase(title)}" AND artist:"{lucenePhrase(artist)}")' for artist, title in pairs)
+
+def creditNames(recording):
+    # Normalised names a recording is credited to: the whole credit and every artist on it
+    names = [recording.get("artist-credit-phrase", "")]
+    names += [credit.get("artist", {}).get("name", credit.get("name", ""))
+              for credit in recording.get("artist-credit", []) if isinstance(credit, dict)]
+    return {normalizeName(name) for name in names if name} - {""}
+
+def recordingMatches(recording, artist, title):
+    # Which track of a combined search a result belongs to: the same title and an artist it is credited to.
+    # Whatever is picked is cached under the track's key, so near misses ("Love" for "Love Me Do") don't count.
+    if normalizeName(recording.get("title", "")) != normalizeName(title):
+        return False
+    wanted_artist = normalizeName(artist)
+    return not wanted_artist or wanted_artist in creditNames(recording)
+
+def mbReqRetry(func, retries=3):
+    for attempt in range(retries):
+        try:
+            rr.record("mb_rate_limit_wait", rateBucket().acquire())
+            with rr.stage("mb_request"):
+                return func()
+        except Exception as e:
+            if attempt == retries - 1:
+                print(f"MusicBrainz: Failed searching after {retries} attempts: {e}")
+                return None
+            with rr.stage("mb_retry_sleep"):
+                time.sleep(2 * (attempt + 1))
+    return None
+
+def mbLookupRec(artist, title):
+    key = cacheKey(artist, title)
+
+    cache = mbCache()
+    cached = cachedRecording(artist, title)
+    if cached is not None:
+        rr.count("mb_cache_hit")
+        print("MusicBrainz: Data found in cache!")
+        return cached
+    rr.count("mb_cache_miss")
+
+    try:
+        mb = mbClient()
+        result = mbReqRetry(lambda: mb.search_recordings(
+            recording=cleanName(title),
+            artist=cleanName(artist),
+            limit=10
+        ))
+    except Exception as e:
+        print(f"MusicBrainz: Failed to search recordings. {e}")
+        return None
+
+    if not result:
+        return None
+
+    if not result["recording-list"]:
+        print("MusicBrainz: No record results.")
+        return None
+
+    best = max(result["recording-list"], key=scoreRecordings)
+
+    cache.put(key, best)
+    print("MusicBrainz: Data searched and saved in cache.")
+    return best
+
+def mbLookupBatch(pairs):
+    # Resolves several (artist, title) pairs with one combined search, every track gets the best scoring
+    # recording among the results that match it. Tracks the combined search found nothing for are searched
+    # on their own. Returns {cacheKey: recording or None}
+    results = {}
+    pending = {}
+    for artist, title in pairs:
+        key = cacheKey(artist, title)
+        if key in results or key in pending:
+            continue
+        cached = cachedRecording(artist, title)
+        if cached is not None:
+            rr.count("mb_cache_hit")
+            results[key] = cached
+        else:
+            pending[key] = (artist, title)
+    if len(pending) < 2:
+        for key, (artist, title) in pending.items():
+            results[key] = mbLookupRec(artist, title)
+        return results
+
+    rr.count("mb_cache_miss", len(pending))
+    rr.count("mb_batch")
+    try:
+        mb = mbClient()
+        result = mbReqRetry(lambda: mb.search_recordings(
+            query=batchQuery(pending.values()),
+            limit=min(100, MB_BATCH_RESULTS * len(pending))
+        ))
+    except Exception as e:
+        print(f"MusicBrainz: Failed to search recordings. {e}")
+        result = None
+    candidates = result["recording-list"] if result else []
+
+    cache = mbCache()
+    for key, (artist, title) in pending.items():
+        matched = [recording for recording in candidates if recordingMatches(recording, artist, title)]
+        if not matched:
+            rr.count("mb_batch_fallback")
+            results[key] = mbLookupRec(artist, title)
+            continue
+        best = max(matched, key=scoreRecordings)
+        cache.put(key, best)
+        results[key] = best
+    print(f"MusicBrainz: {len(pending)} tracks searched in one request and saved in cache.")
+    return results
+
+class OnlineProvider:
+    # The MusicBrainz web service, paced by the token bucket and backed by the SQLite cache.
+    # Providers answer lookup(artist, title) -> recording or None and lookupMany(pairs) -> {cacheKey: recording}
+    name = "online"
+
+    def lookup(self, artist, title):
+        return mbLookupRec(artist, title)
+
+    def lookupMany(self, pairs):
+        return mbLookupBatch(pairs)
+
+    def flush(self):
+        save_mb_cache(_mb_cache)
+
+    def close(self):
+        self.flush()
+
+_provider = OnlineProvider()
+
+def setProvider(provider):
+    # e.g. mbOffline.OfflineProvider for air-gapped runs
+    global _provider
+    _provider = provider
+
+def lookup(artist, title):
+    return _provider.lookup(artist, title)
+
+class LookupStage:
+    # Runs MusicBrainz lookups on a dedicated thread so rate-limit waits never block the encoders.
+    # Keys are prefetched for the whole batch up front; a worker that needs a key that is
+    # still queued bumps it to the front. A future is dropped once a worker has its result; results nobody
+    # asked for (e.g. the file turned out unchanged) are kept up to MB_UNCOLLECTED_MAX, oldest dropped first.
+    URGENT = 0
+    PREFETCH = 1
+
+    def __init__(self):
+        self.futures = {}
+        self.uncollected = collections.OrderedDict()
+        self.queue = queue.PriorityQueue()
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name="mb-lookup", daemon=True)
+        self.thread.start()
+
+    def submit(self, artist, title, priority=PREFETCH):
+        key = cacheKey(artist, title)
+        with self.lock:
+            future = self.futures.get(key)
+            if future is None:
+                future = Future()
+                self.futures[key] = future
+            elif future.done() or priority != self.URGENT:
+                return future
+            self.queue.put((priority, next(self.counter), key, artist, title))
+        return future
+
+    def prefetch(self, items, readKey):
+        # readKey(item) -> (artist, title) or None; runs in the background so scanning tags doesn't delay the batch
+        def feed():
+            for item in items:
+                if self.closed:
+                    return
+                try:
+                    key = readKey(item)
+                except Exception:
+                    continue
+                if key:
+                    self.submit(*key)
+        threading.Thread(target=feed, name="mb-prefetch", daemon=True).start()
+
+    def lookup(self, artist, title):
+        # Time a worker actually spends blocked on MusicBrainz
+        with rr.stage("mb_wait"):
+            future = self.submit(artist, title, priority=self.URGENT)
+            try:
+                return future.result()
+            finally:
+                # Collected: looking the key up again goes through the cache
+                key = cacheKey(artist, title)
+                with self.lock:
+                    if self.futures.get(key) is future:
+                        del self.futures[key]
+                    self.uncollected.pop(key, None)
+
+    def resolved(self, keys):
+        with self.lock:
+            for key in keys:
+                if key in self.futures:
+                    self.uncollected[key] = None
+                    self.uncollected.move_to_end(key)
+            while len(self.uncollected) > MB_UNCOLLECTED_MAX:
+                key, _ = self.uncollected.popitem(last=False)
+                future = self.futures.get(key)
+                if future is not None and future.done():
+                    del self.futures[key]
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            if batch[0][2] is None:
+                return
+            # Whatever else is queued by now goes into the same combined search
+            while len(batch) < MB_BATCH_SIZE:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item[2] is None:
+                    self.queue.put(item)
+                    break
+                batch.append(item)
+
+            claimed = []
+            for _, _, key, artist, title in batch:
+                with self.lock:
+                    # Urgent re-queues leave a stale entry behind, its future may be collected and gone by now
+                    future = self.futures.get(key)
+                    if future is None or future.running() or future.done():
+                        continue
+                    future.set_running_or_notify_cancel()
+                claimed.append((key, artist, title, future))
+            if not claimed:
+                continue
+            try:
+                if len(claimed) == 1:
+                    results = {claimed[0][0]: _provider.lookup(*claimed[0][1:3])}
+                else:
+                    results = _provider.lookupMany([(artist, title) for _, artist, title, _ in claimed])
+                for key, _, _, future in claimed:
+                    future.set_result(results.get(key))
+            except Exception as e:
+                for _, _, _, future in claimed:
+                    if not future.done():
+                        future.set_exception(e)
+            self.resolved([key for key, _, _, _ in claimed])
+
+    def close(self):
+        self.closed = True
+        self.queue.put((self.URGENT - 1, next(self.counter), None, None, None))
+        self.thread.join()
+        _provider.flush()
+
+def scoreRecordings(recording):
+    score = int(recording.get("ext:score", recording.get("score", 0)))
+
+    # Bad scores go downnn
+    title = recording.get("title", "").lower()
+
+    bad_words = ["live", "remaster", "remastered", "edit", "radio edit", "version", "radio", "hits", "world tour"]
+    if any(word in title for word in bad_words):
+        score -= 20
+
+    # Good scores go uppp
+    if "release-list" in recording:
+        for rel in recording["release-list"]:
+            if rel.get("status") == "Official":
+                score += 10
+                break
+    return score
+
+def extractMetadata(recording):
+    album = None
+    year = None
+    genre = None
+
+    # Album and year
+    if "release-list" in recording:
+        releases = recording["release-list"]
+
+        # Filter for official albums
+        official_albums = [ r for r in releases if r.get("status") == "Official"
+                           and "release-group" in r and r["release-group"].get("primary-type") == "Album"]
+
+        if official_albums:
+            # Pick the earliest release
+            official_albums.sort(key=lambda r: r.get("date", "9999-99-99"))
+            release = official_albums[0]
+        else:
+            release = releases[0]
+
+        album = release.get("title")
+        date = release.get("date")
+        if date:
+            year = date[:4]
+
+    # For Genre
+    if "tag-list" in recording:
+        tags = sorted(
+            recording["tag-list"],
+            key=lambda t: int(t.get("count", 0)),
+            reverse=True
+        )
+        if tags:
+            genre = tags[0]["name"].title()
+
+    return album, year, genre
@@ -0,0 +1,259 @@
+import argparse
+import json
+import pathlib as pl
+import sqlite3
+import tarfile
+import threading
+import time
+
+import mbLookup as mbl
+import runReport as rr
+
+# Offline MusicBrainz: the recordings, releases, release groups and tags the tagger needs, imported from
+# the MusicBrainz JSON dumps (https://data.metabrainz.org/pub/musicbrainz/data/json-dumps/) into an
+# indexed SQLite file. Lookups answer with the same dict shape musicbrainzngs.search_recordings returns,
+# so scoreRecordings and extractMetadata don't know the difference.
+#
+#   python mbOffline.py import recording.tar.xz release.tar.xz --db mb_offline.sqlite
+#   python main.py --mb-offline mb_offline.sqlite
+#
+# Dumps can be the .tar.xz archives as downloaded (mbdump/recording, mbdump/release inside) or the
+# extracted JSON lines files. Either one alone works: releases carry their tracks' recordings, recordings
+# carry their tags (and releases, when the dump includes them).
+
+MB_OFFLINE_DB = "mb_offline.sqlite"
+IMPORT_BATCH = 5000
+EXACT_SCORE = 100  # ext:score given to an exact artist and title match
+PARTIAL_SCORE = 90  # The artist is one of several credited, not the whole credit
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS recording ("
+    "id TEXT PRIMARY KEY, title TEXT NOT NULL, credit TEXT NOT NULL, artist_key TEXT NOT NULL, title_key TEXT NOT NULL, tags TEXT)",
+    "CREATE TABLE IF NOT EXISTS release_group (id TEXT PRIMARY KEY, title TEXT, primary_type TEXT)",
+    "CREATE TABLE IF NOT EXISTS release (id TEXT PRIMARY KEY, title TEXT, status TEXT, date TEXT, release_group TEXT)",
+    "CREATE TABLE IF NOT EXISTS recording_release (recording TEXT NOT NULL, release TEXT NOT NULL, PRIMARY KEY (recording, release)) WITHOUT ROWID",
+]
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS recording_key ON recording(title_key, artist_key)",
+]
+
+def creditPhrase(credit):
+    return "".join(c.get("name", c.get("artist", {}).get("name", "")) + c.get("joinphrase", "") for c in credit)
+
+def dumpLines(path, entity):
+    # JSON documents of one entity from a dump archive (mbdump/<entity>) or a JSON lines file
+    path = pl.Path(path)
+    if tarfile.is_tarfile(path):
+        with tarfile.open(path, "r|*") as archive:
+            for member in archive:
+                if member.isfile() and pl.PurePosixPath(member.name).name == entity:
+                    for line in archive.extractfile(member):
+                        if line.strip():
+                            yield json.loads(line)
+        return
+    with open(path, "rb") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def dumpEntity(path):
+    # "recording" or "release", from the archive member or the file name
+    path = pl.Path(path)
+    if tarfile.is_tarfile(path):
+        with tarfile.open(path, "r|*") as archive:
+            for member in archive:
+                name = pl.PurePosixPath(member.name).name
+                if member.isfile() and name in ("recording", "release"):
+                    return name
+        return None
+    name = path.name.split(".")[0]
+    return name if name in ("recording", "release") else None
+
+class OfflineImporter:
+    # Writes dump documents into the store in large transactions; indexes are built once at the end
+    def __init__(self, db_path=MB_OFFLINE_DB):
+        self.conn = sqlite3.connect(str(db_path))
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=OFF")
+        for statement in SCHEMA:
+            self.conn.execute(statement)
+        self.rows = {"recording": [], "release_group": [], "release": [], "recording_release": []}
+        self.counts = {"recordings": 0, "releases": 0}
+
+    def addRecording(self, recording, tags=True):
+        credit = [c for c in recording.get("artist-credit", []) if isinstance(c, dict)]
+        artist = creditPhrase(credit)
+        tag_list = (recording.get("tags") or recording.get("tag-list")) if tags else None
+        self.rows["recording"].append((
+            recording["id"], recording.get("title", ""), json.dumps(credit, ensure_ascii=False),
+            mbl.normalizeName(artist), mbl.normalizeName(recording.get("title", "")),
+            json.dumps([{"name": t["name"], "count": str(t.get("count", 0))} for t in tag_list], ensure_ascii=False) if tag_list else None
+        ))
+        self.counts["recordings"] += 1
+        for release in recording.get("releases", []):
+            self.addRelease(release)
+            self.rows["recording_release"].append((recording["id"], release["id"]))
+        self.flushIfFull()
+
+    def addRelease(self, release, tracks=False):
+        group = release.get("release-group") or {}
+        if group.get("id"):
+            self.rows["release_group"].append((group["id"], group.get("title"), group.get("primary-type")))
+        self.rows["release"].append((release["id"], release.get("title"), release.get("status"),
+                                     release.get("date"), group.get("id")))
+        self.counts["releases"] += 1
+        if tracks:
+            for medium in release.get("media", []):
+                for track in medium.get("tracks", []):
+                    recording = track.get("recording")
+                    if recording and recording.get("id"):
+                        if not recording.get("artist-credit") and track.get("artist-credit"):
+                            recording = {**recording, "artist-credit": track["artist-credit"]}
+                        # Tags only come with the recording dump, don't wipe them
+                        self.addRecording(recording, tags=False)
+                        self.rows["recording_release"].append((recording["id"], release["id"]))
+        self.flushIfFull()
+
+    def flushIfFull(self):
+        if len(self.rows["recording"]) + len(self.rows["release"]) >= IMPORT_BATCH:
+            self.flush()
+
+    def flush(self):
+        with self.conn:
+            # A recording seen in both dumps keeps the tags it was imported with
+            self.conn.executemany(
+                "INSERT INTO recording (id, title, credit, artist_key, title_key, tags) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET title = excluded.title, credit = excluded.credit, artist_key = excluded.artist_key, "
+                "title_key = excluded.title_key, tags = COALESCE(excluded.tags, recording.tags)",
+                self.rows["recording"])
+            self.conn.executemany("INSERT OR REPLACE INTO release_group VALUES (?, ?, ?)", self.rows["release_group"])
+            self.conn.executemany("INSERT OR REPLACE INTO release VALUES (?, ?, ?, ?, ?)", self.rows["release"])
+            self.conn.executemany("INSERT OR IGNORE INTO recording_release VALUES (?, ?)", self.rows["recording_release"])
+        for rows in self.rows.values():
+            rows.clear()
+
+    def importDump(self, path):
+        entity = dumpEntity(path)
+        if entity is None:
+            raise ValueError(f"{path} is neither a recording nor a release dump")
+        start = time.monotonic()
+        before = dict(self.counts)
+        for document in dumpLines(path, entity):
+            if entity == "recording":
+                self.addRecording(document)
+            else:
+                self.addRelease(document, tracks=True)
+        self.flush()
+        print(f"MB OFFLINE: Imported {pl.Path(path).name}: {self.counts['recordings'] - before['recordings']} recordings, "
+              f"{self.counts['releases'] - before['releases']} releases in {time.monotonic() - start:.1f}s")
+
+    def close(self):
+        self.flush()
+        for statement in INDEXES:
+            self.conn.execute(statement)
+        self.conn.execute("ANALYZE")
+        self.conn.commit()
+        self.conn.close()
+
+class OfflineProvider:
+    # Same interface as mbLookup.OnlineProvider, answered from the local store with no rate limit
+    name = "offline"
+
+    def __init__(self, db_path=MB_OFFLINE_DB):
+        path = pl.Path(db_path)
+        if not path.exists():
+            raise FileNotFoundError(f"Offline MusicBrainz store {path} not found, import one with mbOffline.py import")
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(f"{path.resolve().as_uri()}?mode=ro", uri=True, check_same_thread=False)
+
+    def candidates(self, artist, title):
+        title_key = mbl.normalizeName(title)
+        artist_key = mbl.normalizeName(artist)
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id, title, credit, artist_key, tags FROM recording WHERE title_key = ?", (title_key,)
+            ).fetchall()
+            rows = [row for row in rows if not artist_key or artist_key == row[3]
+                    or artist_key in mbl.creditNames({"artist-credit": json.loads(row[2])})]
+            if not rows:
+                return []
+            releases = {}
+            marks = ",".join("?" * len(rows))
+            for recording_id, release_id, release_title, status, date, group_id, primary_type in self.conn.execute(
+                "SELECT rr.recording, r.id, r.title, r.status, r.date, g.id, g.primary_type FROM recording_release rr "
+                "JOIN release r ON r.id = rr.release LEFT JOIN release_group g ON g.id = r.release_group "
+                f"WHERE rr.recording IN ({marks})", [row[0] for row in rows]
+            ):
+                release = {"id": release_id, "title": release_title}
+                if status:
+                    release["status"] = status
+                if date:
+                    release["date"] = date
+                if group_id:
+                    release["release-group"] = {"id": group_id, "primary-type": primary_type} if primary_type else {"id": group_id}
+                releases.setdefault(recording_id, []).append(release)
+
+        recordings = []
+        for recording_id, found_title, credit, found_artist, tags in rows:
+            credit = json.loads(credit)
+            recording = {
+                "id": recording_id,
+                "ext:score": str(EXACT_SCORE if found_artist == artist_key else PARTIAL_SCORE),
+                "title": found_title,
+                "artist-credit": credit,
+                "artist-credit-phrase": creditPhrase(credit),
+            }
+            if recording_id in releases:
+                recording["release-list"] = releases[recording_id]
+            if tags:
+                recording["tag-list"] = json.loads(tags)
+            recordings.append(recording)
+        return recordings
+
+    def lookup(self, artist, title):
+        with rr.stage("mb_offline"):
+            recordings = self.candidates(artist, title)
+        if not recordings:
+            rr.count("mb_offline_miss")
+            print("MusicBrainz (offline): No record results.")
+            return None
+        rr.count("mb_offline_hit")
+        print("MusicBrainz (offline): Data found in local store.")
+        return max(recordings, key=mbl.scoreRecordings)
+
+    def lookupMany(self, pairs):
+        return {mbl.cacheKey(artist, title): self.lookup(artist, title) for artist, title in pairs}
+
+    def flush(self):
+        pass
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline MusicBrainz store")
+    commands = parser.add_subparsers(dest="command", required=True)
+    importer = commands.add_parser("import", help="import MusicBrainz JSON dumps")
+    importer.add_argument("dumps", nargs="+", help="recording/release dump archives or JSON lines files")
+    importer.add_argument("--db", default=MB_OFFLINE_DB)
+    search = commands.add_parser("lookup", help="look up one track")
+    search.add_argument("artist")
+    search.add_argument("title")
+    search.add_argument("--db", default=MB_OFFLINE_DB)
+    args = parser.parse_args()
+
+    if args.command == "import":
+        store = OfflineImporter(args.db)
+        for dump in args.dumps:
+            store.importDump(dump)
+        store.close()
+    else:
+        provider = OfflineProvider(args.db)
+        start = time.perf_counter()
+        recording = provider.lookup(args.artist, args.title)
+        elapsed = time.perf_counter() - start
+        print(json.dumps(recording, indent=2, ensure_ascii=False))
+        if recording:
+            print(mbl.extractMetadata(recording))
+        print(f"MB OFFLINE: {elapsed * 1000:.2f} ms")
@@ -0,0 +1,168 @@
+import argparse
+import hashlib
+import json
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape, quoteattr
+
+# Local stand-in for the MusicBrainz /ws/2/recording search, answering the XML that
+# musicbrainzngs.search_recordings parses. Point the converter at it with --mb-server.
+#
+#   python mbStandIn.py --port 5000 --fixtures recordings.json
+#
+# Fixtures map "artist|title" (lowercase) to a list of recordings in musicbrainzngs' dict
+# shape. Queries without a fixture get one generated, deterministic recording.
+
+TERM_RE = re.compile(r'(recording|artist):(?:\(((?:\\.|[^\\)])*)\)|"((?:\\.|[^\\"])*)")')
+
+def parseQuery(query):
+    # Returns the (artist, title) pairs of a Lucene recording query, in query order
+    pairs = []
+    current = {}
+    for field, group, quoted in TERM_RE.findall(query):
+        value = re.sub(r"\\(.)", r"\1", group or quoted).strip().lower()
+        if field in current:
+            pairs.append(current)
+            current = {}
+        current[field] = value
+    if current:
+        pairs.append(current)
+    return [(pair.get("artist", ""), pair.get("recording", "")) for pair in pairs]
+
+def generatedRecording(artist, title):
+    return {
+        "id": "standin-" + hashlib.md5(f"{artist}|{title}".encode("utf-8")).hexdigest(),
+        "ext:score": "100",
+        "title": title,
+        "artist-credit": [{"name": artist, "artist": {"id": "standin-artist", "name": artist}}],
+        "release-list": [{
+            "id": "standin-release",
+            "title": f"{artist.title()} Album",
+            "status": "Official",
+            "date": "2000-01-01",
+            "release-group": {"id": "standin-group", "primary-type": "Album"},
+        }],
+        "tag-list": [{"name": "rock", "count": "1"}],
+    }
+
+def recordingXml(recording):
+    parts = [f'<recording id={quoteattr(recording.get("id", ""))} ext:score={quoteattr(str(recording.get("ext:score", "100")))}>']
+    parts.append(f"<title>{escape(recording.get('title', ''))}</title>")
+    credits = [c for c in recording.get("artist-credit", []) if isinstance(c, dict)]
+    if credits:
+        parts.append("<artist-credit>")
+        for credit in credits:
+            artist = credit.get("artist", {})
+            parts.append(f'<name-credit><artist id={quoteattr(artist.get("id", ""))}>'
+                         f'<name>{escape(artist.get("name", credit.get("name", "")))}</name></artist></name-credit>')
+        parts.append("</artist-credit>")
+    releases = recording.get("release-list", [])
+    if releases:
+        parts.append(f'<release-list count="{len(releases)}">')
+        for release in releases:
+            parts.append(f'<release id={quoteattr(release.get("id", ""))}><title>{escape(release.get("title", ""))}</title>')
+            if release.get("status"):
+                parts.append(f"<status>{escape(release['status'])}</status>")
+            if release.get("date"):
+                parts.append(f"<date>{escape(release['date'])}</date>")
+            group = release.get("release-group")
+            if group:
+                primary = group.get("primary-type", "")
+                parts.append(f'<release-group id={quoteattr(group.get("id", ""))} type={quoteattr(primary)}>'
+                             f"<primary-type>{escape(primary)}</primary-type></release-group>")
+            parts.append("</release>")
+        parts.append("</release-list>")
+    tags = recording.get("tag-list", [])
+    if tags:
+        parts.append("<tag-list>")
+        for tag in tags:
+            parts.append(f'<tag count={quoteattr(str(tag.get("count", 0)))}><name>{escape(tag.get("name", ""))}</name></tag>')
+        parts.append("</tag-list>")
+    parts.append("</recording>")
+    return "".join(parts)
+
+def searchXml(recordings):
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<metadata xmlns="http://musicbrainz.org/ns/mmd-2.0#" xmlns:ext="http://musicbrainz.org/ns/ext#-2.0">'
+            f'<recording-list count="{len(recordings)}" offset="0">'
+            + "".join(recordingXml(r) for r in recordings) +
+            "</recording-list></metadata>")
+
+class StandInServer:
+    def __init__(self, port=0, fixtures=None, delay=0.0, generate=True):
+        self.fixtures = {k.lower(): v for k, v in (fixtures or {}).items()}
+        self.delay = delay
+        self.generate = generate
+        self.requests = 0
+        self.queries = []
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urllib.parse.urlsplit(self.path)
+                if not url.path.rstrip("/").endswith("/ws/2/recording"):
+                    self.send_error(404)
+                    return
+                args = urllib.parse.parse_qs(url.query)
+                query = args.get("query", [""])[0]
+                limit = int(args.get("limit", ["25"])[0])
+                body = searchXml(server.search(query)[:limit]).encode("utf-8")
+                if server.delay:
+                    time.sleep(server.delay)
+                self.send_response(200)
+                self.send_header("Content-Type", "application/xml; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.port = self.httpd.server_address[1]
+        self.thread = None
+
+    @property
+    def hostname(self):
+        return f"127.0.0.1:{self.port}"
+
+    def search(self, query):
+        with self.lock:
+            self.requests += 1
+            self.queries.append(query)
+        recordings = []
+        for artist, title in parseQuery(query):
+            found = self.fixtures.get(f"{artist}|{title}")
+            if found is None and self.generate and artist and title:
+                found = [generatedRecording(artist, title)]
+            recordings.extend(found or [])
+        return recordings
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="mb-standin", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the MusicBrainz recording search")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--fixtures", help="JSON file mapping 'artist|title' to recording lists")
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds of simulated latency per request")
+    parser.add_argument("--no-generate", action="store_true", help="answer unknown queries with no results")
+    args = parser.parse_args()
+
+    fixtures = json.loads(open(args.fixtures, encoding="utf-8").read()) if args.fixtures else None
+    server = StandInServer(args.port, fixtures, args.delay, generate=not args.no_generate)
+    print(f"MusicBrainz stand-in listening on {server.hostname}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
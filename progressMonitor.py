@@ -0,0 +1,412 @@
+import json
+import os
+import pathlib as pl
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import costModel as cm
+
+# Live progress of a batch. Every ffmpeg process writes -progress blocks to its stderr, they are picked out
+# of the error output as it is read and move the position of the task running it. A printer thread shows
+# what each worker is on, the throughput in audio seconds per second and an ETA; the same snapshot goes to
+# a metrics file (--metrics) and an HTTP endpoint (--metrics-port) for monitoring.
+
+PROGRESS_INTERVAL = 5.0  # Seconds between live progress lines, 0 turns them off
+STATS_PERIOD = 0.5  # Seconds between ffmpeg's progress blocks
+RATE_WINDOW = 30.0  # Throughput, and with it the ETA, is taken over this many recent seconds
+STALE_SECONDS = 30.0  # A worker's metrics file not updated for this long is from a worker that is gone
+METRICS_HOST = "127.0.0.1"
+PROGRESS_KEYS = {b"frame", b"fps", b"bitrate", b"total_size", b"out_time_us", b"out_time_ms", b"out_time",
+                 b"dup_frames", b"drop_frames", b"speed", b"progress"}
+PROGRESS_LINE = re.compile(rb"^([a-z0-9_]+)=(.*?)\s*$")
+
+def fileKey(path):
+    return os.path.normcase(os.path.abspath(str(path)))
+
+def clock(seconds):
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    return f"{hours}:{rest // 60:02d}:{rest % 60:02d}" if hours else f"{rest // 60}:{rest % 60:02d}"
+
+def span(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    return f"{seconds // 60}m{seconds % 60:02d}s" if seconds >= 60 else f"{seconds}s"
+
+class Task:
+    # One ffmpeg process (or a stage without one, like Pillow artwork) working on a file. Counted tasks are
+    # the passes that get the audio done (encode, segments), their position adds to the throughput.
+    def __init__(self, key, name, stage, duration, counted):
+        self.key = key
+        self.name = name
+        self.stage = stage
+        self.duration = duration
+        self.counted = counted
+        self.worker = threading.current_thread().name
+        self.started = time.monotonic()
+        self.position = 0.0
+        self.speed = None
+
+    def update(self, key, value):
+        try:
+            if key == b"out_time_us":
+                self.position = max(0.0, int(value) / 1e6)
+            elif key == b"speed":
+                self.speed = float(value.rstrip(b"x"))
+        except ValueError:
+            pass  # "N/A" until the first packet is out
+
+    def row(self, now):
+        speed = self.speed
+        if speed is None and self.position and now > self.started:
+            speed = self.position / (now - self.started)
+        return {"worker": self.worker, "file": self.name, "stage": self.stage, "position": round(self.position, 3),
+                "duration": round(self.duration, 3) if self.duration else None,
+                "speed": round(speed, 2) if speed is not None else None}
+
+class FileProgress:
+    def __init__(self, duration):
+        self.duration = duration
+        self.processed = 0.0  # Audio seconds of its finished counted tasks
+        self.running = False
+
+class Monitor:
+    # queue: callable returning {"pending": n, "leased": n} when the files wait in a job queue elsewhere
+    # remote: callable returning {worker: snapshot} of workers on other nodes, merged into this one
+    def __init__(self, interval=PROGRESS_INTERVAL, metrics=None, address=None, queue=None, remote=None):
+        self.interval = interval
+        self.metrics = pl.Path(metrics) if metrics else None
+        self.queue = queue
+        self.remote = remote
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.files = {}  # Unfinished files, key -> FileProgress
+        self.tasks = set()
+        self.remotes = {}
+        self.known = 0
+        self.done = 0
+        self.failed = 0
+        self.total_audio = 0.0
+        self.settled_audio = 0.0  # Durations of finished files, processed or skipped
+        self.work_done = 0.0  # Audio seconds processed by the finished files
+        self.samples = deque([(self.started, 0.0)])
+        self.stopping = threading.Event()
+        self.server = serve(self, address) if address else None
+        self.thread = None
+        if interval or self.metrics or remote:
+            self.thread = threading.Thread(target=self.run, name="progress", daemon=True)
+            self.thread.start()
+
+    def queued(self, path, duration=None):
+        key = fileKey(path)
+        with self.lock:
+            if key in self.files:
+                return
+        if duration is None:
+            duration = cm.probeDuration(path)
+        with self.lock:
+            if key not in self.files:
+                self.files[key] = FileProgress(duration)
+                self.known += 1
+                self.total_audio += duration
+
+    def running(self, path):
+        self.queued(path)
+        with self.lock:
+            self.files[fileKey(path)].running = True
+
+    def finished(self, path, ok=True):
+        with self.lock:
+            progress = self.files.pop(fileKey(path), None)
+            if progress is None:
+                return
+            self.done += 1
+            self.failed += not ok
+            self.settled_audio += progress.duration
+            self.work_done += min(progress.duration, progress.processed)
+
+    def add(self, task):
+        with self.lock:
+            self.tasks.add(task)
+
+    def remove(self, task):
+        with self.lock:
+            self.tasks.discard(task)
+            progress = self.files.get(task.key)
+            if task.counted and progress:
+                progress.processed += task.position
+
+    def duration(self, key):
+        with self.lock:
+            progress = self.files.get(key)
+            return progress.duration if progress else None
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self.lock:
+            positions = {}
+            for task in self.tasks:
+                if task.counted:
+                    positions[task.key] = positions.get(task.key, 0.0) + task.position
+            rows = sorted((task.row(now) for task in self.tasks), key=lambda row: row["worker"])
+            active = sum(min(progress.duration, progress.processed + positions.get(key, 0.0))
+                         for key, progress in self.files.items())
+            running = sum(1 for progress in self.files.values() if progress.running)
+            queued = len(self.files) - running
+            processed = self.work_done + active
+            remaining = self.total_audio - self.settled_audio - active
+            files = {"total": self.known, "done": self.done, "failed": self.failed}
+        # Workers on other nodes: their processed audio counts even after they are gone, their rows only while
+        # they are still reporting
+        for worker, remote in sorted(self.remotes.items()):
+            processed += remote["audio_seconds"]["processed"]
+            if not remote.get("stale"):
+                remaining -= remote["audio_seconds"]["active"]
+                rows += [{**row, "worker": f"{worker}/{row['worker']}"} for row in remote["workers"]]
+        if self.queue:
+            counts = self.queue()
+            queued, running = counts["pending"], counts["leased"]
+        with self.lock:
+            if now - self.samples[-1][0] >= 1.0:
+                self.samples.append((now, processed))
+            while len(self.samples) > 2 and self.samples[1][0] <= now - RATE_WINDOW:
+                self.samples.popleft()
+            since, before = self.samples[0]
+        rate = (processed - before) / (now - since) if now - since >= 1.0 else None
+        remaining = max(0.0, remaining)
+        return {
+            "time": time.time(),
+            "elapsed": round(now - self.started, 3),
+            "files": {**files, "running": running, "queued": queued},
+            "audio_seconds": {"total": round(self.total_audio, 3), "processed": round(processed, 3),
+                              "active": round(active, 3), "remaining": round(remaining, 3)},
+            "rate": round(rate, 3) if rate is not None else None,
+            "eta": round(remaining / rate, 1) if rate else None,
+            "workers": rows,
+        }
+
+    def printProgress(self, snapshot):
+        files = snapshot["files"]
+        if not files["running"] and not files["queued"]:
+            return  # Idle (a watched folder), nothing to report
+        rate = f"{snapshot['rate']:.1f} audio-s/s" if snapshot["rate"] is not None else "measuring throughput"
+        eta = f", ETA {span(snapshot['eta'])}" if snapshot["eta"] is not None else ""
+        print(f"PROGRESS: {files['done']} / {files['total']} files done, {files['running']} running, "
+              f"{files['queued']} queued; {rate}{eta}")
+        for row in snapshot["workers"]:
+            position = clock(row["position"])
+            if row["duration"]:
+                position += f" / {clock(row['duration'])} ({min(100.0, row['position'] / row['duration'] * 100):.0f}%)"
+            speed = f" at {row['speed']:.1f}x" if row["speed"] else ""
+            print(f"PROGRESS:   {row['worker']:<12} {row['file']}: {row['stage']} {position}{speed}")
+
+    def run(self):
+        tick = self.interval or PROGRESS_INTERVAL
+        while not self.stopping.wait(tick):
+            if self.remote:
+                try:
+                    self.remotes = self.remote()
+                except OSError:
+                    pass
+            snapshot = self.snapshot()
+            if self.interval:
+                self.printProgress(snapshot)
+            if self.metrics:
+                writeMetrics(self.metrics, snapshot)
+
+    def close(self):
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+        snapshot = self.snapshot()
+        if self.metrics:
+            writeMetrics(self.metrics, snapshot)
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        return snapshot
+
+def writeMetrics(path: pl.Path, snapshot):
+    # JSON, or the Prometheus text format for a .prom file (node_exporter's textfile collector)
+    text = prometheus(snapshot) if path.suffix == ".prom" else json.dumps(snapshot)
+    temp = path.with_name(f".{path.name}.tmp")
+    try:
+        temp.write_text(text, encoding="utf-8")
+        os.replace(temp, path)
+    except OSError as e:
+        print(f"PROGRESS: Could not write metrics to {path}: {e}")
+
+def prometheus(snapshot):
+    def label(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    def value(number):
+        return "NaN" if number is None else f"{number:g}"
+
+    lines = ["# HELP batch_files Files of the batch by state.", "# TYPE batch_files gauge"]
+    lines += [f'batch_files{{state="{state}"}} {count}' for state, count in snapshot["files"].items()]
+    lines += ["# HELP batch_audio_seconds Seconds of audio in the batch: total, processed, active (in files being worked on) and remaining.",
+              "# TYPE batch_audio_seconds gauge"]
+    lines += [f'batch_audio_seconds{{kind="{kind}"}} {value(seconds)}' for kind, seconds in snapshot["audio_seconds"].items()]
+    lines += ["# HELP batch_throughput_audio_seconds Audio seconds processed per second of wall time.",
+              "# TYPE batch_throughput_audio_seconds gauge", f"batch_throughput_audio_seconds {value(snapshot['rate'])}",
+              "# HELP batch_eta_seconds Estimated seconds until the files known so far are done.",
+              "# TYPE batch_eta_seconds gauge", f"batch_eta_seconds {value(snapshot['eta'])}",
+              "# HELP batch_worker_position_seconds Position of each running ffmpeg task in its file.",
+              "# TYPE batch_worker_position_seconds gauge"]
+    labels = [f'worker="{label(row["worker"])}",file="{label(row["file"])}",stage="{label(row["stage"])}"' for row in snapshot["workers"]]
+    lines += [f"batch_worker_position_seconds{{{labels}}} {value(row['position'])}" for labels, row in zip(labels, snapshot["workers"])]
+    lines += ["# HELP batch_worker_speed Real-time speed factor of each running ffmpeg task.", "# TYPE batch_worker_speed gauge"]
+    lines += [f"batch_worker_speed{{{labels}}} {value(row['speed'])}" for labels, row in zip(labels, snapshot["workers"])]
+    return "\n".join(lines) + "\n"
+
+def serve(monitor, address):
+    # "[host:]port": /metrics in the Prometheus text format, /metrics.json (or /) the snapshot as JSON
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    host, _, port = str(address).rpartition(":")
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split("?")[0]
+            if path == "/metrics":
+                body, content_type = prometheus(monitor.snapshot()), "text/plain; version=0.0.4"
+            elif path in ("/", "/metrics.json"):
+                body, content_type = json.dumps(monitor.snapshot()), "application/json"
+            else:
+                self.send_error(404)
+                return
+            body = body.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer((host or METRICS_HOST, int(port)), Handler)
+    threading.Thread(target=httpd.serve_forever, name="metrics-server", daemon=True).start()
+    print(f"PROGRESS: Metrics served on http://{host or METRICS_HOST}:{httpd.server_address[1]}/metrics")
+    return httpd
+
+_monitor = None
+_local = threading.local()
+
+def start(interval=PROGRESS_INTERVAL, metrics=None, address=None, queue=None, remote=None):
+    global _monitor
+    _monitor = Monitor(interval, metrics, address, queue, remote)
+    return _monitor
+
+def finish():
+    # Stops the monitor and prints the batch's overall throughput; returns the last snapshot
+    global _monitor
+    monitor, _monitor = _monitor, None
+    if monitor is None:
+        return None
+    snapshot = monitor.close()
+    audio = snapshot["audio_seconds"]
+    if snapshot["files"]["done"] and audio["processed"]:
+        print(f"PROGRESS: {snapshot['files']['done']} files, {clock(audio['processed'])} of audio processed in "
+              f"{span(snapshot['elapsed'])} ({audio['processed'] / max(snapshot['elapsed'], 0.001):.1f} audio-s/s)")
+    return snapshot
+
+def progressArgs():
+    # ffmpeg arguments for its progress blocks, none when nothing is watching
+    return ["-progress", "pipe:2", "-stats_period", f"{STATS_PERIOD:g}"] if _monitor else []
+
+def queued(path, duration=None):
+    if _monitor:
+        _monitor.queued(path, duration)
+
+def finished(path, ok=True):
+    if _monitor:
+        _monitor.finished(path, ok)
+
+@contextmanager
+def file(path):
+    # A worker thread working on a file, tasks started on this thread without a source belong to it
+    previous = getattr(_local, "path", None)
+    _local.path = path
+    if _monitor:
+        _monitor.running(path)
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        _local.path = previous
+        finished(path, ok)
+
+@contextmanager
+def task(stage, source=None, counted=True, duration=None):
+    # duration: audio seconds the task goes through, the whole source when not given
+    source = source if source is not None else getattr(_local, "path", None)
+    key = fileKey(source) if source is not None else None
+    monitor = _monitor
+    if monitor and duration is None and key:
+        duration = monitor.duration(key)
+    if monitor and duration is None and source is not None:
+        duration = cm.probeDuration(source)
+    current = Task(key, pl.Path(source).name if source is not None else "-", stage, duration, counted)
+    if monitor:
+        monitor.add(current)
+    try:
+        yield current
+    finally:
+        if monitor:
+            monitor.remove(current)
+
+def snapshot():
+    return _monitor.snapshot() if _monitor else None
+
+def etaText():
+    # ", ETA 4m12s" for the per-file progress lines, empty while it isn't known
+    current = snapshot()
+    return f", ETA {span(current['eta'])}" if current and current["eta"] is not None else ""
+
+def communicate(process, task=None, input=None, output=None, size=1 << 20):
+    # Popen.communicate() for ffmpeg started with progressArgs(): the progress blocks on stderr go to task, the
+    # rest of stderr is returned. output is called with every stdout chunk instead of collecting them (a loudness
+    # meter). Returns (stdout or None, stderr)
+    errors = []
+
+    def readErrors():
+        for line in process.stderr:
+            match = PROGRESS_LINE.match(line)
+            if match and (match.group(1) in PROGRESS_KEYS or match.group(1).startswith(b"stream_")):
+                if task:
+                    task.update(*match.groups())
+            else:
+                errors.append(line)
+
+    def writeInput():
+        try:
+            process.stdin.write(input)
+            process.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass  # ffmpeg stopped reading, its stderr says why
+
+    threads = [threading.Thread(target=readErrors, daemon=True)]
+    if input is not None:
+        threads.append(threading.Thread(target=writeInput, daemon=True))
+    for thread in threads:
+        thread.start()
+    chunks = []
+    if process.stdout:
+        while True:
+            data = process.stdout.read(size)
+            if not data:
+                break
+            if output:
+                output(data)
+            else:
+                chunks.append(data)
+    process.wait()
+    for thread in threads:
+        thread.join()
+    return (b"".join(chunks) if process.stdout and not output else None), b"".join(errors)
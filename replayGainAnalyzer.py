@@ -1,24 +1,158 @@
 import subprocess
 import re
+import math
+import threading
+from importlib.util import find_spec
+
+import progressMonitor as pm
+import runReport as rr
+import sqliteCache as sc
+
+# EBU R128 / BS.1770 gating, applied to the 400 ms momentary blocks ebur128 logs every 100 ms
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = 10.0
+REFERENCE_LOUDNESS = -18.0  # ReplayGain 2 reference
+BLOCK_PATTERN = re.compile(r"\bM:\s*(-?\d+\.\d)")
+
+# Results keyed by a hash of the audio packets, so retagging a file doesn't throw its loudness away
+LOUDNESS_CACHE_DB = "loudness_cache.sqlite"
+LOUDNESS_CACHE_MAX_ENTRIES = 200000  # None keeps everything, 0 disables the cache
+ANALYSIS_VERSION = "ebur128-blocks-1"  # Bump when the stored result changes shape
+HASH_PATTERN = re.compile(r"SHA256=([0-9a-f]+)")
+
+# "ffmpeg" reads ebur128's log, "numpy" measures decoded PCM in-process (still slower than ebur128 on whole files).
+# Segmented encodes always use the NumPy meter when it is installed, ebur128's log can't be joined across segments.
+# (NumPy is found without importing it, loudnessMeter and NumPy load with the first measurement)
+ANALYZER = "ffmpeg"
+NUMPY_INSTALLED = find_spec("numpy") is not None
+ANALYZER_THREADS = 1  # Chunk threads per file, files already run in parallel
+
+_loudness_cache = None
+_cache_lock = threading.Lock()
+
+def loudnessCache():
+    # Opened on first use
+    global _loudness_cache
+    if LOUDNESS_CACHE_MAX_ENTRIES == 0:
+        return None
+    with _cache_lock:
+        if _loudness_cache is None:
+            _loudness_cache = sc.SQLiteCache(LOUDNESS_CACHE_DB, max_entries=LOUDNESS_CACHE_MAX_ENTRIES)
+        return _loudness_cache
+
+def flushCache():
+    if _loudness_cache is not None:
+        _loudness_cache.flush()
+
+def closeCache():
+    # The next loudnessCache() opens it again, e.g. after its file was deleted
+    global _loudness_cache
+    with _cache_lock:
+        if _loudness_cache is not None:
+            _loudness_cache.close()
+            _loudness_cache = None
+
+def audioHash(file_path):
+    # Hash of the first audio stream's packets (demux only, no decode); tags and cover art don't change it
+    cmd = ["ffmpeg", "-hide_banner", "-nostats", "-v", "error", "-i", str(file_path),
+           "-map", "0:a:0", "-c", "copy", "-f", "hash", "-hash", "sha256", "-"]
+    with rr.stage("audio_hash"):
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, errors="ignore")
+    match = HASH_PATTERN.search(result.stdout)
+    return match.group(1) if result.returncode == 0 and match else None
+
+def analyze_replaygain(file_path: str, use_cache=True):
+    cache = loudnessCache() if use_cache else None
+    key = None
+    if cache is not None:
+        digest = audioHash(file_path)
+        if digest:
+            key = f"{ANALYSIS_VERSION}:{digest}"
+            cached = cache.get(key)
+            if cached is not None:
+                rr.count("loudness_cache_hit")
+                print(f"REPLAYGAIN: Loudness found in cache (Gain: {cached[0]}, Peak: {cached[1]})")
+                return tuple(cached)
+        rr.count("loudness_cache_miss")
+
+    if ANALYZER == "numpy":
+        import loudnessMeter as lm
+        with rr.stage("replaygain"):
+            measured = lm.analyzeFile(file_path, jobs=ANALYZER_THREADS)
+        rg = fromMeasurement(*measured) if measured else None
+        if rg and key:
+            cache.put(key, list(rg))
+        if rg:
+            return rg
+        # Anything the meter can't read goes through ebur128 instead
 
-def analyze_replaygain(file_path: str):
     cmd = [
         "ffmpeg",
-        "-i", file_path,
-        "-filter:a", "ebur128=peak=true",
+        *pm.progressArgs(),
+        "-i", str(file_path),
+        "-filter:a", "ebur128=peak=true:framelog=info",
         "-f", "null",
         "-"
     ]
-    result = subprocess.run(
-        cmd,
-        stderr=subprocess.PIPE,
-        stdout=subprocess.DEVNULL,
-        text=True,
-        encoding="utf-8",
-        errors="ignore"
-    )
-    stderr = result.stderr
+    with rr.stage("replaygain"), pm.task("loudness", file_path, counted=False) as task:
+        process = subprocess.Popen(cmd, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)
+        _, stderr = pm.communicate(process, task)
+    rg = parse_ebur128(stderr.decode("utf-8", errors="ignore"))
+    if rg and key:
+        cache.put(key, list(rg))
+    return rg
+
+def parse_blocks(stderr: str):
+    # Histogram of the gating blocks in 0.1 LU steps ({"-215": 12} = 12 blocks at -21.5 LUFS).
+    # Tracks' histograms can be summed to gate a whole album without decoding it again.
+    blocks = {}
+    for match in BLOCK_PATTERN.finditer(stderr):
+        loudness = float(match.group(1))
+        if loudness >= ABSOLUTE_GATE:
+            key = str(round(loudness * 10))
+            blocks[key] = blocks.get(key, 0) + 1
+    return blocks
+
+def gated_loudness(histograms):
+    # Integrated loudness of all blocks together: absolute gate at -70 LUFS, then relative gate 10 LU below
+    # the mean of what passed. Returns None when nothing is above the gates.
+    merged = {}
+    for blocks in histograms:
+        for key, count in (blocks or {}).items():
+            merged[int(key)] = merged.get(int(key), 0) + count
+    if not merged:
+        return None
+
+    def meanLoudness(keys):
+        total = sum(merged[k] for k in keys)
+        if not total:
+            return None
+        energy = sum(merged[k] * 10 ** (k / 100) for k in keys) / total
+        return 10 * math.log10(energy)
+
+    ungated = meanLoudness(merged)
+    threshold = ungated - RELATIVE_GATE
+    return meanLoudness([k for k in merged if k / 10 >= threshold])
+
+def album_gain(tracks):
+    # tracks: (gain, peak, blocks) results of parse_ebur128 for every track of one album
+    # Returns (gain, peak) like a single track, or None when no track kept its block data
+    tracks = [track for track in tracks if track and len(track) > 2 and track[2]]
+    loudness = gated_loudness([track[2] for track in tracks])
+    if loudness is None:
+        return None
+    peak = max(track[1] for track in tracks)
+    return round(REFERENCE_LOUDNESS - loudness, 2), round(peak, 2)
+
+def fromMeasurement(loudness, peak, blocks):
+    # Same result shape and rounding as parse_ebur128, for the in-process meter
+    if loudness is None or peak == float("-inf"):
+        return None
+    gain = REFERENCE_LOUDNESS - loudness
+    print(f"Loudness: {loudness}, Peak: {peak}, Gain: {gain}")
+    return round(gain, 2), round(peak, 2), blocks
 
+def parse_ebur128(stderr: str):
     # Integrated loudness
     loudness_match = re.search(r"Integrated loudness:\s+I:\s*(-?\d+\.?\d*) LUFS", stderr)
     # True peak
@@ -31,8 +165,9 @@ def analyze_replaygain(file_path: str):
     peak = float(peak_match.group(1))
 
     # ReplayGain reference is -18 LUFS
-    gain = -18.0 - loudness
+    gain = REFERENCE_LOUDNESS - loudness
 
     print(f"Loudness: {loudness}, Peak: {peak}, Gain: {gain}")
 
-    return round(gain, 2), round(peak, 2)
+    # Gating blocks are kept for album gain, empty when ffmpeg didn't log them per frame
+    return round(gain, 2), round(peak, 2), parse_blocks(stderr)
@@ -0,0 +1,187 @@
+import io
+import json
+import math
+import pathlib as pl
+import threading
+import time
+from contextlib import contextmanager
+
+RUN_REPORT_FILE = "run_report.jsonl"
+# Upper bounds in seconds for the per-stage histogram, the last bucket takes the rest
+HISTOGRAM_BUCKETS = [0.01, 0.1, 1.0, 10.0]
+# Timings are kept as counts in log spaced bins, QUANTILE_BINS per decade (within 5%), p50/p95 are read off them
+QUANTILE_BINS = 50
+
+class RunReport:
+    # Stage timings (monotonic clock) and counters for one batch. Every timing is written as a JSON line
+    # as it happens, the summary with a histogram per stage is appended by close(). Only running totals and
+    # bin counts are kept in memory, a --watch daemon's report doesn't grow with the files it has seen.
+    def __init__(self, path=RUN_REPORT_FILE):
+        self.path = pl.Path(path) if path else None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = time.monotonic()
+        self.timings = {}
+        self.counters = {}
+        self.file = open(self.path, "w", encoding="utf-8") if self.path else None
+        self.write({"event": "start", "time": time.time()})
+
+    def write(self, record):
+        if self.file:
+            self.file.write(json.dumps(record) + "\n")
+
+    @contextmanager
+    def source(self, path):
+        # Timings recorded by this thread are attributed to the file it is working on
+        previous = getattr(self.local, "source", None)
+        self.local.source = str(path)
+        try:
+            yield
+        finally:
+            self.local.source = previous
+
+    @contextmanager
+    def stage(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, time.monotonic() - start)
+
+    def record(self, name, seconds):
+        with self.lock:
+            stage = self.timings.get(name)
+            if stage is None:
+                stage = self.timings[name] = {"count": 0, "total": 0.0, "max": 0.0,
+                                              "histogram": [0] * (len(HISTOGRAM_BUCKETS) + 1), "bins": {}}
+            stage["count"] += 1
+            stage["total"] += seconds
+            stage["max"] = max(stage["max"], seconds)
+            stage["histogram"][next((i for i, bound in enumerate(HISTOGRAM_BUCKETS) if seconds < bound), len(HISTOGRAM_BUCKETS))] += 1
+            position = math.floor(math.log10(max(seconds, 1e-9)) * QUANTILE_BINS)
+            stage["bins"][position] = stage["bins"].get(position, 0) + 1
+            self.write({"event": "stage", "stage": name, "seconds": round(seconds, 6),
+                        "source": getattr(self.local, "source", None), "thread": threading.current_thread().name,
+                        "at": round(time.monotonic() - self.started, 6)})
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self):
+        stages = {}
+        with self.lock:
+            for name, stage in self.timings.items():
+                count = stage["count"]
+                stages[name] = {
+                    "count": count,
+                    "total": round(stage["total"], 6),
+                    "mean": round(stage["total"] / count, 6),
+                    "p50": round(quantile(stage, count // 2), 6),
+                    "p95": round(quantile(stage, min(count - 1, int(count * 0.95))), 6),
+                    "max": round(stage["max"], 6),
+                    "histogram": list(stage["histogram"]),
+                }
+            counters = dict(self.counters)
+        return {"wall": round(time.monotonic() - self.started, 6), "stages": stages, "counters": counters,
+                "buckets": HISTOGRAM_BUCKETS}
+
+    def printSummary(self, summary=None):
+        summary = summary or self.summary()
+        labels = [f"<{bound:g}s" for bound in HISTOGRAM_BUCKETS] + [f">={HISTOGRAM_BUCKETS[-1]:g}s"]
+        print(f"RUN REPORT: {summary['wall']:.2f}s wall")
+        for name, stage in sorted(summary["stages"].items(), key=lambda item: -item[1]["total"]):
+            histogram = " ".join(f"{label}:{n}" for label, n in zip(labels, stage["histogram"]) if n)
+            print(f"RUN REPORT: {name:<22} n={stage['count']:<5} total={stage['total']:8.2f}s mean={stage['mean']:.3f}s "
+                  f"p95={stage['p95']:.3f}s max={stage['max']:.3f}s  [{histogram}]")
+        for name, value in sorted(summary["counters"].items()):
+            print(f"RUN REPORT: {name:<22} {value}")
+
+    def close(self):
+        summary = self.summary()
+        self.write({"event": "summary", **summary})
+        if self.file:
+            self.file.close()
+            self.file = None
+        return summary
+
+def quantile(stage, rank):
+    # Upper edge of the bin holding the rank-th smallest timing (never above the largest one)
+    seen = 0
+    for position in sorted(stage["bins"]):
+        seen += stage["bins"][position]
+        if seen > rank:
+            return min(stage["max"], 10 ** ((position + 1) / QUANTILE_BINS))
+    return stage["max"]
+
+class NullReport:
+    # Used when no report is active, so instrumented code costs next to nothing
+    @contextmanager
+    def source(self, path):
+        yield
+
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def record(self, name, seconds):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+_report = NullReport()
+
+def start(path=RUN_REPORT_FILE):
+    global _report
+    _report = RunReport(path)
+    return _report
+
+def finish():
+    global _report
+    report, _report = _report, NullReport()
+    if isinstance(report, RunReport):
+        summary = report.close()
+        report.printSummary(summary)
+        return summary
+    return None
+
+def stage(name):
+    return _report.stage(name)
+
+def source(path):
+    return _report.source(path)
+
+def record(name, seconds):
+    _report.record(name, seconds)
+
+def count(name, n=1):
+    _report.count(name, n)
+
+def profiled(func, match, out_dir="."):
+    # Wraps a per-file task: the first source whose name matches (or any, with "first") runs under
+    # cProfile. Stats go to <out_dir>/<stem>.prof and the top entries are printed in its log.
+    claimed = threading.Lock()
+    taken = False
+
+    def wrapper(item, *args, **kwargs):
+        nonlocal taken
+        path = pl.Path(item[0] if isinstance(item, tuple) else item)
+        with claimed:
+            run = not taken and (match == "first" or path.name == match)
+            taken = taken or run
+        if not run:
+            return func(item, *args, **kwargs)
+        import cProfile
+        import pstats
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, item, *args, **kwargs)
+        finally:
+            out_file = pl.Path(out_dir) / f"{path.stem}.prof"
+            profile.dump_stats(out_file)
+            stats = io.StringIO()
+            pstats.Stats(profile, stream=stats).sort_stats("cumulative").print_stats(20)
+            print(f"PROFILER: {path.name} profiled, stats saved to {out_file}")
+            print(stats.getvalue())
+    return wrapper
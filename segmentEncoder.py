@@ -0,0 +1,595 @@
+import math
+import pathlib as pl
+import shutil
+import struct
+import subprocess
+import tempfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import audioConverter as ac
+import batchEngine as be
+import costModel as cm
+import progressMonitor as pm
+import replayGainAnalyzer as rga
+import runReport as rr
+
+# Very long files (mixes, audiobooks) are cut into segments on sample-exact boundaries, the segments are
+# encoded and measured at the same time and then joined without a gap:
+# - WAV: raw PCM segments, appended to each other and remuxed into one data chunk
+# - FLAC: segments coded in FLAC_BLOCK_SIZE frames and cut on that grid; their frames are copied with the frame
+#   numbers (and so the header CRC-8 and frame CRC-16) rewritten, STREAMINFO gets the totals and the MD5
+# - MP3: encoded without the bit reservoir, so every frame stands on its own. A segment starts encoding a few
+#   frames early on the same 1152 sample grid as the rest of the file; once those frames are dropped the next
+#   frame continues exactly where the previous segment stopped (the encoder delay is the same in every segment).
+#   The first segment's Info/LAME header gets the frame count and the last segment's padding.
+# - Opus: the same with 20 ms packets, written back into one Ogg stream whose last granule trims the padding
+# Vorbis and AAC don't code on a fixed frame grid, those files are encoded in one piece.
+
+SEGMENT_MIN_SECONDS = 20 * 60  # Only files at least this long are split
+SEGMENT_PREROLL = 1.0  # Seconds decoded ahead of a segment for the resampler, the K filter and encoder warm-up
+# Extra whole seconds decoded ahead of the preroll for sources whose first frames after a seek don't come out as they
+# do in a whole-file decode. MP3 seeks land on the exact sample (with the TOC off), but the bit reservoir and the
+# overlap from the frame before are missing for the first few frames.
+SEEK_WARMUP = {"mp3": 1}
+OGG_PAGE_PACKETS = 50  # Opus packets per Ogg page, 1 s of 20 ms packets like ffmpeg writes
+FLAC_BLOCK_SIZE = 4608  # Samples per FLAC frame of a segment, what ffmpeg picks itself at 44.1/48 kHz
+LOSSLESS_FORMATS = ("wav", "flac")  # Segments without encoder warm-up, joined sample for sample
+
+def frameSamples(settings):
+    # Samples per coded frame of the output (1 for PCM), None when segments can't be joined gaplessly
+    if settings.output_format == "wav" and settings.acodec.startswith("pcm_"):
+        return 1
+    if settings.output_format == "flac" and settings.acodec == "flac":
+        return FLAC_BLOCK_SIZE
+    if settings.output_format == "mp3" and settings.acodec == "libmp3lame":
+        return 1152 if settings.sample_rate >= 32000 else 576
+    if settings.output_format == "opus" and settings.acodec == "libopus":
+        return settings.sample_rate // 50
+    return None
+
+def plan(settings, input_path, segments):
+    # [(start, end)] output sample ranges (end None for the last one), or None when the file stays whole.
+    # Boundaries fall on whole seconds that are also on the encoder's frame grid.
+    frame = frameSamples(settings)
+    if frame is None or segments < 2:
+        return None
+    duration = cm.probeDuration(input_path)
+    if duration < SEGMENT_MIN_SECONDS:
+        return None
+    rate = settings.sample_rate
+    grid = frame * rate // math.gcd(frame, rate)
+    length = math.ceil(duration * rate / segments / grid) * grid
+    starts = list(range(0, int(duration * rate) - grid, length))
+    if len(starts) < 2:
+        return None
+    return [(start, starts[i + 1] if i + 1 < len(starts) else None) for i, start in enumerate(starts)]
+
+def outputArgs(output_path, **output_kwargs):
+    # ffmpeg-python's spelling of the output options (-f, -b:a, ...) for commands built by hand
+    import ffmpeg
+    return ffmpeg.input("-").output(str(output_path), **output_kwargs).get_args()[2:]
+
+def rawFormat(settings):
+    # ffmpeg's raw format for a PCM codec (pcm_s16le -> s16le)
+    return settings.acodec[len("pcm_"):]
+
+def trim(start, end):
+    options = [f"start_sample={start}"] if start else []
+    if end is not None:
+        options.append(f"end_sample={end}")
+    return f"atrim={':'.join(options)}" if options else "anull"
+
+def encodeSegment(settings, input_path, segment_path, start, end, measure, stage="segment"):
+    # Encodes [start, end) (in output samples) plus the warm-up frames before and after it.
+    # Returns (warm-up frames at the start, the meter's measured() or None)
+    import loudnessMeter as lm
+    rate = settings.sample_rate
+    frame = frameSamples(settings)
+    lossless = settings.output_format in LOSSLESS_FORMATS
+    lead = 0 if lossless else min(start, math.ceil(SEGMENT_PREROLL * rate / frame) * frame)
+    tail = 0 if lossless else math.ceil(SEGMENT_PREROLL * rate / frame) * frame
+    # Decoding starts on a whole second, so the resampler's grid lines up with the rest of the file
+    source_format = pl.Path(input_path).suffix[1:].lower()
+    seek = max(0, max(0, start - lead - int(SEGMENT_PREROLL * rate)) // rate - SEEK_WARMUP.get(source_format, 0))
+    base = seek * rate
+
+    output_kwargs = settings.outputKwargs()
+    output_kwargs["loglevel"] = "error"
+    output_kwargs["map_metadata"] = "-1"  # The join takes the tags from the source
+    if settings.output_format == "mp3":
+        output_kwargs.update(reservoir=0, id3v2_version=0)
+    elif settings.output_format == "flac":
+        output_kwargs["frame_size"] = FLAC_BLOCK_SIZE  # Every frame but the last is whole, cuts fall between frames
+    elif settings.output_format == "wav":
+        output_kwargs["format"] = rawFormat(settings)
+
+    layout = "mono" if settings.channels == 1 else "stereo"
+    graph = f"[0:a:0]aresample={rate},aformat=channel_layouts={layout}"
+    # Timestamps restart at 0, the Ogg muxer writes granules from them
+    encoded = trim(start - lead - base, None if end is None else end + tail - base) + ",asetpts=N/SR/TB"
+    cmd = ["ffmpeg", "-hide_banner", "-nostats", "-v", "error", "-y", *pm.progressArgs()]
+    if seek:
+        cmd += (["-usetoc", "0"] if source_format == "mp3" else []) + ["-ss", str(seek)]
+    cmd += ["-i", str(input_path)]
+    # The segment's own audio is what it adds to the file's progress
+    length = ((end if end is not None else cm.probeDuration(input_path) * rate) - start) / rate
+    if not measure:
+        cmd += ["-filter_complex", f"{graph},{encoded}[enc]", "-map", "[enc]"] + outputArgs(segment_path, **output_kwargs)
+        with rr.source(input_path), rr.stage("segment_encode"), be.slot("cpu"), pm.task(stage, input_path, duration=length) as task:
+            process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            _, stderr = pm.communicate(process, task)
+        if process.returncode:
+            raise RuntimeError(stderr.decode(errors="ignore").strip())
+        return lead // frame, None
+
+    # The meter gets the audio before the segment as filter history only
+    metered = trim(0, None if end is None else end - base)
+    cmd += ["-filter_complex", f"{graph},asplit=2[e][m];[e]{encoded}[enc];[m]{metered}[meter]",
+            "-map", "[enc]"] + outputArgs(segment_path, **output_kwargs)
+    cmd += ["-map", "[meter]", "-f", "f32le", "-acodec", "pcm_f32le", "pipe:"]
+    with rr.source(input_path), rr.stage("segment_encode"), be.slot("cpu"), pm.task(stage, input_path, duration=length) as task:
+        meter = lm.LoudnessMeter(rate, settings.channels, lead=start - base)
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stderr = lm.measureProcess(process, meter, task)
+        if process.returncode:
+            raise RuntimeError(stderr.decode(errors="ignore").strip())
+        return lead // frame, meter.measured()
+
+# MPEG audio Layer III frame headers: kbps by bitrate index, Hz by sample rate index
+MP3_BITRATES = {3: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+                2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]}
+MP3_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+def mp3Frames(data):
+    # [(offset, length)] of the MPEG audio frames of a file (after its ID3v2 tag, if any)
+    offset = 0
+    if data[:3] == b"ID3":
+        offset = 10 + ((data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9])
+    frames = []
+    while offset + 4 <= len(data):
+        header = struct.unpack_from(">I", data, offset)[0]
+        if header & 0xFFE00000 != 0xFFE00000:
+            if data[offset:offset + 3] == b"TAG":
+                break  # ID3v1
+            raise ValueError(f"Lost MP3 frame sync at byte {offset}")
+        version = (header >> 19) & 3
+        bitrate = MP3_BITRATES[3 if version == 3 else 2][(header >> 12) & 15] * 1000
+        rate = MP3_RATES[version][(header >> 10) & 3]
+        length = (144 if version == 3 else 72) * bitrate // rate + ((header >> 9) & 1)
+        frames.append((offset, length))
+        offset += length
+    return frames
+
+def infoTag(frame):
+    # Offset of the Xing/Info tag in the first frame of an mp3, -1 when it's audio
+    for tag in (b"Info", b"Xing"):
+        position = frame.find(tag, 4, 48)
+        if position >= 0:
+            return position
+    return -1
+
+def lameCrc(data):
+    # CRC-16 (0x8005, reflected) the LAME tag carries over the first 190 bytes of its frame
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return crc
+
+def patchInfoFrame(frame, frames, size, padding):
+    # The first segment's Info frame with the joined file's frame count, byte size and end padding
+    frame = bytearray(frame)
+    position = infoTag(frame)
+    flags = struct.unpack_from(">I", frame, position + 4)[0]
+    position += 8
+    if flags & 1:
+        struct.pack_into(">I", frame, position, frames)
+        position += 4
+    if flags & 2:
+        struct.pack_into(">I", frame, position, size)
+        position += 4
+    if flags & 4:
+        frame[position:position + 100] = bytes(min(255, i * 256 // 100) for i in range(100))  # Constant bitrate
+        position += 100
+    if flags & 8:
+        position += 4
+    # LAME extension: 12 bit encoder delay and 12 bit padding at +21, music length at +28, tag CRC at +34
+    delay = int.from_bytes(frame[position + 21:position + 24], "big") >> 12
+    frame[position + 21:position + 24] = ((delay << 12) | padding).to_bytes(3, "big")
+    struct.pack_into(">I", frame, position + 28, size)
+    struct.pack_into(">H", frame, position + 34, lameCrc(frame[:position + 34]))
+    return bytes(frame)
+
+def infoPadding(frame):
+    position = infoTag(frame)
+    flags = struct.unpack_from(">I", frame, position + 4)[0]
+    position += 8 + (4 if flags & 1 else 0) + (4 if flags & 2 else 0) + (100 if flags & 4 else 0) + (4 if flags & 8 else 0)
+    return int.from_bytes(frame[position + 21:position + 24], "big") & 0xFFF
+
+def joinMp3(parts, output_path):
+    # parts: [(segment path, warm-up frames, frames to keep or None for the rest)]
+    info = None
+    padding = 0
+    count = 0
+    size = 0
+    with open(output_path, "wb") as f:
+        for path, lead, keep in parts:
+            data = memoryview(pl.Path(path).read_bytes())
+            frames = mp3Frames(data)
+            if frames and infoTag(bytes(data[frames[0][0]:frames[0][0] + 48])) >= 0:
+                first = bytes(data[frames[0][0]:frames[0][0] + frames[0][1]])
+                if info is None:
+                    info = first
+                    f.write(first)  # Patched once the totals are known
+                padding = infoPadding(first)  # The last segment's end is the file's end
+                frames = frames[1:]
+            frames = frames[lead:] if keep is None else frames[lead:lead + keep]
+            if frames:
+                # Frames follow each other, the kept ones are one run of bytes
+                f.write(data[frames[0][0]:frames[-1][0] + frames[-1][1]])
+                size += frames[-1][0] + frames[-1][1] - frames[0][0]
+                count += len(frames)
+        if info:
+            f.seek(0)
+            f.write(patchInfoFrame(info, count, size + len(info), padding))
+
+OGG_CRC_REVERSED = bytes(int(f"{i:08b}"[::-1], 2) for i in range(256))
+
+def oggCrc(page):
+    # Ogg's CRC-32 (0x04C11DB7, not reflected, no final xor) through zlib's reflected one on bit-reversed bytes
+    crc = zlib.crc32(page.translate(OGG_CRC_REVERSED), 0xFFFFFFFF) ^ 0xFFFFFFFF
+    return int(f"{crc:032b}"[::-1], 2)
+
+def oggPackets(data):
+    # (packets of the first logical stream, granule position of its last page)
+    packets = []
+    partial = b""
+    granule = 0
+    serial = None
+    offset = 0
+    while offset + 27 <= len(data):
+        if data[offset:offset + 4] != b"OggS":
+            raise ValueError(f"Lost Ogg page sync at byte {offset}")
+        count = data[offset + 26]
+        lacing = data[offset + 27:offset + 27 + count]
+        position = offset + 27 + count
+        page_serial = struct.unpack_from("<I", data, offset + 14)[0]
+        serial = page_serial if serial is None else serial
+        if page_serial == serial:
+            granule = struct.unpack_from("<q", data, offset + 6)[0]
+            for value in lacing:
+                partial += data[position:position + value]
+                position += value
+                if value < 255:
+                    packets.append(partial)
+                    partial = b""
+        offset = offset + 27 + count + sum(lacing)
+    return packets, granule
+
+def opusSamples(packet):
+    # Samples (at 48 kHz) in an Opus packet, from its TOC byte (RFC 6716 3.1)
+    config = packet[0] >> 3
+    if config < 12:
+        size = (480, 960, 1920, 2880)[config % 4]
+    elif config < 16:
+        size = (480, 960)[config % 2]
+    else:
+        size = (120, 240, 480, 960)[config % 4]
+    code = packet[0] & 3
+    frames = 1 if code == 0 else 2 if code < 3 else packet[1] & 0x3F
+    return size * frames
+
+def writeOgg(f, serial, packets):
+    # packets: (bytes, granule after it or None for a header); the last one's granule ends the stream.
+    # Headers get a page of their own, audio pages hold OGG_PAGE_PACKETS packets, and a packet too big for
+    # what is left of a page continues on the next one.
+    sequence = 0
+    lacing = []
+    body = []
+    granule = -1  # Of the last packet that ends on the page, -1 when none does
+    flags = 2  # First page of the stream
+
+    def page(last=False):
+        nonlocal sequence, granule, flags
+        header = struct.pack("<4sBBqIIIB", b"OggS", 0, flags | (4 if last else 0), granule, serial, sequence, 0, len(lacing))
+        data = bytearray(header + bytes(lacing) + b"".join(body))
+        struct.pack_into("<I", data, 22, oggCrc(bytes(data)))
+        f.write(data)
+        sequence += 1
+        lacing.clear()
+        body.clear()
+        granule = -1
+        flags = 0
+
+    packets = iter(packets)
+    current = next(packets, None)
+    ended = 0
+    while current is not None:
+        following = next(packets, None)
+        packet, packet_granule = current
+        values = [255] * (len(packet) // 255) + [len(packet) % 255]
+        offset = 0
+        while len(lacing) + len(values) > 255:
+            room = 255 - len(lacing)
+            lacing.extend(values[:room])
+            body.append(packet[offset:offset + room * 255])
+            values, offset = values[room:], offset + room * 255
+            page()
+            flags = 1  # Continued packet
+            ended = 0
+        lacing.extend(values)
+        body.append(packet[offset:])
+        granule = packet_granule or 0
+        ended += 1
+        if following is None:
+            page(last=True)
+        elif packet_granule is None or ended >= OGG_PAGE_PACKETS:
+            page()
+            ended = 0
+        current = following
+
+def joinOpus(parts, output_path):
+    # parts: [(segment path, warm-up frames, frames to keep or None for the rest)]; 20 ms frames
+    def packets():
+        position = 0  # Samples at 48 kHz in the joined stream, pre-skip included
+        for i, (path, lead, keep) in enumerate(parts):
+            segment, granule = oggPackets(pl.Path(path).read_bytes())
+            if i == 0:
+                yield from ((header, None) for header in segment[:2])
+            start = lead * 960
+            stop = None if keep is None else start + keep * 960
+            kept = []
+            offset = 0
+            for packet in segment[2:]:
+                samples = opusSamples(packet)
+                if offset >= start and (stop is None or offset < stop):
+                    position += samples
+                    kept.append((packet, position))
+                offset += samples
+            if keep is None and kept:
+                # The last segment's final granule says how much of its last packet is real
+                kept[-1] = (kept[-1][0], position - (offset - start) + (granule - start))
+            yield from kept
+
+    with open(output_path, "wb") as f:
+        writeOgg(f, zlib.crc32(str(output_path).encode()), packets())
+
+def crcTable(width, poly):
+    top = 1 << (width - 1)
+    mask = (1 << width) - 1
+    table = []
+    for byte in range(256):
+        crc = byte << (width - 8)
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly) & mask if crc & top else (crc << 1) & mask
+        table.append(crc)
+    return table
+
+# FLAC's CRC-8 (0x07) over a frame header and CRC-16 (0x8005) over the whole frame, not reflected, starting at 0
+FLAC_CRC8 = crcTable(8, 0x07)
+FLAC_CRC16 = crcTable(16, 0x8005)
+
+def flacCrc8(data):
+    crc = 0
+    for byte in data:
+        crc = FLAC_CRC8[crc ^ byte]
+    return crc
+
+def flacCrc16(data):
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ FLAC_CRC16[(crc >> 8) ^ byte]
+    return crc
+
+def crc16MulMod(a, b):
+    # a * b in GF(2)[x] modulo x^16 + x^15 + x^2 + 1
+    product = 0
+    while b:
+        if b & 1:
+            product ^= a
+        b >>= 1
+        a <<= 1
+        if a & 0x10000:
+            a ^= 0x18005
+    return product
+
+# x^(8 * 2^k) mod the CRC-16 polynomial: what running 2^k zero bytes through the CRC multiplies it by
+FLAC_CRC16_ZEROS = [0x100]
+for _ in range(40):
+    FLAC_CRC16_ZEROS.append(crc16MulMod(FLAC_CRC16_ZEROS[-1], FLAC_CRC16_ZEROS[-1]))
+
+def crc16Zeros(crc, count):
+    # The CRC after count more zero bytes, without running them through
+    for power in FLAC_CRC16_ZEROS:
+        if not count:
+            break
+        if count & 1:
+            crc = crc16MulMod(crc, power)
+        count >>= 1
+    return crc
+
+def flacNumber(value):
+    # The UTF-8 like coding of a frame or sample number
+    if value < 0x80:
+        return bytes([value])
+    length = 2
+    while value >= 1 << (5 * length + 1):
+        length += 1
+    first = (0xFF << (8 - length)) & 0xFF | (value >> (6 * (length - 1)))
+    return bytes([first] + [0x80 | ((value >> (6 * i)) & 0x3F) for i in range(length - 2, -1, -1)])
+
+def flacHeader(data, offset):
+    # (header length with its CRC-8, frame number, offset of the number, its length) of the frame at offset,
+    # None when there is no valid fixed block size frame header there
+    if data[offset:offset + 2] != b"\xff\xf8" or offset + 6 > len(data):
+        return None
+    first = data[offset + 4]
+    length = 1 if first < 0x80 else 8 - (first ^ 0xFF).bit_length()
+    if length == 0 or length > 7 or (first >= 0x80 and length == 1):
+        return None
+    number = first & (0x7F >> length) if length > 1 else first
+    for byte in data[offset + 5:offset + 4 + length]:
+        if byte & 0xC0 != 0x80:
+            return None
+        number = (number << 6) | (byte & 0x3F)
+    position = offset + 4 + length
+    position += {6: 1, 7: 2}.get(data[offset + 2] >> 4, 0)
+    position += {12: 1, 13: 2, 14: 2}.get(data[offset + 2] & 0xF, 0)
+    if position >= len(data) or flacCrc8(data[offset:position]) != data[position]:
+        return None
+    return position + 1 - offset, number, offset + 4, length
+
+def flacStream(data):
+    # (STREAMINFO bytes, [(offset, length)] of the frames) of a FLAC file
+    if data[:4] != b"fLaC":
+        raise ValueError("Not a FLAC stream")
+    offset = 4
+    info = None
+    while True:
+        block = data[offset]
+        size = int.from_bytes(data[offset + 1:offset + 4], "big")
+        if block & 0x7F == 0:
+            info = bytes(data[offset + 4:offset + 4 + size])
+        offset += 4 + size
+        if block & 0x80:
+            break
+    frames = []
+    number = 0
+    while offset < len(data):
+        header = flacHeader(data, offset)
+        if not header or header[1] != number:
+            raise ValueError(f"Lost FLAC frame sync at byte {offset}")
+        # The next frame is the next header that checks out and carries the next frame number
+        search = offset + 2
+        while True:
+            following = data.find(b"\xff\xf8", search)
+            if following < 0:
+                following = len(data)
+                break
+            header = flacHeader(data, following)
+            if header and header[1] == number + 1:
+                break
+            search = following + 1
+        frames.append((offset, following - offset))
+        offset = following
+        number += 1
+    return info, frames
+
+def pcmMd5(path, bits):
+    # MD5 of the decoded samples as STREAMINFO holds it: interleaved, little-endian, whole bytes per sample
+    codec = {8: "pcm_s8", 16: "pcm_s16le", 24: "pcm_s24le", 32: "pcm_s32le"}.get(bits)
+    if codec is None:
+        return bytes(16)  # Unknown
+    cmd = ["ffmpeg", "-hide_banner", "-nostats", "-v", "error", "-i", str(path), "-map", "0:a:0", "-acodec", codec, "-f", "md5", "-"]
+    process = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if process.returncode:
+        raise RuntimeError(process.stderr.decode(errors="ignore").strip())
+    return bytes.fromhex(process.stdout.decode().strip().split("=", 1)[1])
+
+def joinFlac(paths, output_path):
+    # The segments' frames one after the other, renumbered; STREAMINFO with the joined totals
+    info = None
+    total = 0
+    count = 0
+    sizes = []
+    with open(output_path, "wb") as f:
+        for path in paths:
+            data = pl.Path(path).read_bytes()
+            segment_info, frames = flacStream(data)
+            view = memoryview(data)
+            samples = int.from_bytes(segment_info[13:18], "big") & 0xFFFFFFFFF
+            if info is None:
+                info = bytearray(segment_info)
+                f.write(b"fLaC" + bytes([0x80, 0, 0, len(info)]) + info)  # Patched once the totals are known
+            elif total % FLAC_BLOCK_SIZE:
+                raise ValueError(f"A segment before {pl.Path(path).name} ends inside a frame")
+            for number, (offset, length) in enumerate(frames):
+                if number == count:
+                    f.write(view[offset:offset + length])
+                    sizes.append(length)
+                    count += 1
+                    continue
+                size, _, position, number_length = flacHeader(data, offset)
+                header = data[offset:offset + size]
+                renumbered = bytearray(data[offset:position] + flacNumber(count) + data[position + number_length:offset + size - 1])
+                renumbered.append(flacCrc8(renumbered))
+                # CRC-16 is linear: only the change in the header, carried past the unchanged rest, flips bits
+                body = length - size - 2
+                crc = int.from_bytes(data[offset + length - 2:offset + length], "big")
+                crc ^= crc16Zeros(flacCrc16(header) ^ flacCrc16(renumbered), body)
+                f.write(renumbered)
+                f.write(view[offset + size:offset + length - 2])
+                f.write(crc.to_bytes(2, "big"))
+                sizes.append(len(renumbered) + body + 2)
+                count += 1
+            total += samples
+
+    # STREAMINFO: frame sizes (24 bit each) at 4, 36 bit total samples at 13, MD5 at 18
+    info[4:10] = min(sizes).to_bytes(3, "big") + max(sizes).to_bytes(3, "big")
+    info[13:18] = ((int.from_bytes(info[13:18], "big") & ~0xFFFFFFFFF) | total).to_bytes(5, "big")
+    info[18:34] = bytes(16)
+    bits = (((info[12] & 1) << 4) | (info[13] >> 4)) + 1
+    with open(output_path, "r+b") as f:
+        f.write(b"fLaC" + bytes([0x80, 0, 0, len(info)]) + info)
+    md5 = pcmMd5(output_path, bits)
+    with open(output_path, "r+b") as f:
+        f.seek(8 + 18)
+        f.write(md5)
+
+def convertSegmented(settings, input_path, output_path, segments, analyze=True, jobs=None, reserve=None):
+    # segments from plan(). Returns (converted, (gain, peak, blocks) or None) like convertAndAnalyze
+    import loudnessMeter as lm
+    measure = analyze and lm.np is not None  # Whatever rga.ANALYZER says, ebur128 can't be joined across segments
+    frame = frameSamples(settings)
+    output_path = pl.Path(output_path)
+    work = pl.Path(tempfile.mkdtemp(prefix=".segments_", dir=output_path.parent))
+    output_kwargs = None
+    try:
+        suffix = "pcm" if settings.output_format == "wav" else settings.output_format
+        paths = [work / f"segment_{i:03d}.{suffix}" for i in range(len(segments))]
+        with ThreadPoolExecutor(max_workers=jobs or len(segments), thread_name_prefix="segment") as pool:
+            futures = [pool.submit(encodeSegment, settings, input_path, path, start, end, measure, f"segment {i + 1}/{len(segments)}")
+                       for i, (path, (start, end)) in enumerate(zip(paths, segments))]
+            results = [future.result() for future in futures]
+
+        with rr.stage("segment_join"):
+            cmd = ["ffmpeg", "-hide_banner", "-nostats", "-y", *pm.progressArgs()]
+            if settings.output_format == "wav":
+                # Raw PCM segments follow each other sample for sample
+                joined = work / "joined.pcm"
+                with open(joined, "wb") as f:
+                    for path in paths:
+                        with open(path, "rb") as segment:
+                            shutil.copyfileobj(segment, f, 1 << 20)
+                cmd += ["-f", rawFormat(settings), "-ar", str(settings.sample_rate), "-ac", str(settings.channels), "-i", str(joined)]
+            else:
+                joined = work / f"joined.{settings.output_format}"
+                if settings.output_format == "flac":
+                    joinFlac(paths, joined)
+                else:
+                    parts = [(path, lead, None if end is None else (end - start) // frame)
+                             for path, (lead, _), (start, end) in zip(paths, results, segments)]
+                    (joinMp3 if settings.output_format == "mp3" else joinOpus)(parts, joined)
+                cmd += ["-i", str(joined)]
+            output_kwargs = settings.outputKwargs(copy=True, reserve=reserve)
+            # Tags come from the source, like a whole-file conversion
+            output_kwargs.setdefault("map_metadata", "1")
+            cmd += ["-i", str(input_path), "-map", "0:a:0"] + outputArgs(output_path, **output_kwargs)
+            with pm.task("join", input_path, counted=False) as task:
+                process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+                _, stderr = pm.communicate(process, task)
+        if process.returncode:
+            raise RuntimeError(stderr.decode(errors="ignore").strip())
+    except Exception as e:
+        print(f"SEGMENTS: Could not convert {input_path} in segments: {e}")
+        return False, None
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+        ac.removePlaceholder(output_kwargs)
+    rr.count("segmented")
+    print(f"SEGMENTS: {pl.Path(input_path).name} encoded as {len(segments)} segments and joined")
+    if not measure:
+        return True, None
+    return True, rga.fromMeasurement(*lm.integrate([measured for _, measured in results]))
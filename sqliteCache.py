@@ -0,0 +1,119 @@
+import json
+import pathlib as pl
+import sqlite3
+import threading
+import time
+
+class SQLiteCache:
+    # Key/value cache on SQLite: indexed reads, batched writes, optional TTL and LRU size limit
+    def __init__(self, path, ttl=None, max_entries=None, batch_size=50):
+        self.path = pl.Path(path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.batch_size = batch_size
+        self.lock = threading.RLock()
+        self.pending = {}
+        self.touched = {}
+
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache(accessed)")
+        self.conn.commit()
+
+    def expired(self, created, now):
+        return self.ttl is not None and created < now - self.ttl
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self.lock:
+            if key in self.pending:
+                return json.loads(self.pending[key][0])
+            row = self.conn.execute("SELECT value, created FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None or self.expired(row[1], now):
+                return default
+            self.touched[key] = now
+            if len(self.touched) >= self.batch_size * 10:
+                self.flush()
+            return json.loads(row[0])
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def put(self, key, value):
+        with self.lock:
+            self.pending[key] = (json.dumps(value, ensure_ascii=False), time.time())
+            if len(self.pending) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        with self.lock:
+            with self.conn:
+                if self.pending:
+                    self.conn.executemany(
+                        "INSERT OR REPLACE INTO cache (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                        [(key, value, created, created) for key, (value, created) in self.pending.items()]
+                    )
+                if self.touched:
+                    self.conn.executemany(
+                        "UPDATE cache SET accessed = ? WHERE key = ?",
+                        [(accessed, key) for key, accessed in self.touched.items()]
+                    )
+                self.pending.clear()
+                self.touched.clear()
+                self.evict()
+
+    def evict(self):
+        if self.ttl is not None:
+            self.conn.execute("DELETE FROM cache WHERE created < ?", (time.time() - self.ttl,))
+        if self.max_entries is not None:
+            count = self.conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+            if count > self.max_entries:
+                self.conn.execute(
+                    "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed ASC LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+
+    def __len__(self):
+        with self.lock:
+            self.flush()
+            return self.conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def migrateJson(self, json_path):
+        # One-off import of the old whole-file JSON cache, which is then kept aside as *.migrated
+        json_path = pl.Path(json_path)
+        if not json_path.exists():
+            return 0
+        try:
+            entries = json.loads(json_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError) as e:
+            print(f"CACHE: Could not migrate {json_path.name}: {e}")
+            return 0
+        now = time.time()
+        with self.lock:
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO cache (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                    [(key, json.dumps(value, ensure_ascii=False), now, now) for key, value in entries.items()]
+                )
+        json_path.rename(json_path.with_name(json_path.name + ".migrated"))
+        print(f"CACHE: Migrated {len(entries)} entries from {json_path.name} to {self.path.name}")
+        return len(entries)
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.conn.close()
@@ -0,0 +1,188 @@
+import base64
+import pathlib as pl
+import time
+
+import runReport as rr
+
+# mutagen's format modules are imported by the functions that need them, not at startup
+ID3_FRAMES = {"artist": "TPE1", "title": "TIT2", "album": "TALB", "year": "TYER", "genre": "TCON"}
+ID3_CLEAR = {"year": ["TYER", "TDRC"]}
+MP4_KEYS = {"artist": "\xa9ART", "title": "\xa9nam", "album": "\xa9alb", "year": "\xa9day", "genre": "\xa9gen"}
+VORBIS_KEYS = {"artist": "artist", "title": "title", "album": "album", "year": "date", "genre": "genre"}
+# The converter writes this placeholder tag into new files; the first save drops it and its space becomes
+# padding, so the tags and cover added after the encode fit without moving the audio
+RESERVED_TAG = "RESERVED_TAG_SPACE"
+TAG_PADDING = 16 * 1024  # Text tags, track and album ReplayGain, what MusicBrainz fills in
+RESERVE_FORMATS = ["mp3", "flac", "opus", "ogg"]  # m4a keeps its tags in the index after the audio, wav has none
+
+def reserveSize(output_format, cover_size=0):
+    # Bytes to reserve in a new output that will get tags and a cover of cover_size bytes
+    if output_format not in RESERVE_FORMATS:
+        return 0
+    if cover_size:
+        cover_size += 64  # APIC/picture block header
+        if output_format in ("opus", "ogg"):
+            cover_size = cover_size * 4 // 3 + 32  # Base64 picture block in a comment
+    return TAG_PADDING + cover_size
+
+def loadMutagen(filepath: pl.Path):
+    ext = filepath.suffix.lower()
+
+    if ext == ".mp3":
+        from mutagen.id3 import ID3, ID3NoHeaderError
+        try:
+            audio = ID3(filepath)
+        except ID3NoHeaderError:
+            audio = ID3()
+            audio.filename = str(filepath)
+        return "id3", audio
+    elif ext == ".flac":
+        from mutagen.flac import FLAC
+        return "flac", FLAC(filepath)
+    elif ext == ".opus":
+        from mutagen.oggopus import OggOpus
+        return "opus", OggOpus(filepath)
+    elif ext == ".ogg":
+        from mutagen.oggvorbis import OggVorbis
+        return "ogg", OggVorbis(filepath)
+    elif ext == ".m4a":
+        from mutagen.mp4 import MP4
+        return "mp4", MP4(filepath)
+    elif ext == ".wav":
+        return "wav", None  # skip metadata
+    else:
+        raise ValueError(f"loadMutagen - Unsupported format: {ext}")
+
+def imageMime(data: bytes):
+    return "image/png" if data[:8] == b"\x89PNG\r\n\x1a\n" else "image/jpeg"
+
+class TagSession:
+    # Collects every tag edit for one output file in memory and writes them with a single save
+    def __init__(self, filepath: pl.Path):
+        self.path = pl.Path(filepath)
+        self.tag_type, self.audio = loadMutagen(self.path)
+        self.dirty = self.dropReserved()
+        self.in_place = None  # How the last commit went
+
+    def dropReserved(self):
+        if self.tag_type == "id3" and f"TXXX:{RESERVED_TAG}" in self.audio:
+            self.audio.delall(f"TXXX:{RESERVED_TAG}")
+            return True
+        if self.tag_type in ("flac", "opus", "ogg") and self.audio.tags is not None and RESERVED_TAG in self.audio.tags:
+            del self.audio.tags[RESERVED_TAG]
+            return True
+        return False
+
+    def setTags(self, **fields):
+        # artist, title, album, year, genre; empty values are left untouched
+        if self.tag_type == "wav":
+            return
+        for field, value in fields.items():
+            if not value:
+                continue
+            if self.tag_type == "id3":
+                import mutagen.id3
+                for frame in ID3_CLEAR.get(field, [ID3_FRAMES[field]]):
+                    self.audio.delall(frame)
+                self.audio.add(getattr(mutagen.id3, ID3_FRAMES[field])(encoding=3, text=value))
+            elif self.tag_type == "mp4":
+                self.audio[MP4_KEYS[field]] = value
+            else:
+                self.audio[VORBIS_KEYS[field]] = value
+            self.dirty = True
+
+    def setReplayGain(self, gain, peak, scope="track"):
+        if self.tag_type == "wav":
+            return
+        values = {f"REPLAYGAIN_{scope.upper()}_GAIN": f"{gain} dB", f"REPLAYGAIN_{scope.upper()}_PEAK": str(peak)}
+        for name, value in values.items():
+            if self.tag_type == "id3":
+                from mutagen.id3 import TXXX
+                self.audio.delall(f"TXXX:{name}")
+                self.audio.add(TXXX(encoding=3, desc=name, text=value))
+            elif self.tag_type == "mp4":
+                self.audio[f"----:com.apple.iTunes:{name.lower()}"] = [value.encode()]
+            else:
+                self.audio[name] = value
+        self.dirty = True
+
+    def replayGain(self, scope="track"):
+        # (gain, peak) strings as setReplayGain writes them, None when the file has none
+        if self.tag_type == "wav":
+            return None
+        values = []
+        for name in (f"REPLAYGAIN_{scope.upper()}_GAIN", f"REPLAYGAIN_{scope.upper()}_PEAK"):
+            if self.tag_type == "id3":
+                frame = self.audio.get(f"TXXX:{name}")
+                values.append(str(frame.text[0]) if frame else None)
+            elif self.tag_type == "mp4":
+                value = self.audio.get(f"----:com.apple.iTunes:{name.lower()}")
+                values.append(bytes(value[0]).decode("utf-8", errors="ignore") if value else None)
+            else:
+                value = self.audio.get(name)
+                values.append(value[0] if value else None)
+        return None if None in values else tuple(values)
+
+    def setCover(self, data: bytes):
+        if self.tag_type == "wav" or not data:
+            return False
+        mime = imageMime(data)
+        if self.tag_type == "id3":
+            from mutagen.id3 import APIC
+            self.audio.delall("APIC")
+            self.audio.add(APIC(
+                encoding=3,
+                mime=mime,
+                type=3,
+                desc="Cover",
+                data=data
+            ))
+        elif self.tag_type == "mp4":
+            from mutagen.mp4 import MP4Cover
+            imageformat = MP4Cover.FORMAT_PNG if mime == "image/png" else MP4Cover.FORMAT_JPEG
+            self.audio["covr"] = [MP4Cover(data, imageformat=imageformat)]
+        else:
+            from mutagen.flac import Picture
+            pic = Picture()
+            pic.type = 3
+            pic.desc = "Cover"
+            pic.data = data
+            pic.mime = mime
+
+            if self.tag_type == "flac":
+                self.audio.clear_pictures()
+                self.audio.add_picture(pic)
+            else:
+                # Ogg carries the picture block base64 encoded in a comment
+                self.audio["metadata_block_picture"] = [base64.b64encode(pic.write()).decode("ascii")]
+        self.dirty = True
+        return True
+
+    def keepPadding(self, info):
+        # Whatever room is left stays as padding (album gain is written later); only a file without enough
+        # room is rewritten, and then with some to spare
+        self.in_place = info.padding >= 0
+        return info.padding if self.in_place else max(info.get_default_padding(), TAG_PADDING)
+
+    def indexAfterAudio(self):
+        # MP4 tags live in moov; when it follows the audio, growing it only moves the rest of the index
+        from mutagen.mp4 import Atoms
+        with open(self.path, "rb") as f:
+            offsets = {atom.name: atom.offset for atom in Atoms(f).atoms}
+        return offsets.get(b"moov", -1) > offsets.get(b"mdat", 1 << 62)
+
+    def commit(self):
+        if not self.dirty:
+            return False
+        start = time.monotonic()
+        self.in_place = False
+        if self.tag_type == "id3":
+            self.audio.save(self.path, v2_version=3, padding=self.keepPadding)
+        else:
+            self.audio.save(padding=self.keepPadding)
+        if self.tag_type == "mp4" and not self.in_place:
+            self.in_place = self.indexAfterAudio()
+        # Timed under separate names so the report shows how many saves had to rewrite the whole file
+        rr.record("tag_save" if self.in_place else "tag_save_rewrite", time.monotonic() - start)
+        self.dirty = False
+        return True
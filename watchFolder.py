@@ -0,0 +1,248 @@
+import ctypes
+import ctypes.util
+import os
+import pathlib as pl
+import queue
+import select
+import struct
+import sys
+import threading
+import time
+
+import libraryScanner as ls
+
+SETTLE_SECONDS = 5.0  # A file is handed on once it hasn't changed for this long
+POLL_INTERVAL = 2.0  # Seconds between scans when inotify isn't available (or --watch-poll)
+TEMP_SUFFIXES = (".part", ".tmp", ".crdownload", "~")
+
+# inotify(7)
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+EVENT_HEADER = struct.Struct("iIII")
+
+class Inotify:
+    # Minimal inotify binding through libc, Linux only
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.add = libc.inotify_add_watch
+        self.add.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.remove = libc.inotify_rm_watch
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.paths = {}
+
+    def watch(self, path):
+        wd = self.add(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {path}")
+        self.paths[wd] = path
+        return wd
+
+    def read(self, timeout):
+        # [(directory, name, mask)], empty after timeout seconds without events
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0"))
+            offset += EVENT_HEADER.size + length
+            directory = self.paths.get(wd)
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+            events.append((directory, name, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class FolderWatcher:
+    # Watches folders (recursively) and hands on audio files once they stopped changing. Every event on a
+    # file pushes its deadline back, and at the deadline it still has to have the size and mtime it had at
+    # its last event, so copies over a share that close and reopen the file aren't picked up half written.
+    def __init__(self, roots, audio_formats, artwork_ext, exclude=(), settle=SETTLE_SECONDS, poll=False,
+                 recursive=True, existing=True):
+        self.roots = [pl.Path(root).resolve() for root in roots]
+        self.audio_formats = {ext.lower() for ext in audio_formats}
+        self.artwork_ext = [ext.lower() for ext in artwork_ext]
+        self.exclude = {os.path.normcase(str(pl.Path(p).resolve())) for p in exclude}
+        self.settle = settle
+        self.recursive = recursive
+        self.existing = existing
+        self.pending = {}  # path -> (deadline, (size, mtime) at the last event)
+        self.snapshot = {}  # Polling only: path -> stat
+        self.ready = queue.Queue()
+        self.stopping = threading.Event()
+        self.inotify = None
+        if not poll and sys.platform.startswith("linux"):
+            try:
+                self.inotify = Inotify()
+            except (OSError, AttributeError) as e:
+                print(f"WATCHER: inotify unavailable ({e}), polling every {POLL_INTERVAL:g}s instead.")
+        self.thread = threading.Thread(target=self.run, name="folder-watcher", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+
+    def wanted(self, path):
+        name = os.path.basename(path)
+        if name.startswith(".") or name.endswith(TEMP_SUFFIXES):
+            return False
+        return os.path.splitext(name)[1][1:].lower() in self.audio_formats
+
+    def excluded(self, directory):
+        return os.path.basename(directory).startswith(".") or os.path.normcase(str(directory)) in self.exclude
+
+    def sidecar(self, path: pl.Path):
+        for ext in self.artwork_ext:
+            for candidate in (path.with_suffix(f".{ext}"), path.with_suffix(f".{ext.upper()}")):
+                if candidate.is_file():
+                    return candidate
+        return None
+
+    def touch(self, path):
+        if not self.wanted(path):
+            return
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self.pending.pop(path, None)
+            return
+        self.pending[path] = (time.monotonic() + self.settle, (stat.st_size, stat.st_mtime_ns))
+
+    def watchTree(self, directory, mark_files):
+        # Adds watches for a folder and its subfolders; files already inside are marked as changed
+        stack = [str(directory)]
+        while stack:
+            current = stack.pop()
+            if self.excluded(current) and current not in map(str, self.roots):
+                continue
+            if self.inotify:
+                try:
+                    self.inotify.watch(current)
+                except OSError as e:
+                    print(f"WATCHER: Cannot watch {current}: {e}")
+            try:
+                with os.scandir(current) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            if self.recursive:
+                                stack.append(entry.path)
+                        elif mark_files:
+                            self.touch(entry.path)
+            except OSError as e:
+                print(f"WATCHER: Cannot read {current}: {e}")
+
+    def handle(self, directory, name, mask):
+        if mask & IN_Q_OVERFLOW:
+            # Events were dropped, look at everything again
+            print("WATCHER: Event queue overflowed, rescanning.")
+            for root in self.roots:
+                self.watchTree(root, True)
+            return
+        if directory is None:
+            return
+        path = os.path.join(directory, name) if name else directory
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO) and self.recursive and not self.excluded(path):
+                # Files can land in a new folder before its watch exists
+                self.watchTree(path, True)
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            self.pending.pop(path, None)
+        elif name:
+            self.touch(path)
+
+    def poll(self):
+        current = {}
+        for root in self.roots:
+            for path, _ in ls.scanLibrary(root, self.audio_formats, [], recursive=self.recursive, exclude=self.exclude):
+                try:
+                    stat = path.stat()
+                except OSError:
+                    continue
+                current[str(path)] = (stat.st_size, stat.st_mtime_ns)
+        for path, stat in current.items():
+            if self.snapshot.get(path) != stat:
+                self.touch(path)
+        for path in set(self.pending) - set(current):
+            self.pending.pop(path, None)
+        self.snapshot = current
+
+    def settled(self):
+        now = time.monotonic()
+        for path, (deadline, seen) in list(self.pending.items()):
+            if deadline > now:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                self.pending.pop(path, None)
+                continue
+            state = (stat.st_size, stat.st_mtime_ns)
+            if state != seen:
+                # Changed without an event (network shares), give it another settle period
+                self.pending[path] = (now + self.settle, state)
+                continue
+            del self.pending[path]
+            source = pl.Path(path)
+            self.ready.put((source, self.sidecar(source)))
+
+    def run(self):
+        if self.inotify:
+            for root in self.roots:
+                self.watchTree(root, self.existing)
+        else:
+            self.poll()
+            if not self.existing:
+                self.pending.clear()
+        mode = "inotify" if self.inotify else f"polling every {POLL_INTERVAL:g}s"
+        print(f"WATCHER: Watching {', '.join(map(str, self.roots))} ({mode}, files settle for {self.settle:g}s).")
+
+        next_poll = time.monotonic() + POLL_INTERVAL
+        try:
+            while not self.stopping.is_set():
+                deadlines = [deadline for deadline, _ in self.pending.values()]
+                timeout = max(0.05, min([min(deadlines) - time.monotonic()] if deadlines else [1.0]))
+                if self.inotify:
+                    for directory, name, mask in self.inotify.read(min(timeout, 1.0)):
+                        self.handle(directory, name, mask)
+                else:
+                    self.stopping.wait(min(timeout, max(0.05, next_poll - time.monotonic())))
+                    if time.monotonic() >= next_poll:
+                        self.poll()
+                        next_poll = time.monotonic() + POLL_INTERVAL
+                self.settled()
+        finally:
+            if self.inotify:
+                self.inotify.close()
+            self.ready.put(None)
+
+    def __iter__(self):
+        # Stable (audio path, sidecar artwork or None) pairs until stop()
+        while True:
+            item = self.ready.get()
+            if item is None:
+                return
+            yield item